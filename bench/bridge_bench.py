@@ -0,0 +1,110 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: bench/bridge_bench.py
+# Description: Measures CPU cost of bridged calls (CallSession.handler audio path) to find how many calls one core can sustain.
+# Author: Aydin Parin
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import random
+import socket
+import time
+import common
+import g711
+from call_session import CallSession, FROM_PSTN
+from ip_phone import IPPhone
+from line import Line
+
+FRAME_TIME = 0.02  # modem read and RTP packet interval
+FRAME_LEN = int(common.SAMPLE_FREQ * FRAME_TIME)
+
+class FakeSerial:  # modem receive buffer filled by benchmark, transmitted data dropped
+	def __init__(self):
+		self.buffer = bytearray()
+		self.is_open = True
+		self.out_waiting = 0
+
+	@property
+	def in_waiting(self) -> int:
+		return len(self.buffer)
+
+	def read(self, size: int) -> bytes:
+		data = bytes(self.buffer[:size])
+		del self.buffer[:size]
+		return data
+
+	def write(self, data: bytes) -> int:
+		return len(data)
+
+	def reset_input_buffer(self) -> None:
+		self.buffer.clear()
+
+	def reset_output_buffer(self) -> None:
+		pass
+
+def make_call(n: int, peer: socket.socket, voice_format: str) -> CallSession:
+	line = Line(f'/dev/null{n}')
+	line.modem = FakeSerial()
+	line.state = common.PS_CONNECTED
+	line.voice_format = voice_format
+	line.tx_silence = g711.silence(voice_format, len(line.tx_silence))
+	ip_phone = IPPhone('bench', '127.0.0.1', '', '127.0.0.1', 0, common.RTP_LOW, common.RTP_HIGH, '127.0.0.1', 0)
+	ip_phone.rtp_local_port = 0
+	ip_phone.rtp_start()
+	ip_phone.rtp_remote_ip, ip_phone.rtp_remote_port = peer.getsockname()
+	ip_phone.rtp_outSequence = 1
+	ip_phone.rtp_outTimestamp = 1
+	ip_phone.rtp_outSSRC = 1000 + n
+	ip_phone.state = common.PS_CONNECTED
+	ip_phone.set_audio_format(voice_format)
+	session = CallSession(line, ip_phone, FROM_PSTN)
+	session.cross_connected = True
+	return session
+
+def rtp_packet(seq: int, payload: bytes) -> bytes:
+	return b'\x80\x00' + (seq & 0xFFFF).to_bytes(2, 'big') + (seq * FRAME_LEN).to_bytes(4, 'big') + (1234).to_bytes(4, 'big') + payload
+
+def bench(calls: int, seconds: float, voice_format: str = g711.LINEAR) -> float:  # returns CPU seconds used by call handlers per second of audio
+	peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	peer.bind(('127.0.0.1', 0))
+	peer.setblocking(False)
+	peer.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+	sessions = [make_call(n, peer, voice_format) for n in range(calls)]
+	pstn_audio = g711.encode(voice_format, bytes(random.randint(96, 160) for i in range(FRAME_LEN)))
+	ip_payload = bytes(random.randint(0, 255) for i in range(FRAME_LEN))
+	frames = int(seconds / FRAME_TIME)
+	used = 0.0
+	for seq in range(frames):
+		for s in sessions:  # one frame from both sides of every call
+			s.line.modem.buffer += pstn_audio
+			peer.sendto(rtp_packet(seq, ip_payload), ('127.0.0.1', s.ip_phone.rtp_sckt.getsockname()[1]))
+		start = time.process_time()
+		for s in sessions:
+			s.handler()
+		used += time.process_time() - start
+		try:
+			while (True):  # drain packets sent to IP side
+				peer.recv(2048)
+		except BlockingIOError:
+			pass
+	for s in sessions:
+		s.ip_phone.rtp_stop()
+	peer.close()
+	return used / seconds
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='pstnxsip bridged call CPU benchmark')
+	parser.add_argument('calls', nargs='*', type=int, default=[1, 2, 4, 8], help='simultaneous bridged calls')
+	parser.add_argument('--seconds', type=float, default=10.0, help='seconds of audio per run')
+	parser.add_argument('--passthrough', action='store_true', help='modem voice data in G.711 mu-law (MODEM_PASSTHROUGH), PCMU payloads are not transcoded')
+	args = parser.parse_args()
+	voice_format = (g711.ULAW if args.passthrough else g711.LINEAR)
+	print(f'modem voice format: {voice_format}')
+	print(f'{"calls":>6} {"cpu/s audio":>12} {"per call":>10} {"max calls":>10}')
+	for calls in args.calls:
+		load = bench(calls, args.seconds, voice_format)
+		per_call = load / calls
+		print(f'{calls:>6} {load * 100:>11.2f}% {per_call * 100:>9.3f}% {int(1 / per_call):>10}')
+	print('max calls: estimated simultaneous bridged calls at 100% of one core (without SIP signaling and prompts)')
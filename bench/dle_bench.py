@@ -0,0 +1,125 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: bench/dle_bench.py
+# Description: Measures modem receive decoding speed (bytes per second) of line.DLEDecoder against the previous in-place <DLE> eraser.
+# Author: Aydin Parin
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import math
+import random
+import time
+import common
+from line import DLEDecoder, DLE_CHAR, DLE_ERASER, DCE_BUSY_TONE, DCE_DIAL_TONE, DCE_SILENCE_DETECTED, DCE_END_VOICE_DATA_TX, \
+	DCE_TX_BUFFER_UNDERRUN, DCE_RX_BUFFER_OVERRUN
+
+STREAM_SECONDS = 60  # seconds of audio in each synthetic stream
+
+def voice(seconds: float, level: float) -> bytearray:  # 8-bit unsigned pcm speech like signal, level 1 is full scale
+	samples = bytearray()
+	phase = 0.0
+	for n in range(int(seconds * common.SAMPLE_FREQ)):
+		envelope = level * (0.5 + 0.5 * math.sin(2 * math.pi * 3 * n / common.SAMPLE_FREQ))  # syllables
+		phase += 2 * math.pi * (180 + 60 * math.sin(n / 4000)) / common.SAMPLE_FREQ
+		v = envelope * (0.6 * math.sin(phase) + 0.3 * math.sin(3 * phase)) + random.gauss(0, 0.01)
+		samples.append(max(0, min(255, int(128 + 127 * v))))
+	return samples
+
+def shield(samples: bytearray, events: dict) -> bytes:  # modem stream of samples, 0x10 samples doubled, events {sample index: code} inserted
+	stream = bytearray()
+	for n, v in enumerate(samples):
+		if (n in events):
+			stream += bytes([DLE_CHAR, events[n]])
+		if (v == DLE_CHAR):
+			stream += bytes([DLE_CHAR, DLE_CHAR])
+		else:
+			stream.append(v)
+	return bytes(stream)
+
+def streams() -> dict:  # name: modem receive stream
+	random.seed(1)
+	quiet = voice(STREAM_SECONDS, 0.3)  # no 0x10 samples, fast path
+	loud = voice(STREAM_SECONDS, 1.4)  # clipped peaks pass 0x10, doubled <DLE>s
+	dtmf = {}
+	for n in range(0, len(quiet), common.SAMPLE_FREQ):  # a digit every second, underruns sometimes
+		dtmf[n] = ord(random.choice(common.DTMF_DIGITS))
+		if (random.random() < 0.2):
+			dtmf[n + 80] = DCE_TX_BUFFER_UNDERRUN
+	return {'quiet': shield(quiet, {}), 'loud': shield(loud, {}), 'dtmf': shield(quiet, dtmf), 'loud+dtmf': shield(loud, dtmf)}
+
+def reads(stream: bytes, size: int) -> list:  # stream as serial reads of size +- 50% bytes, <DLE> pairs split between reads too
+	chunks = []
+	n = 0
+	while (n < len(stream)):
+		length = random.randint(size // 2, size + size // 2)
+		chunks.append(stream[n:n + length])
+		n += length
+	return chunks
+
+def erase(pstn_read: bytearray) -> bytearray:  # previous decoder (without debug), <DLE> and code bytes changed to DLE_ERASER in place
+	dle = pstn_read.find(DLE_CHAR)
+	while (dle >= 0):
+		pstn_read[dle] = DLE_ERASER
+		dle += 1
+		if (dle == len(pstn_read)):
+			break
+		code = pstn_read[dle]
+		if (code == DLE_CHAR):
+			pass
+		elif (code in (DCE_BUSY_TONE, DCE_DIAL_TONE, DCE_SILENCE_DETECTED, DCE_END_VOICE_DATA_TX)):
+			break
+		elif (code in (DCE_TX_BUFFER_UNDERRUN, DCE_RX_BUFFER_OVERRUN)):
+			pass
+		elif (chr(code) in common.DTMF_DIGITS):
+			pass
+		pstn_read[dle] = DLE_ERASER
+		dle = pstn_read.find(DLE_CHAR, dle)
+	return pstn_read
+
+def bench(chunks: list, repeat: int) -> tuple:  # (decoder, previous) bytes per second
+	events = []
+	decoder = DLEDecoder([events.append] * 256)
+	total = sum([len(c) for c in chunks]) * repeat
+	start = time.perf_counter()
+	for i in range(repeat):
+		for c in chunks:
+			decoder.decode(c)
+	decoded = time.perf_counter() - start
+	start = time.perf_counter()
+	for i in range(repeat):
+		for c in chunks:
+			erase(bytearray(c))  # read_audio copied serial data to a bytearray
+	erased = time.perf_counter() - start
+	return total / decoded, total / erased
+
+def check(stream: bytes, chunks: list) -> bool:  # chunked decode gives the samples of one piece decode
+	whole = []
+	split = []
+	audio = DLEDecoder([whole.append] * 256).decode(stream)
+	decoder = DLEDecoder([split.append] * 256)
+	return (b''.join([bytes(decoder.decode(c)) for c in chunks]) == bytes(audio)) and (whole == split)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='pstnxsip modem receive <DLE> decoder benchmark')
+	parser.add_argument('files', nargs='*', help='captured modem receive streams (raw bytes read in voice mode), synthetic streams if none')
+	parser.add_argument('--read', type=int, default=common.RTP_LEN, help='average serial read size')
+	parser.add_argument('--repeat', type=int, default=5, help='decode each stream this many times')
+	args = parser.parse_args()
+	if (args.files == []):
+		tests = streams()
+	else:
+		tests = {}
+		for name in args.files:
+			with open(name, 'rb') as f:
+				tests[os.path.basename(name)] = f.read()
+	print(f'{"stream":>12} {"bytes":>9} {"<DLE>s":>7} {"decoder MB/s":>13} {"previous MB/s":>14} {"speedup":>8}')
+	for name, stream in tests.items():
+		chunks = reads(stream, args.read)
+		if (not check(stream, chunks)):
+			print(f'{name}: Error! Decoded audio differs when stream is split into reads.')
+			continue
+		decoded, erased = bench(chunks, args.repeat)
+		print(f'{name:>12} {len(stream):>9} {stream.count(DLE_CHAR):>7} {decoded / 1e6:>13.2f} {erased / 1e6:>14.2f} {decoded / erased:>7.1f}x')
+	print(f'modem voice stream is {common.SAMPLE_FREQ} bytes per second per line')
@@ -0,0 +1,47 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: bench/dsp_bench.py
+# Description: Measures CPU time per second of audio of each bridge processing stage (dsp.py) and of the frame decode and encode of a pipeline, fed in modem read sizes.
+# Author: Aydin Parin
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import platform
+import random
+import time
+import common
+import dsp
+import g711
+from dle_bench import voice
+
+READ_LEN = 168  # modem reads are a little longer than a frame, rest waits in pipeline
+
+def run(specs: list, audio_format: str, audio: bytes) -> tuple:  # (pipeline, CPU seconds of process calls)
+	pipeline = dsp.pipeline('bench', specs, audio_format)
+	start = time.process_time()
+	for n in range(0, len(audio), READ_LEN):
+		pipeline.process(audio[n:n + READ_LEN])
+	return pipeline, time.process_time() - start
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='pstnxsip bridge DSP stage benchmark')
+	parser.add_argument('--seconds', type=float, default=60, help='seconds of audio per test (default 60)')
+	args = parser.parse_args()
+	if (dsp.numpy == None):
+		sys.exit('dsp.py needs NumPy (pip install numpy)')
+	random.seed(1)
+	speech = bytes(voice(args.seconds, 0.8))
+	seconds = len(speech) / common.SAMPLE_FREQ
+	print(f'{platform.machine()} {platform.python_implementation()} {platform.python_version()}, NumPy {dsp.numpy.__version__}')
+	print(f'{"stages":<42} {"format":<5} {"stage ms/s":>11} {"total ms/s":>11} {"loop %":>7}')
+	tests = [[name] for name in dsp.STAGES] + [['dc_removal', 'high_pass:300', 'agc:-20', 'meter']]
+	for audio_format in (g711.LINEAR, g711.ULAW):
+		audio = g711.encode(audio_format, speech)
+		for specs in tests:
+			pipeline, cpu = run(specs, audio_format, audio)
+			stages = sum([stage.cpu for stage in pipeline.stages])
+			print(f'{", ".join(specs):<42} {audio_format:<5} {stages * 1e3 / seconds:>11.2f} {cpu * 1e3 / seconds:>11.2f} {cpu * 100 / seconds:>6.2f}%')
+	print('stage ms/s: CPU milliseconds per second of audio in stages (per-stage timers of pipeline), total: with frame decode, encode and timing,')
+	print('loop %: share of one core, one direction of one call')
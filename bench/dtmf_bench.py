@@ -0,0 +1,59 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: bench/dtmf_bench.py
+# Description: Measures CPU time per second of PSTN audio of the software DTMF detector (dtmf.py) with NumPy and pure Python filter banks, and checks detected digits of synthetic key presses and talk-off on speech.
+# Author: Aydin Parin
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import math
+import platform
+import random
+import time
+import common
+import dtmf
+import g711
+from dle_bench import voice
+
+def key_presses(digits: str, tone_time: float, pause_time: float, level: float, twist: float) -> bytes:  # 8-bit unsigned pcm, twist in dB (column tone weaker)
+	samples = bytearray()
+	for digit in digits:
+		row = [r for r in range(4) if (digit in dtmf.KEYS[r])][0]
+		column = dtmf.KEYS[row].index(digit)
+		low = 2 * math.pi * dtmf.ROW_FREQS[row] / common.SAMPLE_FREQ
+		high = 2 * math.pi * dtmf.COLUMN_FREQS[column] / common.SAMPLE_FREQ
+		for n in range(int(tone_time * common.SAMPLE_FREQ)):
+			v = level * (math.sin(low * n) + 10 ** (-twist / 20) * math.sin(high * n)) + random.gauss(0, 1)
+			samples.append(max(0, min(255, int(128 + v))))
+		samples += bytes([128]) * int(pause_time * common.SAMPLE_FREQ)
+	return bytes(samples)
+
+def detect(detector: dtmf.Detector, audio: bytes) -> tuple:  # (digits, CPU seconds), fed in RTP_LEN reads like Line.decode_audio
+	digits = ''
+	start = time.process_time()
+	for n in range(0, len(audio), common.RTP_LEN):
+		digits += detector.feed(audio[n:n + common.RTP_LEN])
+	return digits, time.process_time() - start
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='pstnxsip software DTMF detector benchmark')
+	parser.add_argument('--seconds', type=float, default=60, help='seconds of audio per test (default 60)')
+	args = parser.parse_args()
+	random.seed(1)
+	keys = ''.join([random.choice(common.DTMF_DIGITS) for n in range(int(args.seconds / 0.1))])  # 50 ms tone, 50 ms pause
+	tests = {'digits': key_presses(keys, 0.05, 0.05, 50, 0), 'digits-twist': key_presses(keys, 0.05, 0.05, 50, 6), \
+		'digits-quiet': key_presses(keys, 0.05, 0.05, 8, 0), 'speech': bytes(voice(args.seconds, 0.8))}
+	banks = [('python', False)] + ([('numpy', True)] if (dtmf.numpy != None) else [])
+	print(f'{platform.machine()} {platform.python_implementation()} {platform.python_version()}, NumPy {dtmf.numpy.__version__ if (dtmf.numpy != None) else "not installed"}')
+	print(f'{"bank":<7} {"format":<5} {"test":<13} {"cpu ms/s":>9} {"loop %":>7} {"digits":>7} {"errors":>7}')
+	for bank, vectorized in banks:
+		for audio_format in (g711.LINEAR, g711.ULAW):
+			for name, audio in tests.items():
+				expected = ('' if (name == 'speech') else keys)
+				digits, cpu = detect(dtmf.Detector(audio_format, vectorized), g711.encode(audio_format, audio))
+				errors = sum([a != b for a, b in zip(digits, expected)]) + abs(len(digits) - len(expected))
+				seconds = len(audio) / common.SAMPLE_FREQ
+				print(f'{bank:<7} {audio_format:<5} {name:<13} {cpu * 1e3 / seconds:>9.2f} {cpu * 100 / seconds:>6.2f}% {len(digits):>7} {errors:>7}')
+	print('cpu ms/s: CPU milliseconds per second of audio of one line, loop %: share of one core')
@@ -0,0 +1,101 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: bench/echo_bench.py
+# Description: Measures CPU time per call of the NLMS echo canceller (echo_canceller.py) at 64, 128 and 256 taps, and its echo return loss enhancement, near-end speech kept in double-talk and delay estimation on a synthetic echo path.
+# Author: Aydin Parin
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import math
+import platform
+import random
+import time
+import common
+import echo_canceller
+import g711
+from dle_bench import voice
+
+TAPS = (64, 128, 256)
+READ_LEN = 160  # modem read and write size (Line.TX_BLOCK, common.RTP_LEN)
+LEAD_BLOCKS = 3  # blocks written ahead of playback (Line.TX_FIFO_LEVEL)
+ECHO_DELAY = 0.035  # seconds from playback to echo in near-end audio (hybrid and modem buffers)
+ECHO_TAIL = 40  # samples of echo impulse response (5 ms)
+ERL = 10  # dB, echo return loss of line
+DOUBLE_TALK = ((0.3, 0.4), (0.7, 0.8))  # parts of stream with near-end speech
+DELAY_JUMP = 0.5  # part of stream where echo path delay changes in delay-jump test (modem underrun)
+JUMP = 0.02  # seconds of delay change
+NEAR_PITCH = 1.3  # near-end talker speaks faster at higher pitch
+
+def echo_path() -> list:  # decaying impulse response with ERL dB loss
+	h = [random.gauss(0, 1) * math.exp(-n / 8) for n in range(ECHO_TAIL)]
+	scale = 10 ** (-ERL / 20) / math.sqrt(sum([v * v for v in h]))
+	return [v * scale for v in h]
+
+def streams(seconds: float, jump: bool) -> tuple:  # (far-end, near-end speech, near-end with echo) 16-bit samples
+	numpy = echo_canceller.numpy
+	far = (numpy.frombuffer(bytes(voice(seconds, 0.5)), dtype=numpy.uint8).astype(numpy.float64) - 128) * 256
+	speech = (numpy.frombuffer(bytes(voice(seconds * NEAR_PITCH, 0.3)), dtype=numpy.uint8).astype(numpy.float64) - 128) * 256
+	speech = numpy.interp(numpy.arange(len(far)) * NEAR_PITCH, numpy.arange(len(speech)), speech)  # other talker, higher pitch and syllable rate
+	talk = numpy.zeros(len(far))
+	for start, end in DOUBLE_TALK:
+		talk[int(start * len(far)):int(end * len(far))] = 1
+	speech = speech * talk
+	echo = numpy.convolve(far, echo_path())[:len(far)]
+	delay = int(ECHO_DELAY * common.SAMPLE_FREQ)
+	delayed = numpy.concatenate((numpy.zeros(delay), echo))[:len(far)]
+	if (jump):
+		n = int(DELAY_JUMP * len(far))
+		later = numpy.concatenate((numpy.zeros(delay + int(JUMP * common.SAMPLE_FREQ)), echo))[:len(far)]
+		delayed[n:] = later[n:]
+	near = delayed + speech + numpy.random.normal(0, 20, len(far))
+	return far, speech, near
+
+def run(taps: int, audio_format: str, far: object, near: object) -> tuple:  # (near-end output samples, canceller, CPU seconds), written and read in READ_LEN blocks
+	numpy = echo_canceller.numpy
+	canceller = echo_canceller.EchoCanceller(taps, audio_format)
+	table = echo_canceller.format_table(audio_format)
+	far_data = echo_canceller.encode(audio_format, far)
+	near_data = echo_canceller.encode(audio_format, near)
+	out = bytearray()
+	cpu = 0.0
+	for n in range(0, len(far_data), READ_LEN):
+		start = time.process_time()
+		canceller.far(far_data[n:n + READ_LEN])
+		if (n >= LEAD_BLOCKS * READ_LEN):
+			out += canceller.near(near_data[n - LEAD_BLOCKS * READ_LEN:n - (LEAD_BLOCKS - 1) * READ_LEN])
+		cpu += time.process_time() - start
+	return table[numpy.frombuffer(bytes(out), dtype=numpy.uint8)].astype(numpy.float64), canceller, cpu
+
+def ratio(a: object, b: object) -> float:  # dB
+	return 10 * math.log10(max(float(echo_canceller.numpy.dot(a, a)), 1) / max(float(echo_canceller.numpy.dot(b, b)), 1))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='pstnxsip NLMS echo canceller benchmark')
+	parser.add_argument('--seconds', type=float, default=30, help='seconds of audio per test (default 30)')
+	args = parser.parse_args()
+	if (echo_canceller.numpy == None):
+		sys.exit('echo_canceller.py needs NumPy (pip install numpy)')
+	numpy = echo_canceller.numpy
+	random.seed(1)
+	numpy.random.seed(1)
+	print(f'{platform.machine()} {platform.python_implementation()} {platform.python_version()}, NumPy {numpy.__version__}')
+	print(f'{"taps":>4} {"format":<5} {"test":<10} {"cpu ms/s":>9} {"loop %":>7} {"delay ms":>9} {"erle dB":>8} {"near dB":>8}')
+	for test in ('echo', 'delay-jump'):
+		far, speech, near = streams(args.seconds, test == 'delay-jump')
+		talk = (speech != 0)
+		for taps in TAPS:
+			for audio_format in (g711.LINEAR, g711.ULAW):
+				out, canceller, cpu = run(taps, audio_format, far, near)
+				size = len(out)
+				single = numpy.arange(size) >= size // 2  # converged echo only part, after delay jump
+				single &= ~talk[:size]
+				erle = ratio(near[:size][single], out[single])
+				near_error = ratio(speech[:size][talk[:size]], (out - speech[:size])[talk[:size]])  # near-end speech to residual echo and distortion in double-talk
+				delay = canceller.delay()
+				seconds = size / common.SAMPLE_FREQ
+				print(f'{taps:>4} {audio_format:<5} {test:<10} {cpu * 1e3 / seconds:>9.2f} {cpu * 100 / seconds:>6.2f}% {(delay * 1000 if (delay != None) else 0):>9.1f} {erle:>8.1f} {near_error:>8.1f}')
+	print(f'echo path: {ECHO_DELAY * 1000:.0f} ms delay after playback ({LEAD_BLOCKS * READ_LEN / common.SAMPLE_FREQ * 1000:.0f} ms written ahead), {ECHO_TAIL} samples tail, ERL {ERL} dB')
+	print('cpu ms/s: CPU milliseconds per second of one call (far-end and near-end), loop %: share of one core, erle: echo removed in single-talk,')
+	print('near dB: near-end speech to residual echo and distortion in double-talk')
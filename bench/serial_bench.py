@@ -0,0 +1,112 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: bench/serial_bench.py
+# Description: Compares system calls, heap allocations and CPU time per second of modem audio of pyserial and raw_serial (termios) ports on a pseudo terminal (linux, macOS).
+# Author: Aydin Parin
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import fcntl
+import pty
+import select
+import time
+import tty
+import serial
+import common
+import raw_serial
+from line import TX_BLOCK
+
+PORT_MODULES = ('serial.serialposix', 'serial.serialutil', 'raw_serial')  # system calls of these modules are counted
+SYSCALLS = {os.read: 'read', os.write: 'write', os.readv: 'readv', fcntl.ioctl: 'ioctl', select.select: 'select'}
+
+class Counter:  # profile hook counting system calls of port modules and heap blocks allocated between profiler events
+	def __init__(self):
+		self.syscalls = {}
+		self.allocations = 0
+		self.blocks = 0
+
+	def hook(self, frame, event: str, arg) -> None:
+		blocks = sys.getallocatedblocks()
+		if (blocks > self.blocks):  # freed blocks are not subtracted, a lower bound of allocations
+			self.allocations += blocks - self.blocks
+		self.blocks = blocks
+		if ((event == 'c_call') and (arg in SYSCALLS) and (frame.f_globals.get('__name__') in PORT_MODULES)):
+			name = SYSCALLS[arg]
+			self.syscalls[name] = self.syscalls.get(name, 0) + 1
+
+	def measure(self, func, *args) -> object:
+		self.blocks = sys.getallocatedblocks()
+		sys.setprofile(self.hook)
+		try:
+			result = func(*args)
+		finally:
+			sys.setprofile(None)
+		self.hook(None, 'return', None)
+		return result
+
+def open_port(port_class, name: str) -> object:  # configured like Line does
+	port = port_class()
+	port.port = name
+	port.baudrate = 115200
+	port.timeout = 0
+	port.writeTimeout = 0
+	port.open()
+	return port
+
+def line_read(port) -> bytes:  # Line.read_audio
+	in_waiting = port.in_waiting
+	if (in_waiting >= common.RTP_LEN):
+		return port.read(in_waiting)
+	return None
+
+def run(port_class, seconds: float, counter: Counter = None) -> float:  # returns CPU seconds of port calls
+	master, slave = pty.openpty()
+	tty.setraw(master)
+	port = open_port(port_class, os.ttyname(slave))
+	frame = bytes([0x80 + (n % 64) for n in range(common.RTP_LEN)])  # 20 ms of voice data written by modem
+	block = bytearray(TX_BLOCK)  # Line.tx_pace writes a preallocated block
+	view = memoryview(block)
+	cpu = 0.0
+	try:
+		for n in range(int(seconds * common.SAMPLE_FREQ / common.RTP_LEN)):
+			os.write(master, frame)
+			t = time.process_time()
+			if (counter != None):
+				audio = counter.measure(line_read, port)
+				counter.measure(port.write, view)
+			else:
+				audio = line_read(port)
+				port.write(view)
+			cpu += time.process_time() - t
+			if ((audio == None) or (len(audio) != len(frame))):
+				raise RuntimeError(f'serial_bench: short read {audio}')
+			while (select.select([master], [], [], 0)[0]):  # drain modem side
+				os.read(master, 4096)
+	finally:
+		port.close()
+		os.close(master)
+		os.close(slave)
+	return cpu
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description='pyserial and raw_serial port costs per second of modem audio (one read and one write per 20 ms)')
+	parser.add_argument('--seconds', type=float, default=60, help='seconds of audio (default 60)')
+	args = parser.parse_args()
+	if (not raw_serial.available):
+		print('raw_serial needs termios (linux, macOS)')
+		return
+	ports = (('pyserial', serial.Serial), ('raw_serial', raw_serial.RawSerial))
+	print(f'{"port":<12} {"syscalls/s":>11} {"allocs/s":>9} {"cpu us/s":>9}  system calls per second of audio')
+	for name, port_class in ports:
+		counter = Counter()
+		run(port_class, args.seconds, counter)
+		cpu = run(port_class, args.seconds)
+		syscalls = sum(counter.syscalls.values()) / args.seconds
+		detail = ', '.join([f'{call} {count / args.seconds:.0f}' for call, count in sorted(counter.syscalls.items())])
+		print(f'{name:<12} {syscalls:>11.0f} {counter.allocations / args.seconds:>9.0f} {cpu * 1e6 / args.seconds:>9.0f}  {detail}')
+	print('allocs: heap blocks allocated by port calls (lower bound, blocks freed in the same call are not counted)')
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,75 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: bench/tone_bench.py
+# Description: Measures detection latency of every call progress tone of each country table (call_progress.py) from tone start, CPU time per second of audio and false detections on speech, DTMF and ringback.
+# Author: Aydin Parin
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import math
+import random
+import time
+import call_progress
+import common
+import g711
+from call_progress import Tone
+from dle_bench import voice
+from dtmf_bench import key_presses
+
+LEAD_TIME = 0.5  # seconds of speech before tone starts
+RINGBACKS = {'B5': Tone('ringback', (440, 480), (2.0, 4.0)), 'B4': Tone('ringback', (400, 450), (0.4, 0.2, 0.4, 2.0)), \
+	'04': Tone('ringback', (425,), (1.0, 4.0)), '3D': Tone('ringback', (440,), (1.5, 3.5)), 'AE': Tone('ringback', (450,), (1.0, 4.0))}  # must not be detected
+
+def tone_audio(tone: Tone, seconds: float, level: float) -> bytes:  # 8-bit unsigned pcm, cadence started at first sample
+	cadence = tone.cadence or (seconds,)
+	samples = bytearray()
+	for n in range(int(seconds * common.SAMPLE_FREQ)):
+		t = (n / common.SAMPLE_FREQ) % sum(cadence)
+		segment = 0
+		while (t >= cadence[segment]):
+			t -= cadence[segment]
+			segment += 1
+		v = sum([level * math.sin(2 * math.pi * f * n / common.SAMPLE_FREQ) for f in tone.freqs]) if ((segment % 2) == 0) else 0
+		samples.append(max(0, min(255, int(128 + v + random.gauss(0, 0.7)))))
+	return bytes(samples)
+
+def run(country: str, audio: bytes, audio_format: str) -> tuple:  # (first detected tone, seconds of audio until detected, CPU seconds), fed in RTP_LEN reads
+	detector = call_progress.Detector(country, audio_format)
+	data = g711.encode(audio_format, audio)
+	detected = None
+	at = 0.0
+	start = time.process_time()
+	for n in range(0, len(data), common.RTP_LEN):
+		tone = detector.feed(data[n:n + common.RTP_LEN])
+		if ((tone != None) and (detected == None)):
+			detected = tone
+			at = (n + common.RTP_LEN) / common.SAMPLE_FREQ
+	return detected, at, time.process_time() - start
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='pstnxsip call progress tone detector benchmark')
+	parser.add_argument('--format', choices=(g711.LINEAR, g711.ULAW, g711.ALAW), default=g711.LINEAR, help='modem voice format (default pcm)')
+	parser.add_argument('--level', type=float, default=30, help='tone amplitude in 8-bit sample units (default 30, about -12 dB)')
+	parser.add_argument('--seconds', type=float, default=60, help='seconds of speech, DTMF and ringback for false detections (default 60)')
+	args = parser.parse_args()
+	random.seed(1)
+	lead = bytes(voice(LEAD_TIME, 0.5))
+	print(f'{"country":<8} {"tone":<28} {"detected":<11} {"latency s":>9} {"cpu ms/s":>9}')
+	for country, tones in list(call_progress.COUNTRY_TONES.items()) + [('default', call_progress.DEFAULT_TONES)]:
+		for tone in tones:
+			detected, at, cpu = run(country, lead + tone_audio(tone, 4, args.level), args.format)
+			latency = (f'{at - LEAD_TIME:.2f}' if (detected != None) else '-')
+			print(f'{country:<8} {str(tone):<28} {detected.name if (detected != None) else "missed":<11} {latency:>9} {cpu * 1e3 / (LEAD_TIME + 4):>9.2f}')
+	print(f'{"country":<8} {"false detections in":<28} {"detected":<11}')
+	digits = ''.join([random.choice(common.DTMF_DIGITS) for n in range(int(args.seconds / 0.1))])
+	tests = {'speech': bytes(voice(args.seconds, 0.8)), 'dtmf': key_presses(digits, 0.05, 0.05, 30, 0)}
+	for country in call_progress.COUNTRY_TONES:
+		cases = dict(tests)
+		if (country in RINGBACKS):
+			cases[str(RINGBACKS[country])] = tone_audio(RINGBACKS[country], args.seconds, args.level)
+		for name, audio in cases.items():
+			detected, at, cpu = run(country, audio, args.format)
+			print(f'{country:<8} {name:<28} {(f"{detected.name} at {at:.1f} s") if (detected != None) else "none"}')
+	print('latency: seconds from tone start until detected, cpu ms/s: CPU milliseconds per second of audio of one line')
@@ -0,0 +1,71 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: bench/vad_bench.py
+# Description: Measures RTP packets sent with voice activity detection (vad.py) on a conversation with pauses, speech frames lost to silence, and CPU time of the detector and of comfort noise synthesis.
+# Author: Aydin Parin
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import platform
+import random
+import time
+import common
+import g711
+import vad
+from dle_bench import voice
+
+TALK = (0.5, 3.0)  # seconds of a talkspurt and of a pause, uniformly random
+NOISE = 0.003  # line noise (part of full scale), about -50 dBov
+
+def conversation(seconds: float) -> tuple:  # (8-bit unsigned pcm audio, talk flag of each RTP_LEN frame), one party talks about half of the time
+	speech = voice(seconds, 0.5)
+	audio = bytearray()
+	talk = []
+	talking = True
+	while (len(audio) < len(speech)):
+		size = int(random.uniform(*TALK) * common.SAMPLE_FREQ)
+		size -= size % common.RTP_LEN
+		if (talking):
+			audio += speech[len(audio):len(audio) + size]
+		else:
+			audio += bytes([max(0, min(255, int(128 + 127 * random.gauss(0, NOISE)))) for n in range(size)])
+		talk += [talking] * (size // common.RTP_LEN)
+		talking = not talking
+	return bytes(audio[:len(speech)]), talk
+
+def run(audio_format: str, audio: bytes) -> tuple:  # (actions of each frame, CPU seconds of feed)
+	detector = vad.Detector()
+	actions = []
+	start = time.process_time()
+	for n in range(0, len(audio) - common.RTP_LEN + 1, common.RTP_LEN):
+		actions.append(detector.feed(audio_format, audio[n:n + common.RTP_LEN]))
+	return actions, time.process_time() - start
+
+def noise_cpu(audio_format: str, seconds: float) -> float:  # CPU seconds of comfort noise for seconds of silence
+	noise = vad.ComfortNoise()
+	noise.level = 50
+	start = time.process_time()
+	for n in range(int(seconds * common.SAMPLE_FREQ / common.RTP_LEN)):
+		noise.generate(common.RTP_LEN, audio_format)
+	return time.process_time() - start
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='pstnxsip voice activity detection and comfort noise benchmark')
+	parser.add_argument('--seconds', type=float, default=120, help='seconds of conversation (default 120)')
+	args = parser.parse_args()
+	random.seed(1)
+	pcm, talk = conversation(args.seconds)
+	seconds = len(pcm) / common.SAMPLE_FREQ
+	print(f'{platform.machine()} {platform.python_implementation()} {platform.python_version()}, talk {100 * sum(talk) / len(talk):.0f}% of {seconds:.0f} s')
+	print(f'{"format":<6} {"frames":>7} {"packets":>8} {"sid":>5} {"sent %":>7} {"clipped":>8} {"vad ms/s":>9} {"cn ms/s":>8}')
+	for audio_format in (g711.LINEAR, g711.ULAW, g711.ALAW):
+		audio = g711.encode(audio_format, pcm)
+		actions, cpu = run(audio_format, audio)
+		sent = len([a for a in actions if (a != vad.SILENT)])
+		sids = actions.count(vad.SID)
+		clipped = len([n for n, a in enumerate(actions) if (talk[n] and (a in (vad.SID, vad.SILENT)))])  # talk frames not sent
+		print(f'{audio_format:<6} {len(actions):>7} {sent:>8} {sids:>5} {100 * sent / len(actions):>6.1f}% {clipped:>8} {cpu * 1e3 / seconds:>9.3f} {noise_cpu(audio_format, seconds) * 1e3 / seconds:>8.3f}')
+	print('packets: RTP packets sent (audio and SID), clipped: talk frames taken as silence (quiet syllable ends), vad ms/s: CPU milliseconds of')
+	print('detector per second of call, cn ms/s: of comfort noise synthesis per second of received silence')
@@ -52,21 +52,33 @@ RESPONSE_TIMEOUT = 5  # SIP message response and modem AT command response timeo
 ANSWER_TIMEOUT = 28  # less than 30 sec, before end points timedout
 MAX_SESSION_DURATION = 180	# 3 mins, max session duration (also record duration if RECORDING_ENABLED true
 DIAL_TIMEOUT = 30  # when LINE_CAN_DIAL true or an IP Phone dialed pstnxsip internal number directly
+DIGIT_TIMEOUT = 3  # waits this long for more digits when dialed number matches a dial plan pattern but a longer number may still match (i.e. '_X.')
 ANSWER_AFTER_RINGS = 1  # if pstnxsip is using as a parallel phone and first priority is the hand set, set this parameter accordingly
 
 # IP Phone parameters
 REGISTER_EXPIRES = 60
 
 # PSTN Line parameters
+MM_AUTO = 0  # chipset probed at start (AT+GMI, AT+GMM, AT+FCLASS=?, AT+VSM=?), each modem gets its own profile (line.MODEM_PROFILES)
 MM_CONEXANT = 1
 MM_USR = 2  # USR 5637 MAY NOT BE SUPPORT VOICE MODE AND/OR FULL-DUPLEX VOICE
-MODEM_MFG = MM_CONEXANT
-MODEM_PORT = '/dev/ttyACM0'  # Modem port for 'serial' module (in Line object)
+MODEM_MFG = MM_AUTO  # MM_CONEXANT or MM_USR skips probing, same profile used for all modems
+MODEM_PORTS = ['/dev/ttyACM0']  # Modem ports for 'serial' module, one Line object per modem, i.e. ['/dev/ttyACM0', '/dev/ttyACM1']
 # when pstnxsip running on linux you can find it in /dev folder using command: ls /dev/ttyA*
 # when pstnxsip running on windows you can find it in Device Manager/Com Ports as 'COMX' form
 MODEM_COUNTRY_CODE = 'AE'  # country code: 'B5' for US, 'AE' for TR
-ECHO_CANCEL_DELTA = 0	# use this two parameters for echo cancellation; 0 disables the echo cancellation (can be deleted all unnecessary codes when disabled)
-ECHO_CANCEL_TIME = 0.2  # suppresses audio transmission to IP phone while audio detected from IP Phone
+MODEM_RECEIVE_GAIN = None  # AT+VGR receive (record) gain 0-255, None: modem default (255 Conexant, 128 USR)
+MODEM_TRANSMIT_GAIN = 128  # AT+VGT transmit (playback volume) gain 0-255
+MODEM_RAW_SERIAL = False  # termios serial port (raw_serial.py) instead of pyserial on linux/macOS, fewer system calls and copies per audio block
+MODEM_PASSTHROUGH = False  # G.711 mu-law/A-law voice data (AT+VSM) when probed modem supports it, RTP payloads of same codec pass without transcoding
+MODEM_VOICE_IDLE = False  # keep modem in voice mode (+FCLASS=8) between calls, only off-hook and AT+VTR are sent when a call is bridged (Conexant only)
+MODEM_DTMF_DETECT = False  # software DTMF detector (dtmf.py, Goertzel) on PSTN audio instead of modem <DLE> digit reports, uses NumPy when installed; off until bench/dtmf_bench.py is run on the board (measured on x86 only)
+MODEM_TONE_DETECT = False  # software busy, congestion, reorder and dial tone detector (call_progress.py) on PSTN audio, tones of MODEM_COUNTRY_CODE hang up within about a second
+MODEM_HEALTH_TIME = 30  # seconds between AT probes of an idle modem (watchdog), a missing response or serial I/O error reopens the modem; 0 disables probing
+MODEM_REOPEN_TIME = 2  # seconds between reopen attempts of a failed modem, new calls are rejected (503) until it is ready again
+MODEM_ECHO_CANCEL = 0  # taps of line echo canceller (echo_canceller.py, NLMS), 64/128/256 cover 8/16/32 ms of echo after estimated delay; needs NumPy, 0 disables; off until bench/echo_bench.py is run on the board (measured on x86 only)
+DSP_PSTN_TO_IP = []  # processing stages of PSTN audio sent to IP phone in order (dsp.STAGES), i.e. ['dc_removal', 'high_pass:300', 'agc:-20', 'meter']; applied from next call, needs NumPy
+DSP_IP_TO_PSTN = []  # processing stages of IP audio written to modem, i.e. ['gain:-3', 'meter']
 
 # PSTN_CONNECTOR parameters
 LOCAL_PBX = False
@@ -94,14 +106,29 @@ else:
 	IP_PHONE_CID_IS_NUMBER = False  # If you create entries in your phone book like "05552345678" <sip:IP_PBX_USER@IP_PBX_ADDRESS> code will dial out 05552345678 on PSTN line
 	IP_PHONE_IP = '192.168.1.111'  # IP address or DNS name of the PSTNxSIP IP phone
 	IP_PHONE_PORT = 51611  #  SIP port of the PSTNxSIP IP phone
+IP_PHONE_PORTS = [IP_PHONE_PORT]  # one IP phone (SIP port) per concurrent call, i.e. [5060, 5062]. All register as IP_PBX_USER, IP PBX must accept multiple contacts for the user
 RTP_LOW = 10000
 RTP_HIGH = 20000
 RTP_LEN = 160  # RTP packet length using when read modem receive buffer in voice mode
+RTP_COMFORT_NOISE = False  # offer comfort noise (CN, RFC 3389) in SDP, when IP PBX accepts it PSTN silence is sent as SID packets instead of audio (vad.py) and received SID packets play comfort noise; applied from next call
 RECORDING_ENABLED = False  # if enabled voice records of sessions can be found at the folder where the pstnxsip script running
 
+# Dial plans, Asterisk style extension patterns (see asterisk/extensions.conf): X any digit 0-9, Z 1-9, N 2-9, [*#] or [1-5] one of listed digits,
+# '.' one or more and '!' zero or more of any digit (only at the end), a pattern without '_' is a number itself.
+# Number is dialed on the digit that completes a pattern, and rejected on the digit no allowed number can start with. Deny patterns win over allow patterns.
+IP_DIAL_PLAN = ['_0XXXXXXXXXX', '_*XX', '_[*][*].']  # numbers IP phones can dial on PSTN line, i.e. 05552345678, *11 (internal numbers used in this project)
+IP_DIAL_DENY = ['_00.', '_0900XXXXXXX']  # international and premium rate numbers
+LINE_DIAL_PLAN = ['_1XXX']  # numbers PSTN callers can dial to IP phones (IP PBX extensions) when LINE_CAN_DIAL is True
+LINE_DIAL_DENY = []
+
 # loop timing
 SAMPLE_FREQ = 8000  # PCMU and PCMA codecs sample frequency, 8000 samples (1 byte -8 bit- per sample) per second
 LOOP_TIME = 0.01  # for main loop (10 ms)
 CHUNK_SIZE = int(SAMPLE_FREQ * LOOP_TIME)  # file read chunk length depends on loop time and sample rate (8000)
+ASYNC_MODE = False  # run pstnxsip on asyncio event loop (async_gateway.py), uses uvloop if installed
+SPLIT_MEDIA = False  # run modem and RTP audio in a separate media process (media_process.py) to use a second CPU core
+PROFILE = False  # time loop stages (profiler.py), prints latency histograms at exit. No cost when False
+PROFILE_TRACE_FILE = 'trace.json'  # Chrome trace-event file of the first call when PROFILE is True (open in chrome://tracing or ui.perfetto.dev), '' disables
+CONFIG_FILE = 'pstnxsip.toml'  # optional TOML file overriding settings of this file (same names), reloaded between calls when changed or on SIGHUP, '' disables
 
 DTMF_DIGITS = '0123456789*#ABCD'
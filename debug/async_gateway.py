@@ -0,0 +1,424 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: async_gateway.py
+# Description: asyncio runtime of pstnxsip. SIP/RTP sockets and modem are read by asyncio transports, every call is handled by a coroutine.
+# Author: Aydin Parin
+
+from ip_phone import IPPhone, SS_SERVICE_UNAVAILABLE
+from line import Line
+from call_session import record_file_name
+from typing import Callable
+import common
+import asyncio
+import config
+import dial_plan
+import timers
+import wave
+try:
+	import uvloop  # optional, faster event loop
+except ImportError:
+	uvloop = None
+
+debug = common.debug
+
+FROM_IP = 1
+FROM_PSTN = 2
+
+ip_call_ids = set()  # Call-IDs of IP calls handled by all gateways, same call may be forked to all ip phones
+gateways = []  # all gateways of process
+
+class SIPProtocol(asyncio.DatagramProtocol):
+	def __init__(self, gateway):
+		self.gateway = gateway
+
+	def datagram_received(self, data: bytes, addr: tuple) -> None:
+		msg = self.gateway.ip_phone.parse_sip(data, addr)
+		if (msg != None):
+			self.gateway.ip_phone.message_handler(msg)
+		self.gateway.notify()
+
+class RTPProtocol(asyncio.DatagramProtocol):
+	def __init__(self, gateway):
+		self.gateway = gateway
+
+	def datagram_received(self, data: bytes, addr: tuple) -> None:
+		self.gateway.rtp_received(data)
+
+class ModemProtocol(asyncio.Protocol):
+	def __init__(self, gateway):
+		self.gateway = gateway
+		self.transport: asyncio.ReadTransport = None
+
+	def connection_made(self, transport: asyncio.ReadTransport) -> None:
+		self.transport = transport
+
+	def data_received(self, data: bytes) -> None:
+		self.gateway.modem_received(data)
+
+	def connection_lost(self, exc) -> None:
+		self.gateway.modem_lost(self.transport, exc)
+
+class AsyncGateway:
+	def __init__(self, line: Line, ip_phone: IPPhone):
+		self.line = line
+		self.ip_phone = ip_phone
+		self.loop: asyncio.AbstractEventLoop = None
+		self.waiters = []  # futures of coroutines waiting for a state change
+		self.timer_handle: asyncio.TimerHandle = None
+		self.timer_due = 0
+		self.modem_transport: asyncio.ReadTransport = None
+		self.modem_buffer = bytearray()
+		self.rtp_transport: asyncio.DatagramTransport = None
+		self.call_task: asyncio.Task = None
+		self.prompt_task: asyncio.Task = None
+		self.bridged = False
+		self.rec_file = None
+
+	async def start(self) -> bool:  # starts line and registers ip phone, can be awaited from other asyncio services
+		self.loop = asyncio.get_running_loop()
+		self.line.port_listener = self.modem_listener
+		self.line.start()
+		await self.until(lambda: not self.line.busy())  # modem commands completed by modem_received
+		self.ip_phone.rtp_listener = self.rtp_listener
+		self.ip_phone.start()
+		await self.open_sip()
+		await self.until(lambda: self.ip_phone.state != common.PS_REGISTERING)
+		return (self.ip_phone.state != common.PS_INACTIVE)
+
+	async def stop(self) -> None:
+		debug(':async_gateway.stop: ...')
+		if ((self.call_task != None) and (not self.call_task.done())):
+			self.call_task.cancel()
+			try:
+				await self.call_task
+			except asyncio.CancelledError:
+				pass
+		if (self.ip_phone.state != common.PS_INACTIVE):
+			self.ip_phone.stop()
+			try:
+				await asyncio.wait_for(self.until(lambda: self.ip_phone.state == common.PS_INACTIVE), common.RESPONSE_TIMEOUT)
+			except asyncio.TimeoutError:
+				self.ip_phone.inactivate()
+		if (self.timer_handle != None):
+			self.timer_handle.cancel()
+		self.modem_listener(False)
+		self.line.stop()
+
+	async def run(self) -> None:  # runs gateway until IP PBX deregisters ip phone
+		try:
+			if (await self.start()):
+				await self.until(lambda: self.ip_phone.state == common.PS_INACTIVE)
+			common.error('Error!: IP PBX deregistered ip_phone.')
+		finally:
+			await self.stop()
+
+	def notify(self) -> None:  # wakes up waiting coroutines, called after every handled event
+		waiters = self.waiters
+		self.waiters = []
+		for w in waiters:
+			if (not w.done()):
+				w.set_result(None)
+		self.dispatch()
+		self.schedule_timers()
+
+	async def until(self, predicate: Callable) -> None:  # waits until predicate is true, use asyncio.wait_for for timeouts
+		self.schedule_timers()  # coroutine may have started a timer before waiting
+		while (not predicate()):
+			w = self.loop.create_future()
+			self.waiters.append(w)
+			await w
+
+	def schedule_timers(self) -> None:  # wakes up event loop when the earliest timer of timer wheel is due
+		due = timers.wheel.next_deadline()
+		if (due == self.timer_due):
+			return
+		if (self.timer_handle != None):
+			self.timer_handle.cancel()
+			self.timer_handle = None
+		self.timer_due = due
+		if (due != 0):
+			self.timer_handle = self.loop.call_later(max(due - timers.now(), 0), self.timers_expired)
+
+	def timers_expired(self) -> None:
+		self.timer_handle = None
+		self.timer_due = 0
+		timers.expire()
+		self.notify()
+
+	def idle(self) -> bool:  # no call and no modem command running
+		return (((self.call_task == None) or self.call_task.done()) and (self.line.state == common.PS_IDLE) and (not self.line.busy()) and (self.ip_phone.state == common.PS_IDLE))
+
+	def dispatch(self) -> None:  # starts a call controller coroutine for a new call
+		if ((self.call_task != None) and (not self.call_task.done())):
+			return
+		if (config.requested and all([g.idle() for g in gateways])):  # config reloaded between calls
+			changes = config.reload()
+			for g in gateways:
+				g.ip_phone.reconfigure(changes)
+				g.call_task = self.loop.create_task(g.modem_command(g.line.reconfigure, changes))  # new calls wait for modem commands
+			return
+		if (self.ip_phone.state == common.PS_RINGING):  # ringing started from IP
+			if (self.ip_phone.call_id in ip_call_ids):  # already answered by another gateway
+				self.ip_phone.reject()
+				return
+			if (self.line.recovering()):  # modem reopening, registration kept, caller may retry later
+				self.ip_phone.reject(SS_SERVICE_UNAVAILABLE)
+				return
+			ip_call_ids.add(self.ip_phone.call_id)
+			self.call_task = self.loop.create_task(self.ip_call())
+		elif (self.line.state == common.PS_RINGING):  # ringing started from line
+			self.call_task = self.loop.create_task(self.pstn_call())
+
+	async def modem_command(self, func: Callable, *args) -> None:  # func queues AT commands of line, waits until their responses received
+		func(*args)
+		await self.until(lambda: self.line.current == None)
+		self.notify()
+
+	def modem_received(self, data: bytes) -> None:
+		line = self.line
+		if ((line.current == None) and (line.state == common.PS_CONNECTED)):  # modem in voice mode
+			self.modem_buffer += data
+			if (len(self.modem_buffer) >= common.RTP_LEN):
+				audio = line.decode_audio(self.modem_buffer)
+				self.modem_buffer = bytearray()
+				if (self.bridged and (audio != None)):
+					self.pstn_audio(audio)
+		else:  # command response or data mode, a new call ringing starts caller ID timer of line
+			line.response_received(data)
+		self.notify()
+
+	def pstn_audio(self, audio: bytearray) -> None:  # PSTN -> IP
+		if (self.rec_file != None):
+			self.rec_file.writeframes(self.line.to_linear(audio))
+		self.ip_phone.write_audio(audio)
+		dtmf = self.line.read_dtmf()  # DTMF tone from PSTN, send DTMF code to IP phone
+		if ((dtmf != '') and (dtmf in common.DTMF_DIGITS)):
+			self.ip_phone.send_dtmf(dtmf)
+
+	def rtp_received(self, packet: bytes) -> None:  # IP -> PSTN
+		self.ip_phone.parse_rtp(packet)  # audio is buffered by jitter buffer, bridged line pulls it
+		if (self.bridged):
+			dtmf = self.ip_phone.read_dtmf()  # DTMF tone from IP phone, send DTMF code to PSTN
+			if ((dtmf != '') and (dtmf in common.DTMF_DIGITS)):
+				self.line.send_dtmf(dtmf)
+		self.notify()
+
+	def modem_listener(self, opened: bool) -> None:  # line opened modem port (start, reopen after fault) or failed
+		if (self.modem_transport != None):
+			transport = self.modem_transport
+			self.modem_transport = None  # closed by gateway, not a fault
+			transport.close()
+		self.modem_buffer = bytearray()
+		if (opened):
+			self.loop.create_task(self.open_modem())
+
+	async def open_sip(self) -> None:
+		await self.loop.create_datagram_endpoint(lambda: SIPProtocol(self), sock=self.ip_phone.sip_sckt)
+
+	def modem_ready(self) -> bool:  # modem port open and not failed
+		return (self.line.modem.is_open and (self.line.reopen_timer == None))
+
+	async def open_modem(self) -> None:
+		if (not self.modem_ready()):  # failed again before task started
+			return
+		modem_file = open(self.line.modem.fileno(), 'rb', buffering=0, closefd=False)  # serial port is closed by line
+		transport, _ = await self.loop.connect_read_pipe(lambda: ModemProtocol(self), modem_file)
+		if ((self.modem_transport == None) and self.modem_ready()):
+			self.modem_transport = transport
+		else:  # failed again before transport created
+			transport.close()
+
+	def modem_lost(self, transport: asyncio.ReadTransport, exc: Exception) -> None:  # read error or end of file (device removed)
+		if ((transport == None) or (transport is not self.modem_transport)):
+			return
+		self.modem_transport = None
+		self.line.fault(f'read: {exc}' if (exc != None) else 'device closed')
+		self.notify()
+
+	def rtp_listener(self, active: bool) -> None:
+		if (active):
+			self.loop.create_task(self.open_rtp(self.ip_phone.rtp_sckt))
+		elif (self.rtp_transport != None):
+			self.rtp_transport.close()
+			self.rtp_transport = None
+
+	async def open_rtp(self, sckt) -> None:
+		try:
+			transport, _ = await self.loop.create_datagram_endpoint(lambda: RTPProtocol(self), sock=sckt)
+		except OSError:  # call closed before transport created
+			return
+		if ((self.ip_phone.rtp_active) and (self.ip_phone.rtp_sckt is sckt)):
+			self.rtp_transport = transport
+		else:
+			transport.close()
+
+	def start_prompt(self, file_name: str, write: Callable) -> None:
+		self.stop_prompt()
+		self.prompt_task = self.loop.create_task(self.play_file(file_name, write))
+
+	def stop_prompt(self) -> None:
+		if (self.prompt_task != None):
+			self.prompt_task.cancel()
+			self.prompt_task = None
+
+	async def play_file(self, file_name: str, write: Callable) -> None:  # plays file in CHUNK_SIZE frames at real time pace
+		debug(f':async_gateway.play_file: {file_name} playing')
+		with wave.open(file_name, 'rb') as play_file:
+			due = self.loop.time()
+			frames = play_file.readframes(common.CHUNK_SIZE)
+			while (len(frames) != 0):
+				write(frames)
+				self.schedule_timers()  # line.write_linear may start transmit pacing
+				due += common.LOOP_TIME
+				await asyncio.sleep(max(due - self.loop.time(), 0))
+				frames = play_file.readframes(common.CHUNK_SIZE)
+
+	def start_record(self, call_from: int, line_num: str, ip_num: str) -> None:
+		file_name = record_file_name(call_from, line_num, ip_num, self.line.port)  # same names as call_session, port suffix with several lines
+		self.rec_file = wave.open(file_name, 'wb')
+		self.rec_file.setnchannels(1)
+		self.rec_file.setsampwidth(1)
+		self.rec_file.setframerate(common.SAMPLE_FREQ)
+		debug(f':async_gateway.start_record: {file_name} recording')
+
+	def stop_record(self) -> None:
+		if (self.rec_file != None):
+			self.rec_file.close()
+			self.rec_file = None
+
+	async def bridge(self, call_from: int, line_number: str, ip_number: str) -> None:  # cross connects line and ip phone until one side hangs up
+		self.stop_prompt()
+		if (common.RECORDING_ENABLED):
+			self.start_record(call_from, line_number, ip_number)
+		await self.modem_command(self.line.start_voice_mode)
+		self.modem_buffer = bytearray()  # empty modem receive buffer
+		self.ip_phone.set_audio_format(self.line.voice_format)  # G.711 payloads pass without transcoding when modem uses the codec
+		self.ip_phone.jitter.restart()  # drop IP audio received before bridged
+		self.line.set_tx_source(self.ip_phone.jitter.get)  # line pulls IP audio at playout time
+		self.bridged = True
+		try:
+			await asyncio.wait_for(self.until(lambda: (self.ip_phone.state == common.PS_IDLE) or (self.line.state != common.PS_CONNECTED)), common.MAX_SESSION_DURATION)
+		except asyncio.TimeoutError:
+			debug(':async_gateway.bridge: Warning! Session timeout occured. Call will be disconnected.')
+			pass
+		debug(':async_gateway.bridge: Line or IP phone closed the call.')
+
+	async def stop_call(self) -> None:
+		debug(':async_gateway.stop_call: ...')
+		self.bridged = False
+		self.ip_phone.hangup()
+		self.stop_prompt()
+		self.stop_record()
+		await self.modem_command(self.line.stop_voice_mode)
+
+	async def dialed_number(self, phone: object, plan: dial_plan.DialPlan) -> str:  # digits dialed by IP phone or PSTN phone, None if hanged-up or a wrong number dialed
+		number = ''
+		node = plan.start
+		while (True):
+			try:  # waits DIGIT_TIMEOUT for more digits after an allowed number when a longer one may be dialed
+				await asyncio.wait_for(self.until(lambda: (phone.dtmf != '') or (phone.state != common.PS_CONNECTED)), (common.DIGIT_TIMEOUT if node.matched else None))
+			except asyncio.TimeoutError:
+				return number
+			if (phone.state != common.PS_CONNECTED):
+				return None
+			dtmf = phone.read_dtmf()
+			if ((dtmf == '') or (dtmf not in common.DTMF_DIGITS)):
+				continue
+			number += dtmf
+			node = node.next[dtmf]
+			if (node.result == dial_plan.REJECT):
+				debug(f':async_gateway.dialed_number: Warning! {"IP" if (phone is self.ip_phone) else "PSTN"} phone dialed a wrong number. Call will be disconnected.')
+				return None
+			if (node.result == dial_plan.COMPLETE):
+				return number
+
+	async def ip_call(self) -> None:  # call initiated from IP
+		debug(':async_gateway.ip_call: Answer incoming IP call.')
+		ip_phone = self.ip_phone
+		call_id = ip_phone.call_id
+		try:
+			ip_phone.set_codecs(self.line.rtp_formats())  # PCMA offered and accepted when modem passes A-law through
+			ip_phone.answer()
+			try:
+				await asyncio.wait_for(self.until(lambda: ip_phone.state in (common.PS_CONNECTED, common.PS_IDLE)), common.RESPONSE_TIMEOUT)
+			except asyncio.TimeoutError:
+				debug(f':async_gateway.ip_call: Warning! IP phone connect timeout occured. Call will be disconnected. {ip_phone.call_id}')
+				return
+			if (ip_phone.state != common.PS_CONNECTED):
+				return
+			debug(':async_gateway.ip_call: IP call connected.')
+			self.start_prompt('dial.wav', ip_phone.write_audio)
+			try:
+				line_number = await asyncio.wait_for(self.dialed_number(ip_phone, dial_plan.ip_plan), common.DIAL_TIMEOUT)
+			except asyncio.TimeoutError:
+				debug(':async_gateway.ip_call: Warning! IP phone not dialed a number. Call will be disconnected.')
+				return
+			if (line_number == None):
+				return
+			await self.modem_command(self.line.dial, line_number)
+			await self.bridge(FROM_IP, line_number, '')
+		finally:
+			await self.stop_call()
+			ip_call_ids.discard(call_id)
+
+	async def pstn_call(self) -> None:  # call initiated from PSTN
+		line = self.line
+		ip_phone = self.ip_phone
+		line_number = ''
+		try:
+			if ((common.LOCAL_PBX) and (common.LINE_CAN_DIAL)):  # inbound PSTN calls can dial only when LOCAL_PBX and LINE_CAN_DIAL are True
+				await self.until(lambda: (line.ring_counter >= common.ANSWER_AFTER_RINGS) or (line.state != common.PS_RINGING))
+				if (line.state != common.PS_RINGING):
+					return
+				debug(':async_gateway.pstn_call: Incoming Line call answered.')
+				await self.modem_command(line.start_voice_mode)
+				self.start_prompt('dial.wav', line.write_linear)
+				try:
+					ip_number = await asyncio.wait_for(self.dialed_number(line, dial_plan.line_plan), common.DIAL_TIMEOUT)
+				except asyncio.TimeoutError:
+					debug(':async_gateway.pstn_call: Warning! PSTN phone not dialed a number. Call will be disconnected.')
+					return
+				if (ip_number == None):
+					return
+				ip_number = f'{ip_number}@{common.IP_PBX_DOMAIN}'
+				debug(f':async_gateway.pstn_call: Line dialed IP phone {ip_number}.')
+				self.start_prompt('ringback.wav', line.write_linear)
+			else:
+				debug(f':async_gateway.pstn_call: Incoming Line call forwarding to {common.CALL_FORWARD_TO}.')
+				await self.until(lambda: not line.busy())  # caller ID requested after first ring
+				line_number = line.read_caller_id()
+				ip_number = common.CALL_FORWARD_TO
+			ip_phone.set_codecs(line.rtp_formats())
+			ip_phone.call(line_number, ip_number)
+			try:
+				await asyncio.wait_for(self.until(lambda: (ip_phone.state in (common.PS_CONNECTED, common.PS_IDLE)) or (line.state in (common.PS_IDLE, common.PS_INACTIVE))), common.ANSWER_TIMEOUT)
+			except asyncio.TimeoutError:
+				debug(':async_gateway.pstn_call: Dialed IP phone, answer timeout occured.')
+				return
+			if (ip_phone.state != common.PS_CONNECTED):  # rejected/busy or line gived-up
+				return
+			debug(':async_gateway.pstn_call: IP phone answered, call connected.')
+			await self.bridge(FROM_PSTN, line_number, ip_number)
+		finally:
+			await self.stop_call()
+
+async def run_gateways(gateways: list) -> None:
+	await asyncio.gather(*[gateway.run() for gateway in gateways])
+
+def main() -> None:
+	if (uvloop != None):
+		uvloop.install()
+	for modem_port, phone_port in zip(common.MODEM_PORTS, common.IP_PHONE_PORTS):  # a fixed line and ip phone pair per gateway
+		line = Line(modem_port)
+		ip_phone = IPPhone(common.IP_PBX_USER, common.IP_PBX_DOMAIN, common.IP_PBX_PASS, common.IP_PHONE_IP, phone_port, \
+			common.RTP_LOW, common.RTP_HIGH, common.IP_PBX_PROXY_ADDRESS, common.IP_PBX_PROXY_PORT)
+		gateways.append(AsyncGateway(line, ip_phone))
+	try:
+		asyncio.run(run_gateways(gateways))
+	except KeyboardInterrupt:
+		pass
+	finally:
+		if (common.DEBUGFILE):  # if debug.log file opened, shared by all gateways
+			common.debug_log.close()  # close debug.log file
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,131 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: call_progress.py
+# Description: Call progress tone detector of pstnxsip. Classifies 20 ms frames of PSTN audio with Goertzel filters of the country tones (MODEM_COUNTRY_CODE) and matches on/off cadences of busy, congestion, reorder and dial tones as frames arrive.
+# Author: Aydin Parin
+
+import common
+import dtmf
+import g711
+import math
+
+debug = common.debug
+
+FRAME = 160  # samples per frame (20 ms at 8 kHz)
+FRAME_TIME = FRAME / common.SAMPLE_FREQ
+MIN_AMPLITUDE = 4  # weakest tone accepted, peak in 8-bit sample units (about -30 dB of full scale)
+MIN_POWER = MIN_AMPLITUDE * MIN_AMPLITUDE * FRAME / 2  # tone power of a frame at MIN_AMPLITUDE
+SILENCE_RMS = 3  # frames below this level (8-bit sample units) are tone pauses
+SILENCE_ENERGY = SILENCE_RMS * SILENCE_RMS * FRAME
+TONE_RATIO = 0.6  # tone frequencies carry this part of frame energy at least, one frame at a tone edge may fail (merged into next segment)
+CADENCE_TOLERANCE = 0.2  # on/off durations may differ 20% and one frame from table
+CONTINUOUS_TIME = 2.0  # seconds of a continuous tone (dial tone) before detected, longer than ringback bursts of same frequency (France 1.5 s)
+HISTORY = 8  # completed segments kept for cadence matching
+
+SILENT = 'silent'  # frame labels other than tone frequencies
+OTHER = 'other'  # speech, noise or a tone not in table
+
+class Tone:  # call progress tone of a country
+	def __init__(self, name: str, freqs: tuple, cadence: tuple):
+		self.name = name  # 'dial', 'busy', 'congestion' or 'reorder'
+		self.freqs = freqs  # Hz, single or dual tone
+		self.cadence = cadence  # seconds of one cycle (on, off, on, off...), () continuous
+
+	def __repr__(self) -> str:
+		return f'{self.name} {"+".join([str(f) for f in self.freqs])} Hz {self.cadence}'
+
+US_TONES = (Tone('dial', (350, 440), ()), Tone('busy', (480, 620), (0.5, 0.5)), Tone('reorder', (480, 620), (0.25, 0.25)))
+COUNTRY_TONES = {  # T.35 country code of AT+GCI: tones, first matching tone is reported
+	'B5': US_TONES,  # United States
+	'20': US_TONES,  # Canada
+	'B4': (Tone('dial', (350, 440), ()), Tone('busy', (400,), (0.375, 0.375)), Tone('congestion', (400,), (0.4, 0.35, 0.225, 0.525))),  # United Kingdom, congestion may be reported as busy
+	'04': (Tone('dial', (425,), ()), Tone('busy', (425,), (0.48, 0.48)), Tone('congestion', (425,), (0.24, 0.24))),  # Germany
+	'3D': (Tone('dial', (440,), ()), Tone('busy', (440,), (0.5, 0.5))),  # France
+	'AE': (Tone('dial', (450,), ()), Tone('busy', (450,), (0.5, 0.5)), Tone('congestion', (450,), (0.2, 0.2))),  # Turkey
+}
+DEFAULT_TONES = (Tone('dial', (425,), ()), Tone('busy', (425,), (0.5, 0.5)), Tone('congestion', (425,), (0.25, 0.25)))  # ITU-T E.180 recommended tones
+
+def matches(frames: int, seconds: float, open_segment: bool) -> bool:  # segment length fits cadence time, running segment only needs its lower bound
+	low = seconds * (1 - CADENCE_TOLERANCE) / FRAME_TIME - 1
+	high = seconds * (1 + CADENCE_TOLERANCE) / FRAME_TIME + 1
+	return ((frames >= low) and (open_segment or (frames <= high)))
+
+class Detector:  # feed() PSTN audio of a call, a tone is reported once when its cadence matched
+	def __init__(self, country: str, audio_format: str = g711.LINEAR):
+		self.tones = COUNTRY_TONES.get(country.upper(), DEFAULT_TONES)
+		self.freqs = sorted(set([f for tone in self.tones for f in tone.freqs]))
+		self.coeffs = [2 * math.cos(2 * math.pi * f / common.SAMPLE_FREQ) for f in self.freqs]
+		self.labels = {tone.freqs: [self.freqs.index(f) for f in tone.freqs] for tone in self.tones}  # frequency set: indexes of its powers
+		self.table = dtmf.TABLES[audio_format]
+		self.pending = bytearray()  # voice data of incomplete frame
+		self.segments = []  # [label, first frame, frame count] of completed segments and running one (last)
+		self.frames = 0  # frames classified
+		self.latency = 0.0  # seconds from start of last detected tone to its detection
+
+	def reset(self) -> None:
+		self.pending = bytearray()
+		self.segments = []
+
+	def classify(self, samples: list) -> object:  # frequency set of a tone, SILENT or OTHER
+		energy = sum([x * x for x in samples])
+		if (energy < SILENCE_ENERGY):
+			return SILENT
+		powers = dtmf.goertzel(samples, self.coeffs)
+		label = OTHER
+		best = 0.0
+		for freqs, indexes in self.labels.items():
+			p = [powers[i] for i in indexes]
+			if ((min(p) >= MIN_POWER) and (sum(p) >= TONE_RATIO * energy) and (sum(p) > best)):
+				label = freqs
+				best = sum(p)
+		return label
+
+	def add(self, label: object) -> None:  # appends frame to running segment or starts a new one
+		segments = self.segments
+		if (segments and (segments[-1][0] == label)):
+			segments[-1][2] += 1
+			return
+		if (segments and (segments[-1][0] == OTHER) and (segments[-1][2] == 1)):  # one frame at a tone edge, part of next segment
+			glitch = segments.pop()
+			if (segments and (segments[-1][0] == label)):
+				segments[-1][2] += 2
+			else:
+				segments.append([label, glitch[1], 2])
+			return
+		segments.append([label, self.frames, 1])
+		if (len(segments) > HISTORY):
+			del segments[0]
+
+	def match(self) -> Tone:  # tone whose cadence ends with running segment, None if no match
+		segments = self.segments
+		for tone in self.tones:
+			if (tone.cadence == ()):
+				if ((segments[-1][0] == tone.freqs) and (segments[-1][2] * FRAME_TIME >= CONTINUOUS_TIME)):
+					return tone
+				continue
+			count = len(tone.cadence)
+			if (len(segments) < count):
+				continue
+			tail = segments[-count:]
+			for shift in range(0, count, 2):  # cycle may be matched from any on segment
+				if (all([(s[0] == (tone.freqs if ((n % 2) == 0) else SILENT)) and matches(s[2], tone.cadence[(shift + n) % count], (n == count - 1)) \
+					for n, s in enumerate(tail)])):
+					return tone
+		return None
+
+	def feed(self, data: bytes) -> Tone:  # returns tone detected in data, None if not detected
+		self.pending += data
+		size = len(self.pending) - (len(self.pending) % FRAME)
+		table = self.table
+		detected = None
+		for n in range(0, size, FRAME):
+			self.add(self.classify([table[v] for v in self.pending[n:n + FRAME]]))
+			self.frames += 1
+			tone = self.match()
+			if ((tone != None) and (detected == None)):
+				first = self.segments[-(len(tone.cadence) or 1)][1]
+				self.latency = (self.frames - first) * FRAME_TIME
+				detected = tone
+				self.segments = []  # reported once
+				debug(f':call_progress.feed: {tone} detected after {self.latency:.2f} s.')
+		del self.pending[:size]
+		return detected
@@ -0,0 +1,291 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: call_session.py
+# Description: Call session of pstnxsip. Controls a call between a PSTN line and an IP Phone.
+# Author: Aydin Parin
+
+from ip_phone import IPPhone
+from line import Line
+import common
+import dial_plan
+import os
+import time
+import timers
+import wave
+
+debug = common.debug
+
+FROM_IP = 1
+FROM_PSTN = 2
+
+def record_file_name(call_from: int, line_num: str, ip_num: str, port: str) -> str:  # caller_to_callee wav file of a recorded call, also used by async_gateway
+	line_num = line_num.strip('*#ABCD')
+	if (line_num == ''):
+		line_num = 'X'
+	ip_num = ip_num.strip('*#ABCD')
+	if (ip_num == ''):
+		ip_num = 'X'
+	if (call_from == FROM_PSTN):
+		file_name = time.strftime('%Y%m%d-%H%M%S') + '_' + line_num + '_to_' + ip_num
+	else:
+		file_name = time.strftime('%Y%m%d-%H%M%S') + '_' + ip_num + '_to_' + line_num
+	if (len(common.MODEM_PORTS) > 1):  # calls can start at the same second on different lines
+		file_name += f'_{os.path.basename(port)}'
+	return file_name + '.wav'
+
+class CallSession:  # a call between a line and an ip phone
+	def __init__(self, line: Line, ip_phone: IPPhone, call_from: int):
+		self.line = line
+		self.ip_phone = ip_phone
+		self.call_from = call_from
+		self.cross_connected = False
+		self.dial_timer: timers.Timer = None
+		self.session_timer: timers.Timer = None
+		self.resp_timer: timers.Timer = None
+		self.line_number = ''
+		self.ip_number = ''
+		self.dial_node: dial_plan.DialNode = None  # dial plan trie node of digits dialed so far
+		self.play_started = False
+		self.play_file = None
+		self.total_chunk = 0
+		self.chunk_counter = 0
+		self.play_timer: timers.Timer = None
+		self.rec_started = False
+		self.rec_file = None
+		ip_phone.set_codecs(line.rtp_formats())  # PCMA offered and accepted when modem passes A-law through
+
+	def closed(self) -> bool:
+		return (self.call_from == None)
+
+	def start_cross_conn(self) -> None:
+		debug(':start_cross_conn: ...')
+		if (self.cross_connected):  # if modem already in Voice Mode
+			return
+		self.stop_play_file()
+		if (common.RECORDING_ENABLED):
+			self.start_record_file(self.line_number, self.ip_number)
+		self.line.start_voice_mode()
+		self.ip_phone.set_audio_format(self.line.voice_format)  # G.711 payloads pass without transcoding when modem uses the codec
+		self.ip_phone.jitter.restart()  # drop IP audio received before bridged
+		self.line.set_tx_source(self.ip_phone.jitter.get)  # line pulls IP audio at playout time
+		audio_data = self.line.read_audio()  # empty modem receive buffer
+		self.session_timer = timers.rearm(self.session_timer, common.MAX_SESSION_DURATION, self.session_timeout)
+		self.dial_timer = timers.cancel(self.dial_timer)
+		self.resp_timer = timers.cancel(self.resp_timer)
+		self.cross_connected = True
+
+	def stop_cross_conn(self) -> None:
+		debug(':stop_cross_conn: ...')
+		self.ip_phone.hangup()
+		self.stop_play_file()
+		if (common.RECORDING_ENABLED):
+			self.stop_record_file()
+		self.line.stop_voice_mode()
+		self.line_number = ''
+		self.ip_number = ''
+		self.dial_node = None
+		self.session_timer = timers.cancel(self.session_timer)
+		self.dial_timer = timers.cancel(self.dial_timer)
+		self.resp_timer = timers.cancel(self.resp_timer)
+		self.call_from = None
+		self.cross_connected = False
+
+	def start_play_file(self, file_name: str) -> None:
+		if (not self.play_started):
+			self.play_file = wave.open(file_name,'rb')
+			self.total_chunk = self.play_file.getnframes() / common.CHUNK_SIZE
+			self.chunk_counter = 0
+			self.play_timer = timers.schedule(0, self.play_handler)
+			self.play_started = True
+			debug(f':start_play_file: {file_name} playing')
+
+	def play_handler(self) -> None:  # play timer callback
+		if (self.play_started):
+			self.play_timer = timers.schedule_at(self.play_timer.deadline + common.LOOP_TIME, self.play_handler)  # one chunk per LOOP_TIME
+			if (self.chunk_counter < self.total_chunk):
+				if (self.call_from == FROM_PSTN):
+					self.line.write_linear(self.play_file.readframes(common.CHUNK_SIZE))
+				elif (self.call_from == FROM_IP):
+					self.ip_phone.write_audio(self.play_file.readframes(common.CHUNK_SIZE))
+				self.chunk_counter += 1
+			else:
+				self.stop_play_file()
+
+	def stop_play_file(self) -> None:
+		if (self.play_started):
+			self.play_file.close()
+			self.play_timer = timers.cancel(self.play_timer)
+			self.play_started = False
+			debug(f':stop_play_file: ...')
+
+	def start_record_file(self, line_num: str, ip_num: str) -> None:
+		if (not self.rec_started):
+			file_name = record_file_name(self.call_from, line_num, ip_num, self.line.port)
+			self.rec_file = wave.open(file_name, 'wb')
+			self.rec_file.setnchannels(1)
+			self.rec_file.setsampwidth(1)
+			self.rec_file.setframerate(common.SAMPLE_FREQ)
+			self.rec_started = True
+			debug(f':start_record_file: {file_name} recording')
+
+	def record_handler(self, audio_data: bytes = []) -> None:
+		if (self.rec_started):
+			self.rec_file.writeframes(audio_data)
+
+	def stop_record_file(self) -> None:
+		if (self.rec_started):
+			self.rec_file.close()
+			self.rec_started = False
+			debug(f':stop_record_file: ...')
+
+	def bridge_audio(self) -> None:  # cross connected line and ip phone audio and DTMF
+		line = self.line
+		ip_phone = self.ip_phone
+		line_read = line.read_audio()  # handle modem receive buffer, read modem receive buffer
+		if (line_read != None):
+			if (common.RECORDING_ENABLED):
+				self.record_handler(line.to_linear(line_read))
+			ip_phone.write_audio(line_read)  # send audio to IP phone
+		ip_phone.read_audio()  # handle IP call receive buffer, audio is buffered by jitter buffer and pulled by line
+		dtmf = line.read_dtmf()	# handle DTMF from PSTN, last pressed key
+		if ((dtmf != '') and (dtmf in common.DTMF_DIGITS)):  # DTMF tone from PSTN, send DTMF code to IP phone
+			ip_phone.send_dtmf(dtmf)
+		dtmf = ip_phone.read_dtmf()	# handle DTMF from IP, last pressed key
+		if ((dtmf != '') and (dtmf in common.DTMF_DIGITS)):  # DTMF tone from IP phone, send DTMF code to PSTN
+			line.send_dtmf(dtmf)
+
+	def session_timeout(self) -> None:  # call session timeout (default 3 mins)
+		self.session_timer = None
+		debug(':main_handler: Warning! Session timeout occured. Call will be disconnected.')
+		self.stop_cross_conn()
+
+	def dial_timeout(self) -> None:  # IP or PSTN phone not dialed a number
+		self.dial_timer = None
+		if ((self.dial_node != None) and self.dial_node.matched):  # no more digits after an allowed number
+			if (self.call_from == FROM_IP):
+				self.ip_dialed()
+			elif (self.ip_phone.state == common.PS_IDLE):
+				self.line_dialed()
+			else:  # IP phone still busy (previous call not released), wait for it like a dialed digit does
+				self.dial_timer = timers.rearm(self.dial_timer, common.DIGIT_TIMEOUT, self.dial_timeout)
+			return
+		debug(f':main_handler: Warning! {"IP" if (self.call_from == FROM_IP) else "PSTN"} phone not dialed a number. Call will be disconnected.')
+		self.stop_cross_conn()  # even if not started (initializes all parameters)
+
+	def resp_timeout(self) -> None:
+		self.resp_timer = None
+		if (self.call_from == FROM_IP):  # answered IP call not acknowledged
+			debug(f':main_handler: Warning! IP phone connect timeout occured. Call will be disconnected. {self.ip_phone.call_id}')
+			self.ip_phone.hangup()
+		else:  # Call not answered
+			debug(':main_handler: Dialed IP phone, answer timeout occured.')
+			self.stop_cross_conn()
+
+	def status(self) -> tuple:
+		return (self.call_from, self.cross_connected, self.dial_timer, self.resp_timer)
+
+	def start_from_ip(self) -> None:  # ringing started from IP
+		debug(':main_handler: Answer incoming IP call.')
+		self.resp_timer = timers.rearm(self.resp_timer, common.RESPONSE_TIMEOUT, self.resp_timeout)
+		self.ip_phone.answer()
+
+	def start_from_pstn(self) -> None:  # ringing started from line
+		if ((common.LOCAL_PBX) and (common.LINE_CAN_DIAL)):  # inbound PSTN calls can dial only when LOCAL_PBX and LINE_CAN_DIAL are True
+			debug(':main_handler: Incoming Line call answered.')
+			self.line.start_voice_mode()
+			self.ip_number = ''
+			self.dial_node = dial_plan.line_plan.start
+			self.dial_timer = timers.rearm(self.dial_timer, common.DIAL_TIMEOUT, self.dial_timeout)
+			self.start_play_file('dial.wav')
+		else:
+			debug(f':main_handler: Incoming Line call forwarding to {common.CALL_FORWARD_TO}.')
+			self.line_number = self.line.read_caller_id()  # get caller ID
+			self.resp_timer = timers.rearm(self.resp_timer, common.ANSWER_TIMEOUT, self.resp_timeout)
+			self.ip_number = common.CALL_FORWARD_TO
+			self.ip_phone.call(self.line_number, self.ip_number)  # call IP phone
+
+	def ip_dialed(self) -> None:  # IP phone dialed an allowed number, dial it on line
+		self.dial_node = None
+		self.line.dial(self.line_number)
+		self.start_cross_conn()
+
+	def line_dialed(self) -> None:  # PSTN phone dialed an allowed number, call it from ip phone
+		self.dial_node = None
+		self.ip_number = f'{self.ip_number}@{common.IP_PBX_DOMAIN}'
+		debug(f':main_handler: Line dialed IP phone {self.ip_number}.')
+		self.dial_timer = timers.cancel(self.dial_timer)
+		self.resp_timer = timers.rearm(self.resp_timer, common.ANSWER_TIMEOUT, self.resp_timeout)
+		self.start_play_file('ringback.wav')
+		self.ip_phone.call(self.line_number, self.ip_number)	 # call IP phone
+
+	def handler(self) -> None:
+		line = self.line
+		ip_phone = self.ip_phone
+		if (self.cross_connected):  # if modem in 'Voice Mode'
+			if (ip_phone.state == common.PS_IDLE):
+				debug(':main_handler: IP phone closed the call.-1')
+				self.stop_cross_conn()
+			elif (line.state != common.PS_CONNECTED):
+				debug(':main_handler: Line closed the call.')
+				self.stop_cross_conn()
+			else:
+				self.bridge_audio()
+		elif (self.call_from == FROM_IP):  # handle call initiated from IP
+			if (ip_phone.state == common.PS_IDLE):  # call hanged-up
+				debug(':main_handler: IP phone closed the call.-2')
+				self.stop_cross_conn()
+				return
+			if (ip_phone.state == common.PS_CONNECTED):  #  call connected
+				audio_data = ip_phone.read_audio()  # empty IP phone receive buffer
+				if (self.dial_timer == None):  # IP call connected, will be waiting for IP phone to dial a number
+					debug(':main_handler: IP call connected.')
+					self.resp_timer = timers.cancel(self.resp_timer)
+					self.line_number = ''
+					self.dial_node = dial_plan.ip_plan.start
+					self.dial_timer = timers.rearm(self.dial_timer, common.DIAL_TIMEOUT, self.dial_timeout)
+					self.start_play_file('dial.wav')
+					return
+				dtmf = ip_phone.read_dtmf()	# last pressed key
+				if ((dtmf != '') and (dtmf in common.DTMF_DIGITS)):  # get digits
+					self.line_number += dtmf
+					self.dial_node = self.dial_node.next[dtmf]  # IP_DIAL_PLAN of common.py (for outbound calls)
+					if (self.dial_node.result == dial_plan.REJECT):
+						debug(':main_handler: Warning! IP phone dialed a wrong number. Call will be disconnected.')
+						self.stop_cross_conn()  # even if not started (initializes all parameters)
+						return
+					if (self.dial_node.result == dial_plan.COMPLETE):
+						self.ip_dialed()
+						return
+					if (self.dial_node.matched):  # a longer number may be dialed, dial this one if no more digits
+						self.dial_timer = timers.rearm(self.dial_timer, common.DIGIT_TIMEOUT, self.dial_timeout)
+		elif (self.call_from == FROM_PSTN):  # handle call initiated from PSTN
+			if (line.state == common.PS_CONNECTED):  # if PSTN line in voice mode
+				audio_data = line.read_audio()  # empty line receive buffer
+			if (ip_phone.state == common.PS_CONNECTED):  # Call answered
+				debug(':main_handler: IP phone answered, call connected.')
+				self.start_cross_conn()
+				return
+			if (self.resp_timer != None):
+				if (line.state in (common.PS_IDLE, common.PS_INACTIVE)):  # PSTN line session disconnected (or modem failed)
+					debug(':main_handler: Line gived-up.')
+					self.stop_cross_conn()
+					return
+				elif (ip_phone.state == common.PS_IDLE):  # Call rejected/busy
+					debug(':main_handler: IP phone rejected call/busy.')
+					self.stop_cross_conn()
+					return
+			if (self.dial_timer != None):  # IP call connected, will be waiting for PSTN phone to dial a number (if can dial)
+				if (line.state != common.PS_CONNECTED):  # PSTN line session disconnected
+					debug(':main_handler: Line hanged-up.')
+					self.stop_cross_conn()
+					return
+				dtmf = line.read_dtmf()	# last pressed key
+				if ((dtmf != '') and (dtmf in common.DTMF_DIGITS)):  # get digits
+					self.ip_number += dtmf
+					self.dial_node = self.dial_node.next[dtmf]  # LINE_DIAL_PLAN of common.py (for inbound calls)
+					if (self.dial_node.result == dial_plan.REJECT):
+						debug(':main_handler: Warning! PSTN phone dialed a wrong number. Call will be disconnected.')
+						self.stop_cross_conn()  # even if not started (initializes all parameters)
+					elif ((self.dial_node.result == dial_plan.COMPLETE) and (ip_phone.state == common.PS_IDLE)):
+						self.line_dialed()
+					elif (self.dial_node.matched):  # a longer number may be dialed, dial this one if no more digits
+						self.dial_timer = timers.rearm(self.dial_timer, common.DIGIT_TIMEOUT, self.dial_timeout)
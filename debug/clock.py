@@ -0,0 +1,31 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: clock.py
+# Description: Clock of pstnxsip. Uses system clock, simulation.py replaces it with a virtual clock.
+# Author: Aydin Parin
+
+import time as system_time
+
+class Clock:  # system clock
+	def time(self) -> float:
+		return system_time.time()
+
+	def monotonic(self) -> float:
+		return system_time.monotonic()
+
+	def sleep(self, seconds: float) -> None:
+		system_time.sleep(seconds)
+
+source = Clock()
+
+def set_clock(clock: Clock) -> None:  # timers.reset() must be called after the clock changed
+	global source
+	source = clock
+
+def time() -> float:
+	return source.time()
+
+def monotonic() -> float:
+	return source.monotonic()
+
+def sleep(seconds: float) -> None:
+	source.sleep(seconds)
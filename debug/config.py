@@ -0,0 +1,115 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: config.py
+# Description: Configuration reload of pstnxsip. Values in CONFIG_FILE (TOML) override common.py, file is reloaded when changed or on SIGHUP and applied between calls.
+# Author: Aydin Parin
+
+import common
+import dial_plan
+import line
+import os
+import signal
+import timers
+try:
+	import tomllib  # python 3.11+
+except ImportError:
+	try:
+		import tomli as tomllib  # optional, 'pip install tomli' for older pythons
+	except ImportError:
+		tomllib = None
+
+debug = common.debug
+
+POLL_TIME = 2  # seconds between two config file modification checks
+RESTART_REQUIRED = ('MODEM_PORTS', 'MODEM_MFG', 'LOCAL_PBX', 'IP_PHONE_IP', 'IP_PHONE_PORT', 'IP_PHONE_PORTS', 'RTP_LOW', 'RTP_HIGH', 'RTP_LEN', 'MODEM_VOICE_IDLE', 'MODEM_RAW_SERIAL', 'MODEM_PASSTHROUGH', \
+	'SAMPLE_FREQ', 'LOOP_TIME', 'CHUNK_SIZE', 'ASYNC_MODE', 'SPLIT_MEDIA', 'PROFILE', 'PROFILE_TRACE_FILE', 'DEBUGFILE', 'CONFIG_FILE')  # used when objects created
+DIAL_PLAN_SETTINGS = ('IP_DIAL_PLAN', 'IP_DIAL_DENY', 'LINE_DIAL_PLAN', 'LINE_DIAL_DENY', 'DTMF_DIGITS')
+
+overrides = {}  # all values of config file applied to common (media process applies them too)
+requested = False  # reload requested, applied by event loop between calls
+mtime = None  # modification time of config file when last read
+watch_timer: timers.Timer = None
+
+def read(starting: bool = False) -> dict:  # values of config file different from common, invalid (and restart required when running) values are skipped
+	global mtime
+	try:
+		mtime = os.stat(common.CONFIG_FILE).st_mtime
+		with open(common.CONFIG_FILE, 'rb') as f:
+			data = tomllib.load(f)
+	except FileNotFoundError:
+		mtime = None
+		return {}
+	except (OSError, tomllib.TOMLDecodeError) as e:
+		common.error(f':config.read: Error! {common.CONFIG_FILE} not loaded: {e}')
+		return {}
+	values = {}
+	for key, value in data.items():  # tables only group settings, i.e. [line] MODEM_COUNTRY_CODE = 'B5'
+		if (isinstance(value, dict)):
+			values.update(value)
+		else:
+			values[key] = value
+	changes = {}
+	for name, value in values.items():
+		if (not hasattr(common, name)):
+			common.error(f':config.read: Error! Unknown setting {name} in {common.CONFIG_FILE}.')
+		elif (not valid(getattr(common, name), value)):
+			common.error(f':config.read: Error! Invalid value of {name} in {common.CONFIG_FILE}: {value!r}')
+		elif (getattr(common, name) == value):
+			continue
+		elif ((name in RESTART_REQUIRED) and (not starting)):
+			common.error(f':config.read: Warning! {name} change needs restart.')
+		else:
+			changes[name] = value
+	return changes
+
+def valid(current: object, value: object) -> bool:  # value has the type of common.py setting
+	if (isinstance(current, bool) or isinstance(value, bool)):
+		return (type(current) == type(value))
+	if (current == None):  # optional numbers, i.e. MODEM_RECEIVE_GAIN
+		return isinstance(value, int)
+	if (isinstance(current, float)):
+		return isinstance(value, (int, float))
+	return isinstance(value, type(current))
+
+def update(changes: dict) -> None:  # sets changed values to common and rebuilds values depending on them
+	if (changes == {}):
+		return
+	for name, value in changes.items():
+		setattr(common, name, value)
+	overrides.update(changes)
+	line.configure()
+	if (any([(name in changes) for name in DIAL_PLAN_SETTINGS])):
+		dial_plan.load()
+
+def reload() -> dict:  # reads config file, returns changed values (Line and IPPhone objects reconfigure by them)
+	global requested
+	requested = False
+	changes = read()
+	update(changes)
+	debug(f':config.reload: {common.CONFIG_FILE} changes: {changes}')
+	return changes
+
+def request(*args) -> None:  # SIGHUP handler
+	global requested
+	requested = True
+
+def watch() -> None:  # config file modification check
+	global watch_timer, requested
+	watch_timer = timers.schedule(POLL_TIME, watch)
+	try:
+		modified = os.stat(common.CONFIG_FILE).st_mtime
+	except OSError:
+		modified = None
+	if (modified != mtime):
+		requested = True
+
+def start() -> None:  # loads config file before lines and ip phones created, then watches it
+	global watch_timer
+	if (common.CONFIG_FILE == ''):
+		return
+	if (tomllib == None):
+		common.error(f':config.start: Error! tomllib (python 3.11+) or tomli module needed for {common.CONFIG_FILE}, not loaded.')
+		return
+	update(read(True))
+	if (hasattr(signal, 'SIGHUP')):  # not in windows
+		signal.signal(signal.SIGHUP, request)
+	watch_timer = timers.schedule(POLL_TIME, watch)
@@ -0,0 +1,145 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: dial_plan.py
+# Description: Dial plans of pstnxsip. Compiles Asterisk style extension patterns into a digit trie, each dialed digit is one dictionary lookup.
+# Author: Aydin Parin
+
+import common
+
+debug = common.debug
+
+NEED_MORE = 0  # number is a prefix of an allowed number
+COMPLETE = 1  # number is allowed and no longer number can be allowed, dial it now
+REJECT = 2  # no allowed number starts with these digits (or a deny pattern matched)
+
+ANY = '.'  # pattern tail, one or more of any digit
+STAR = '!'  # pattern tail, zero or more of any digit
+DIGIT_SETS = {'X': '0123456789', 'Z': '123456789', 'N': '23456789'}
+
+class DialNode:  # trie node, digits dialed so far end here
+	__slots__ = ('next', 'result', 'matched')
+
+	def __init__(self):
+		self.next = {}  # dtmf digit: DialNode (all DTMF_DIGITS, rejected digits lead to a REJECT node)
+		self.result = NEED_MORE
+		self.matched = False  # an allowed number ends here, but a longer one may still be dialed (i.e. '_X.' patterns)
+
+def parse(pattern: str) -> list:  # Asterisk pattern to list of digit sets, pattern tail (. or !) at the end as ANY or STAR
+	if (not pattern.startswith('_')):  # not a pattern, number itself
+		return [c for c in pattern]
+	tokens = []
+	chars = pattern[1:]
+	n = 0
+	while (n < len(chars)):
+		c = chars[n].upper()
+		if (c in DIGIT_SETS):
+			tokens.append(DIGIT_SETS[c])
+		elif (c == '['):
+			end = chars.index(']', n)
+			digits = ''
+			body = chars[n + 1:end]
+			i = 0
+			while (i < len(body)):
+				if (((i + 2) < len(body)) and (body[i + 1] == '-')):  # range, i.e. [2-5]
+					digits += ''.join([d for d in common.DTMF_DIGITS if (body[i] <= d <= body[i + 2])])
+					i += 3
+				else:
+					digits += body[i]
+					i += 1
+			tokens.append(digits)
+			n = end
+		elif (c in (ANY, STAR)):
+			if (c == ANY):
+				tokens.append(common.DTMF_DIGITS)
+			tokens.append(STAR)
+			break  # nothing can follow a tail
+		else:
+			tokens.append(c)
+		n += 1
+	return tokens
+
+class DialPlan:  # allow and deny patterns compiled into a trie, deny wins when both match a number
+	def __init__(self, allow: list, deny: list = []):
+		self.patterns = [(parse(p), True) for p in allow] + [(parse(p), False) for p in deny]
+		self.nodes = {}  # set of (pattern index, position): DialNode, one node per set of live pattern positions
+		self.start = self.compile(frozenset([(n, 0) for n in range(len(self.patterns))]))
+		self.resolve()
+		debug(f':dial_plan: {len(allow)} allow, {len(deny)} deny patterns compiled to {len(self.nodes)} nodes.')
+
+	def compile(self, items: frozenset) -> DialNode:  # builds nodes reachable from items (breadth first, pattern tails loop)
+		start = self.node(items)
+		pending = [items]
+		while (pending != []):
+			items = pending.pop()
+			node = self.nodes[items]
+			for digit in common.DTMF_DIGITS:
+				following = []
+				for n, pos in items:
+					tokens = self.patterns[n][0]
+					if (pos == len(tokens)):
+						continue
+					if (tokens[pos] == STAR):
+						following.append((n, pos))  # tail matches any number of digits
+					elif (digit in tokens[pos]):
+						following.append((n, pos + 1))
+				following = frozenset(following)
+				if (following not in self.nodes):
+					pending.append(following)
+				node.next[digit] = self.node(following)
+		return start
+
+	def node(self, items: frozenset) -> DialNode:
+		if (items not in self.nodes):
+			self.nodes[items] = DialNode()
+		return self.nodes[items]
+
+	def ends(self, items: frozenset) -> tuple:  # (allowed, denied) numbers ending at node of items
+		allowed = False
+		denied = False
+		for n, pos in items:
+			tokens, allow = self.patterns[n]
+			if ((pos == len(tokens)) or (tokens[pos] == STAR)):
+				if (allow):
+					allowed = True
+				else:
+					denied = True
+		return allowed, denied
+
+	def resolve(self) -> None:  # sets result of nodes, a node is live if an allowed (not denied) number ends at or after it
+		live = set()
+		for items, node in self.nodes.items():
+			allowed, denied = self.ends(items)
+			node.matched = (allowed and (not denied))
+			if (node.matched):
+				live.add(node)
+		changed = True
+		while (changed):  # walk back from allowed numbers until no new live node
+			changed = False
+			for node in self.nodes.values():
+				if ((node not in live) and any([(n in live) for n in node.next.values()])):
+					live.add(node)
+					changed = True
+		for node in self.nodes.values():
+			if (node not in live):
+				node.result = REJECT
+			elif (node.matched and (not any([(n in live) for n in node.next.values()]))):
+				node.result = COMPLETE
+			else:
+				node.result = NEED_MORE
+
+	def match(self, number: str) -> int:  # result of a whole number
+		node = self.start
+		for digit in number:
+			if (digit not in node.next):
+				return REJECT
+			node = node.next[digit]
+		return node.result
+
+ip_plan: DialPlan = None  # numbers IP phones can dial on PSTN lines (outbound calls)
+line_plan: DialPlan = None  # numbers PSTN callers can dial to IP phones when LINE_CAN_DIAL is True (inbound calls)
+
+def load() -> None:  # compiles dial plans of common.py
+	global ip_plan, line_plan
+	ip_plan = DialPlan(common.IP_DIAL_PLAN, common.IP_DIAL_DENY)
+	line_plan = DialPlan(common.LINE_DIAL_PLAN, common.LINE_DIAL_DENY)
+
+load()
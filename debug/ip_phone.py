@@ -8,12 +8,14 @@ from typing import Any, Callable, Dict, List, Optional, Union, Tuple
 import common
 import hashlib
 import random
-import time
 import uuid
 import socket
-import select
-import audioop
+import g711
 import re
+import timers
+import profiler
+import vad
+from jitter_buffer import JitterBuffer
 
 __all__ = [
 	'SIPMessage',
@@ -30,6 +32,7 @@ SIPCompatibleMethods = ['INVITE', 'ACK', 'BYE', 'CANCEL']
 SIPCompatibleVersions = ['SIP/2.0']
 SIP_REQUEST = 1
 SIP_RESPONSE = 2
+REGISTRATION_SETTINGS = ('IP_PBX_USER', 'IP_PBX_DOMAIN', 'IP_PBX_PASS', 'IP_PBX_PROXY_ADDRESS', 'IP_PBX_PROXY_PORT', 'REGISTER_EXPIRES')  # config reload of these registers again
 
 # RTP parameters
 RTP_PACKET_MAX_SIZE = 1440
@@ -37,10 +40,13 @@ RTP_PACKET_MAX_SIZE = 1440
 # RTP codecs Enum
 PCMU = 0
 PCMA = 8
+CN = 13
 EVENT = 101
 rtp_maps: Dict = {PCMU: ['PCMU', 8000, 1],
 				PCMA: ['PCMA', 8000, 1],
+				CN: ['CN', 8000, 1],
 				EVENT: ['telephone-event', 8000, 1]}
+rtp_formats: Dict = {PCMU: g711.ULAW, PCMA: g711.ALAW}  # voice data format of audio codecs
 
 # SIP Message Enum
 SS_TRYING = 100
@@ -275,6 +281,8 @@ class SIPMessage:
 			self.body[header] = data
 
 class IPPhone:
+	socket_class = socket.socket  # simulation.py uses fake sockets
+
 	def __init__(self, username: str, domain: str, password: str, phone_ip: str, phone_port: int, rtp_port_low: int, rtp_port_high: int, proxy_address: str, proxy_port: int):
 		self.username: str = username
 		self.domain: str = domain
@@ -288,25 +296,32 @@ class IPPhone:
 		self.sip_send_address: str = proxy_address
 		self.sip_send_port: int = proxy_port
 		self.RTPCompatibleVersions = [2]
-		self.rtp_prefered = [PCMU, EVENT]  # prefered codec, set to PCMU.
+		self.rtp_prefered = [PCMU, EVENT]  # offered codecs in order of preference, G.711 ones set by bridged line (set_codecs)
+		self.rtp_codec = PCMU  # audio codec of call, first one of offer answered by other side
 		self.rtp_local_ip: str = self.phone_ip
 		self.rtp_local_port: int = self.rtp_port_low
 		self.dtmf: str = ''
 		self.rtp_active = False
+		self.rtp_listener: Callable = None  # called with True/False when RTP socket opened/closed (asyncio runtime)
+		self.jitter = JitterBuffer()  # received audio, played out by bridged line (Line.set_tx_source)
+		self.rtp_cn = False  # remote accepts comfort noise (CN), silence is not sent (RTP_COMFORT_NOISE)
+		self.vad: vad.Detector = None  # silence of sent audio while RTP is active when rtp_cn
+		self.audio_format = g711.LINEAR  # format of write_audio and jitter buffer audio, bridged line's voice format (G.711 passthrough)
+		self.invite_time = 0.0  # monotonic time of INVITE sent or received, 0 after first audio sent
 		self.active = False
 		self.state = common.PS_INACTIVE
 		self.msg: SIPMessage = None
 		self.register_counter = 0
 		self.register_retry = 0
-		self.register_timer = 0
+		self.register_timer: timers.Timer = None
 		self.register_expires = 0
-		self.reregister_timer = 0
+		self.reregister_timer: timers.Timer = None
 		self.register_call_id = ''
 		self.register_my_tag: str = ''
 		self.register_other_tag: str = ''
 		self.request_counter = 0
-		self.response_timer = 0
-		self.answer_timer = 0
+		self.response_timer: timers.Timer = None
+		self.answer_timer: timers.Timer = None
 		self.retry = 0
 		self.call_id: str = ''
 		self.line_cid: str = ''
@@ -332,7 +347,7 @@ class IPPhone:
 			debug(f':ip_phone.start: Warning! IP Phone already started.')
 			return
 		self.active = True
-		self.sip_sckt = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sip_sckt = self.socket_class(socket.AF_INET, socket.SOCK_DGRAM)
 		self.sip_sckt.bind((self.phone_ip, self.phone_port))
 		self.sip_sckt.setblocking(False)
 		self.state = common.PS_REGISTERING
@@ -350,8 +365,8 @@ class IPPhone:
 	def inactivate(self) -> None:
 		self.state = common.PS_INACTIVE
 		self.register_expires = 0
-		self.register_timer = 0
-		self.reregister_timer = 0
+		self.register_timer = timers.cancel(self.register_timer)
+		self.reregister_timer = timers.cancel(self.reregister_timer)
 		self.register_call_id = ''
 		self.register_my_tag: str = ''
 		self.register_other_tag: str = ''
@@ -366,9 +381,23 @@ class IPPhone:
 			self.register_call_id = self.gen_call_id()
 		self.register_expires = exp
 		self.register_retry = self.register_counter + 2
-		self.register_timer = time.time() + common.RESPONSE_TIMEOUT
+		self.register_timer = timers.rearm(self.register_timer, common.RESPONSE_TIMEOUT, self.register_timeout)
 		self.sip_send(self.build_register_req())
 
+	def reconfigure(self, changes: dict) -> None:  # config reloaded between calls, registers again only if registration settings changed
+		if (not any([(name in changes) for name in REGISTRATION_SETTINGS])):
+			return
+		if ((self.username, self.domain) != (common.IP_PBX_USER, common.IP_PBX_DOMAIN)):  # new address of record, new registration dialog
+			self.register_call_id = ''
+		self.username = common.IP_PBX_USER
+		self.domain = common.IP_PBX_DOMAIN
+		self.password = common.IP_PBX_PASS
+		self.sip_send_address = common.IP_PBX_PROXY_ADDRESS
+		self.sip_send_port = common.IP_PBX_PROXY_PORT
+		if (self.state == common.PS_IDLE):
+			debug(f':ip_phone.reconfigure: Registering again as {self.username}@{self.domain}')
+			self.register(common.REGISTER_EXPIRES)
+
 	def call(self, line_cid: str, other_user: str) -> None:
 		debug(f':ip_phone.call: line_cid: {line_cid:}, number: {other_user}')
 		self.line_cid = line_cid
@@ -377,67 +406,78 @@ class IPPhone:
 		self.my_tag = self.gen_tag()
 		self.state = common.PS_DIALING
 		self.rtp_local_port = self.request_port()
-		self.response_timer = time.time() + common.RESPONSE_TIMEOUT
-		self.answer_timer = time.time() + common.ANSWER_TIMEOUT
+		self.response_timer = timers.rearm(self.response_timer, common.RESPONSE_TIMEOUT, self.response_timeout)
+		self.answer_timer = timers.rearm(self.answer_timer, common.ANSWER_TIMEOUT, self.answer_timeout)
 		self.retry = self.request_counter + 2
+		self.invite_time = timers.now()
 		self.sip_send(self.build_req('INVITE'))
 
 	def answer(self) -> None:
 		debug(':ip_phone.answer: ...')
 		self.create_rtp_clients()
-		self.response_timer = time.time() + common.RESPONSE_TIMEOUT
+		self.response_timer = timers.rearm(self.response_timer, common.RESPONSE_TIMEOUT, self.response_timeout)
 		self.sip_send(self.build_resp(SS_OK))
 
 	def hangup(self) -> None:
 		if (self.state == common.PS_CONNECTED):
 			self.state = common.PS_HANGINGUP
-			self.response_timer = time.time() + common.RESPONSE_TIMEOUT
+			self.response_timer = timers.rearm(self.response_timer, common.RESPONSE_TIMEOUT, self.response_timeout)
 			self.sip_send(self.build_req('BYE'))
+			self.rtp_stop()  # nobody reads RTP after BYE, event loop would spin on the socket until 200 OK
 			debug(':ip_phone.hangup: Call state PS_CONNECTED changed to PS_HANGINGUP, BYE sent.')
 		elif (self.state == common.PS_DIALING):
 			self.state = common.PS_CANCELING
-			self.response_timer = time.time() + common.RESPONSE_TIMEOUT
+			self.response_timer = timers.rearm(self.response_timer, common.RESPONSE_TIMEOUT, self.response_timeout)
 			self.sip_send(self.build_req('CANCEL'))
 			debug(':ip_phone.hangup: Call state PS_DIALING changed to PS_CANCELING, CANCEL sent.')
 		elif (self.state == common.PS_RINGING):
 			self.delete_call()
 			debug(':ip_phone.hangup: Call state PS_RINGING  changed to PS_IDLE, call deleted.')
 
+	def reject(self, status: int = SS_BUSY_HERE) -> None:  # rejects ringing call as busy (i.e. no free line), SS_SERVICE_UNAVAILABLE while modem recovering
+		if (self.state == common.PS_RINGING):
+			self.sip_send(self.build_resp(status))
+			self.delete_call()
+			debug(f':ip_phone.reject: Call state PS_RINGING changed to PS_IDLE, {status} sent.')
+
 	def delete_call(self) -> None:
 		debug(f':ip_phone.delete_call: {self.call_id}')
-		self.response_timer = 0
-		self.answer_timer = 0
+		self.response_timer = timers.cancel(self.response_timer)
+		self.answer_timer = timers.cancel(self.answer_timer)
 		self.retry = 0
 		self.rtp_stop()
 		self.state = common.PS_IDLE
 		self.call_id = ''
 		self.line_cid = ''
 		self.ip_cid = ''
+		self.invite_time = 0.0
 
 	def handler(self) -> None:
 		msg = self.sip_receive()
-		if (msg == None):  # handle timers
-			if (self.register_timer != 0):  # registering
-				if (time.time() > self.register_timer):
-					self.register_timer = 0
-					common.error(':ip_phone.handler: Error! Register timeout occured!')
-					self.inactivate()  # may retry when installed in service mode according to service parameters
-			if (self.response_timer != 0):
-				if (time.time() > self.response_timer):  # not responded request, timed out
-					debug(f':ip_phone.handler: Warning! Response timeout occured. call_id: {self.call_id}, call_state: {self.state}')
-					self.response_timer = 0
-					if (self.call_id != ''):
-						self.hangup()
-			if (self.answer_timer != 0):
-				if (time.time() > self.answer_timer):  # initiated call could not completed, answer timed out
-					debug(f':ip_phone.handler: Warning! Answer timeout occured. call_id: {self.call_id}, call_state: {self.state}')
-					self.answer_timer = 0
-					self.hangup()
-			if (self.reregister_timer != 0):  # reregister
-				if (time.time() > self.reregister_timer):
-					self.reregister_timer = 0
-					self.register(common.REGISTER_EXPIRES)
-			return
+		if (msg != None):
+			self.message_handler(msg)
+
+	def register_timeout(self) -> None:
+		self.register_timer = None
+		common.error(':ip_phone.handler: Error! Register timeout occured!')
+		self.inactivate()  # may retry when installed in service mode according to service parameters
+
+	def response_timeout(self) -> None:  # not responded request, timed out
+		debug(f':ip_phone.handler: Warning! Response timeout occured. call_id: {self.call_id}, call_state: {self.state}')
+		self.response_timer = None
+		if (self.call_id != ''):
+			self.hangup()
+
+	def answer_timeout(self) -> None:  # initiated call could not completed, answer timed out
+		debug(f':ip_phone.handler: Warning! Answer timeout occured. call_id: {self.call_id}, call_state: {self.state}')
+		self.answer_timer = None
+		self.hangup()
+
+	def reregister(self) -> None:
+		self.reregister_timer = None
+		self.register(common.REGISTER_EXPIRES)
+
+	def message_handler(self, msg: SIPMessage) -> None:
 		if (msg.version not in SIPCompatibleVersions):
 			common.error(f':ip_phone.handler: Error! SIP Message Version {msg.version} not compatible:\r\n')
 			return
@@ -447,13 +487,13 @@ class IPPhone:
 				return
 		call_id = msg.headers['Call-ID']
 		if (call_id == self.register_call_id):  # SIP REGISTER handling 
-			self.register_timer = 0
+			self.register_timer = timers.cancel(self.register_timer)
 			self.register_other_tag = msg.headers['To']['tag']
 			if (msg.status == SS_OK):
 				if (self.register_expires != 0):
 					if (self.state == common.PS_REGISTERING):  # only when registering, do not change while reregistering
 						self.state = common.PS_IDLE
-					self.reregister_timer = time.time() + common.REGISTER_EXPIRES - 5
+					self.reregister_timer = timers.rearm(self.reregister_timer, common.REGISTER_EXPIRES - 5, self.reregister)
 					debug(f':ip_phone.handler: IP Phone registered to {self.domain} as {self.username}.')
 				else:
 					debug(':ip_phone.handler: IP phone deregistered.')
@@ -467,7 +507,7 @@ class IPPhone:
 						self.qop = msg.authentication['qop']
 					if ('opaque' in msg.authentication):
 						self.opaque = msg.authentication['opaque']
-					self.register_timer = time.time() + common.RESPONSE_TIMEOUT
+					self.register_timer = timers.rearm(self.register_timer, common.RESPONSE_TIMEOUT, self.register_timeout)
 					self.sip_send(self.build_register_req())
 				else:  # At this point, it's reasonable to assume that this is caused by invalid credentials.
 					common.error(f':ip_phone.handler: Error! Register unauthorized! Invalid credentials for {self.username}@{self.domain}')
@@ -504,6 +544,7 @@ class IPPhone:
 					if (common.IP_PHONE_CID_IS_NUMBER):  # invitee's (this process) caller id is using as dial out number
 						self.ip_cid = msg.headers['To']['cid']  # check invitee's caller ID is a number or not, clear if not
 					self.rtp_local_port = self.request_port()
+					self.invite_time = timers.now()
 					self.state = common.PS_RINGING
 					self.sip_send(self.build_resp(SS_RINGING))
 				else:
@@ -511,7 +552,7 @@ class IPPhone:
 			else:
 				self.unhandled_SIP_message(':ip_phone.handler: SIP_RESPONSE -Unknown call-')
 			return
-		self.response_timer = 0  # got a message
+		self.response_timer = timers.cancel(self.response_timer)  # got a message
 		if ('Contact' in msg.headers):
 			first = msg.headers['Contact'].split('sip:')
 			second = first[1].split('>')
@@ -558,7 +599,7 @@ class IPPhone:
 			if (msg.status == SS_OK):
 				if (self.state == common.PS_DIALING):
 					debug(':ip_phone.handler: Outgoing call established.')
-					self.answer_timer = 0
+					self.answer_timer = timers.cancel(self.answer_timer)
 					self.create_rtp_clients()
 					self.branch = self.gen_branch()
 					self.sip_send(self.build_req('ACK'))
@@ -567,7 +608,7 @@ class IPPhone:
 				elif (self.state == common.PS_HANGINGUP):
 					self.delete_call()
 				elif (self.state == common.PS_CANCELING):
-					self.response_timer = time.time() + common.RESPONSE_TIMEOUT
+					self.response_timer = timers.rearm(self.response_timer, common.RESPONSE_TIMEOUT, self.response_timeout)
 					self.state = common.PS_DELETING
 				elif (self.state == common.PS_DELETING):  # needs to wait got two responses: SS_OK and SS_REQUEST_TERMINATED
 					self.delete_call()
@@ -583,7 +624,7 @@ class IPPhone:
 							self.opaque = msg.authentication['opaque']
 						if (msg.status == SS_PROXY_AUTHENTICATION_REQUIRED):
 							self.sip_send(self.build_req('ACK'))
-						self.response_timer = time.time() + common.RESPONSE_TIMEOUT
+						self.response_timer = timers.rearm(self.response_timer, common.RESPONSE_TIMEOUT, self.response_timeout)
 						self.sip_send(self.build_req('INVITE'))
 					else:
 						common.error(f':ip_phone.handler: Error! Call unauthorized! Invalid credentials for {self.username}@{self.domain}')
@@ -595,7 +636,7 @@ class IPPhone:
 				self.delete_call()
 			elif (msg.status == SS_REQUEST_TERMINATED):
 				if (self.state == common.PS_CANCELING):
-					self.response_timer = time.time() + common.RESPONSE_TIMEOUT
+					self.response_timer = timers.rearm(self.response_timer, common.RESPONSE_TIMEOUT, self.response_timeout)
 					self.state = common.PS_DELETING
 					self.sip_send(self.build_req('ACK'))
 				elif (self.state == common.PS_DELETING):  # needs to wait got two responses: SS_OK and SS_REQUEST_TERMINATED
@@ -615,6 +656,14 @@ class IPPhone:
 			else:
 				self.unhandled_SIP_message(':ip_phone.handler: SIP_RESPONSE')
 
+	def get_readers(self) -> list:  # sockets to be waited by event loop for incoming data
+		readers = []
+		if (self.active):
+			readers.append(self.sip_sckt)
+		if (self.rtp_active):
+			readers.append(self.rtp_sckt)
+		return readers
+
 	def unhandled_SIP_message(self, source: str) -> None:
 		debug(f'Warning! Unhandled SIP Message Received at {source}, Call State: {self.state}\r\n')
 		pass
@@ -706,7 +755,7 @@ class IPPhone:
 	def build_resp(self, resp_code: int) -> str:  # can build response even call_id is different
 		body = ''
 		if ((resp_code == SS_OK) and (self.msg.headers["CSeq"]["method"] == 'INVITE')):
-			body = self.build_sdp_body()
+			body = self.build_sdp_body(answer=True)
 		b = len(body)
 		resp = f'SIP/2.0 {resp_code} {sip_status[resp_code]}\r\n'
 		resp += self.build_response_via_header()
@@ -779,17 +828,21 @@ class IPPhone:
 	f'Contact: <sip:{self.username}@{self.phone_ip};gr=urn:uuid:{self.urn_uuid}>;+sip.instance="<urn:uuid:{self.urn_uuid}>"\r\n'
 	"""
 
-	def build_sdp_body(self) -> str:
+	def set_codecs(self, audio_formats: list) -> None:  # G.711 voice formats bridged line can pass or transcode, first preferred
+		self.rtp_prefered = [pt for audio_format in audio_formats for pt in rtp_formats if (rtp_formats[pt] == audio_format)] + [EVENT]
+
+	def build_sdp_body(self, answer: bool = False) -> str:  # offer lists rtp_prefered, answer only the codec taken from offer of other side
 		body = 'v=0\r\n'
 		body += f'o=SIPxPSTN {str(random.randint(1, 100000))} {str(random.randint(1, 100000))} IN IP4 {self.phone_ip}\r\n'
 		body += f's=SIPxPSTN\r\n'
 		body += f'c=IN IP4 {self.phone_ip}\r\n'
 		body += 't=0 0\r\n'
 		body += f'm=audio {self.rtp_local_port} RTP/AVP'
-		for c in self.rtp_prefered:
+		offer = ([self.rtp_codec, EVENT] if (answer) else self.rtp_prefered) + ([CN] if (common.RTP_COMFORT_NOISE) else [])
+		for c in offer:
 			body += f' {c}'
 		body += '\r\n'
-		for c in self.rtp_prefered:
+		for c in offer:
 			body += f'a=rtpmap:{c} {rtp_maps[c][0]}/{rtp_maps[c][1]}\r\n'
 			if (c == EVENT):
 				body += f'a=fmtp:{c} 0-15\r\n'
@@ -839,16 +892,20 @@ class IPPhone:
 		raw = None
 		if (not self.active):
 			return None
-		ready, _, _ = select.select([self.sip_sckt], [], [], 0)
-		if (ready == []):
+		try:
+			raw, sender = self.sip_sckt.recvfrom(SIP_BUF_SIZE)  # non-blocking socket, event loop waits for data
+		except (BlockingIOError, InterruptedError):
 			return None
-		raw, sender = self.sip_sckt.recvfrom(SIP_BUF_SIZE)
 		if (raw != None):
-			debug(f'\r\n:ip_phone.sip_recive: {sender[0]}:{sender[1]}\r\n{str(raw, "utf8")}')
-			msg = SIPMessage(raw)
-			if (msg.msg_type == None):
-				common.error(f'\r\n:ip_phone.sip_recive: Error! Unable to decipher SIP request:\r\n')
-				return None
+			msg = self.parse_sip(raw, sender)
+		return msg
+
+	def parse_sip(self, raw: bytes, sender: tuple) -> SIPMessage:
+		debug(f'\r\n:ip_phone.sip_recive: {sender[0]}:{sender[1]}\r\n{str(raw, "utf8")}')
+		msg = SIPMessage(raw)
+		if (msg.msg_type == None):
+			common.error(f'\r\n:ip_phone.sip_recive: Error! Unable to decipher SIP request:\r\n')
+			return None
 		return msg
 
 	def sip_send(self, msg: bytes) -> None:
@@ -864,8 +921,9 @@ class IPPhone:
 	def create_rtp_clients(self) -> None:
 		codecs = {}
 		for x in self.msg.body['m']['methods']:
-			if (int(x) in self.rtp_prefered):
+			if ((int(x) in self.rtp_prefered) and (int(x) in rtp_formats)):  # first audio codec of other side's list
 				codecs[x] = rtp_maps[int(x)]
+				self.rtp_codec = int(x)
 				debug(f':ip_phone.create_rtp_clients: "{codecs[x]}" is compatible for RTP session.')
 				break
 		if (codecs == {}):
@@ -876,6 +934,7 @@ class IPPhone:
 		self.rtp_outSequence = random.randint(1, 100)
 		self.rtp_outTimestamp = random.randint(1, 10000)
 		self.rtp_outSSRC = random.randint(1000, 65530)
+		self.rtp_cn = (common.RTP_COMFORT_NOISE and (str(CN) in self.msg.body['m']['methods']))
 
 	def byte_to_bits(self, byte: bytes) -> str:
 		nbyte = bin(ord(byte)).lstrip('-0b')
@@ -893,27 +952,48 @@ class IPPhone:
 	def rtp_start(self) -> None:
 		if (self.rtp_active):
 			self.rtp_stop()
-		self.rtp_sckt = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.rtp_sckt = self.socket_class(socket.AF_INET, socket.SOCK_DGRAM)
 		self.rtp_sckt.bind((self.rtp_local_ip, self.rtp_local_port))
 		self.rtp_sckt.setblocking(False)
+		self.jitter.reset()
+		self.vad = (vad.Detector() if (self.rtp_cn) else None)
 		self.rtp_active = True
+		if (self.rtp_listener != None):
+			self.rtp_listener(True)
 
 	def rtp_stop(self) -> None:
 		if (self.rtp_active):
 			self.dtmf = ''
 			self.rtp_active = False
+			debug(f':ip_phone.rtp_stop: jitter buffer {self.jitter.stats()}')
+			if (self.vad != None):
+				debug(f':ip_phone.rtp_stop: vad {self.vad.stats()}')
+				self.vad = None
+			self.set_audio_format(g711.LINEAR)
+			if (self.rtp_listener != None):
+				self.rtp_listener(False)
 			if (hasattr(self, 'rtp_sckt')):
 				if (self.rtp_sckt):
 					self.rtp_sckt.close()
 
+	def set_audio_format(self, audio_format: str) -> None:  # bridged line's voice format, payloads of same codec are not transcoded
+		if (audio_format != self.audio_format):
+			self.audio_format = audio_format
+			self.jitter.set_format(audio_format)
+			debug(f':ip_phone.set_audio_format: {audio_format}')
+
 	def read_audio(self, length: int = RTP_PACKET_MAX_SIZE) -> bytes:  # RTP Receive
 		data = None
 		if (not self.rtp_active):  # if RTP is not active
 			return data
-		ready, _, _ = select.select([self.rtp_sckt], [], [], 0)
-		if (ready == []):
+		try:
+			packet = self.rtp_sckt.recv(length)  # non-blocking socket, event loop waits for data
+		except (BlockingIOError, InterruptedError):
 			return data
-		packet = self.rtp_sckt.recv(length)
+		return self.parse_rtp(packet)
+
+	def parse_rtp(self, packet: bytes) -> bytes:  # returns audio payload (in audio_format) also put to jitter buffer, None for events and invalid packets
+		data = None
 		if (len(packet) != 0):  # parse RTP packet
 			f_byte = self.byte_to_bits(packet[0:1])
 			version = int(f_byte[0:2], 2)
@@ -938,14 +1018,12 @@ class IPPhone:
 				CSRC.append(packet[i : i + 4])
 				i += 4
 			payload = packet[i:]
-			if (pt == PCMU):
-				data = audioop.ulaw2lin(payload, 1)
-				data = audioop.bias(data, 1, 128)
-				return data
-			elif (pt == PCMA):
-				data = audioop.alaw2lin(payload, 1)
-				data = audioop.bias(data, 1, 128)
+			if (pt in rtp_formats):
+				data = g711.transcode(rtp_formats[pt], self.audio_format, payload)  # no conversion when bridged modem uses the codec
+				self.jitter.put(sequence, timestamp, data)
 				return data
+			elif (pt == CN):  # remote is silent, plays comfort noise until next audio
+				self.jitter.put_sid(sequence, timestamp, payload)
 			else:
 				if (marker):
 					key = common.DTMF_DIGITS
@@ -959,17 +1037,29 @@ class IPPhone:
 		pl = len(payload)
 		if (pl > RTP_PACKET_MAX_SIZE):
 			return
-		if (self.rtp_prefered[0] == PCMU):
-			payload = audioop.bias(payload, 1, -128)
-			payload = audioop.lin2ulaw(payload, 1)
-		elif (self.rtp_prefered[0] == PCMA):
-			payload = audioop.bias(payload, 1, -128)
-			payload = audioop.lin2alaw(payload, 1)
-		else:
-			debug(f':ip_phone.write_audio: Warning! Unsupported codec (encode): {self.rtp_prefered[0]}')
+		if (self.rtp_codec not in rtp_formats):
+			debug(f':ip_phone.write_audio: Warning! Unsupported codec (encode): {self.rtp_codec}')
 			return
+		marker = 0
+		if (self.vad != None):  # silence is not sent, a SID packet tells its noise level (RFC 3389)
+			action = self.vad.feed(self.audio_format, payload)
+			if (action == vad.SID):
+				self.send_rtp(CN, self.vad.sid())
+			if (action in (vad.SID, vad.SILENT)):
+				self.advance_timestamp(pl)
+				return
+			if (action == vad.TALKSPURT):
+				marker = 0x80
+		payload = g711.transcode(self.audio_format, rtp_formats[self.rtp_codec], payload)  # no conversion when bridged modem uses the codec
+		self.send_rtp(marker | self.rtp_codec, payload)
+		self.advance_timestamp(pl)
+		if (self.invite_time != 0):  # first audio of call
+			profiler.record('invite_to_audio', timers.now() - self.invite_time)
+			self.invite_time = 0.0
+
+	def send_rtp(self, second_byte: int, payload: bytes) -> None:  # marker bit and payload type
 		packet = b'\x80'
-		packet += chr(self.rtp_prefered[0]).encode('ascii')
+		packet += bytes([second_byte])
 		packet += self.rtp_outSequence.to_bytes(2, byteorder='big')
 		packet += self.rtp_outTimestamp.to_bytes(4, byteorder='big')
 		packet += self.rtp_outSSRC.to_bytes(4, byteorder='big')
@@ -978,11 +1068,13 @@ class IPPhone:
 			self.rtp_outSequence = 0
 		else:
 			self.rtp_outSequence += 1
-		if (self.rtp_outTimestamp > (0xFFFFFFFF - pl)):
+		self.rtp_sckt.sendto(packet, (self.rtp_remote_ip, self.rtp_remote_port))
+
+	def advance_timestamp(self, samples: int) -> None:  # audio sent or suppressed as silence
+		if (self.rtp_outTimestamp > (0xFFFFFFFF - samples)):
 			self.rtp_outTimestamp = 0
 		else:
-			self.rtp_outTimestamp += pl
-		self.rtp_sckt.sendto(packet, (self.rtp_remote_ip, self.rtp_remote_port))
+			self.rtp_outTimestamp += samples
 
 	def read_dtmf(self) -> str:
 		if (self.rtp_active):
@@ -0,0 +1,241 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: jitter_buffer.py
+# Description: RTP receive jitter buffer of pstnxsip. Orders packets by sequence, sizes playout delay from interarrival jitter, conceals lost packets (G.711 Appendix I style) and plays comfort noise of SID packets (RFC 3389) in silence.
+# Author: Aydin Parin
+
+import common
+import clock
+import g711
+import vad
+
+debug = common.debug
+
+MIN_DELAY = 0.02  # playout delay limits (seconds), target delay is JITTER_FACTOR * measured jitter between them
+MAX_DELAY = 0.2
+JITTER_FACTOR = 4
+MAX_MISORDER = 100  # sequence jumps more than this (forward or back) restart the buffer, new stream or SSRC
+MAX_PACKETS = 50  # packets kept when nothing plays out (1 s of 20 ms packets), oldest dropped
+
+# Packet loss concealment (ITU-T G.711 Appendix I), 8000 Hz samples
+PITCH_MIN = 40  # 200 Hz
+PITCH_MAX = 120  # 66 Hz
+CORRELATION_LEN = 160  # 20 ms window matched against pitch period candidates
+HISTORY_LEN = PITCH_MAX * 3 + CORRELATION_LEN // 4  # 390 samples (48.75 ms)
+ATTENUATION_START = 80  # concealment is attenuated after 10 ms
+ATTENUATION_STEP = 0.2 / 80  # 20% per 10 ms, silent after 60 ms
+CONCEAL_MAX = 480  # concealed samples without a received packet (60 ms), then buffer restarts
+
+def seq_diff(a: int, b: int) -> int:  # a - b of 16 bit RTP sequence numbers
+	return ((a - b + 32768) & 0xFFFF) - 32768
+
+class Concealment:  # replaces lost audio with repeated pitch periods of last received audio, fades out and overlap-adds next audio
+	def __init__(self):
+		self.audio_format = g711.LINEAR  # format of received and concealed audio, pitch is searched in linear samples
+		self.tail = b''  # last received audio (HISTORY_LEN bytes), converted to history when a loss starts
+		self.history = [0] * HISTORY_LEN  # last received samples before loss, signed
+		self.pitch = 0  # pitch period of current loss, 0 when no loss
+		self.pitch_buffer: list = []  # last 1..3 pitch periods repeated during loss
+		self.position = 0  # next sample of pitch buffer
+		self.erased = 0  # samples concealed in current loss
+
+	def find_pitch(self) -> int:  # period of highest normalized correlation, coarse 2:1 search then refined
+		h = self.history
+		end = len(h)
+		start = end - CORRELATION_LEN
+
+		def score(lag: int, step: int) -> float:
+			energy = 1
+			corr = 0
+			for n in range(start, end, step):
+				x = h[n - lag]
+				corr += h[n] * x
+				energy += x * x
+			return corr / (energy ** 0.5)
+
+		best = max(range(PITCH_MIN, PITCH_MAX + 1, 2), key=lambda lag: score(lag, 2))
+		return max(range(max(best - 1, PITCH_MIN), min(best + 1, PITCH_MAX) + 1), key=lambda lag: score(lag, 1))
+
+	def conceal(self, length: int) -> bytes:  # length samples of synthesized audio (in audio_format)
+		return g711.encode(self.audio_format, self.synthesize(length))
+
+	def synthesize(self, length: int) -> bytes:  # length samples of concealment (8 bit unsigned)
+		if (self.pitch == 0):  # loss starts
+			linear = g711.decode(self.audio_format, self.tail)
+			self.history = [0] * (HISTORY_LEN - len(linear)) + [v - 128 for v in linear]
+			self.pitch = self.find_pitch()
+			self.pitch_buffer = self.history[-self.pitch:]
+			self.position = 0
+			self.erased = 0
+		out = bytearray(length)
+		for n in range(length):
+			periods = 1 + min(self.erased // 80, 2)  # 1, 2 then 3 pitch periods after 10 and 20 ms, less buzzy
+			if (periods * self.pitch > len(self.pitch_buffer)):
+				self.pitch_buffer = self.history[-periods * self.pitch:]
+			gain = 1.0 - max(self.erased - ATTENUATION_START, 0) * ATTENUATION_STEP
+			v = self.pitch_buffer[self.position % len(self.pitch_buffer)]
+			self.position += 1
+			self.erased += 1
+			out[n] = 128 + int(v * max(gain, 0.0))
+		return bytes(out)
+
+	def received(self, audio: bytes) -> bytes:  # audio of a received packet, first samples overlap-added with concealment after a loss
+		if (self.pitch != 0):
+			ola = min(32 + (self.erased // 80) * 8, 80, len(audio))  # 4 ms, +1 ms per 10 ms of loss
+			tail = self.synthesize(ola)
+			head = bytearray(g711.decode(self.audio_format, audio[:ola]))
+			for n in range(ola):
+				w = (n + 1) / (ola + 1)
+				head[n] = int(round(tail[n] * (1 - w) + head[n] * w))
+			audio = g711.encode(self.audio_format, bytes(head)) + audio[ola:]
+			self.pitch = 0
+		self.tail = (self.tail + audio)[-HISTORY_LEN:]  # samples are converted only when a loss starts
+		return audio
+
+	def reset(self) -> None:
+		self.tail = b''
+		self.pitch = 0
+
+class JitterBuffer:  # put() RTP audio as received, get() plays it out at sample rate (Line pulls it)
+	def __init__(self):
+		self.concealment = Concealment()
+		self.noise = vad.ComfortNoise()
+		self.reset()
+
+	def reset(self) -> None:
+		self.packets = {}  # sequence: audio (8 bit unsigned linear or G.711, concealment.audio_format), SID payload level (int) of comfort noise packets
+		self.buffered = 0  # samples in packets
+		self.sid_packets = 0  # SID packets in packets
+		self.out = bytearray()  # audio of played packets not yet taken by get
+		self.next_seq: int = None  # sequence of next packet to play, None until playout starts
+		self.last_seq: int = None  # highest sequence received
+		self.last_len = common.RTP_LEN  # audio length of last packet (lost packets are concealed with it)
+		self.transit: float = None  # arrival time - timestamp of last packet (seconds)
+		self.jitter = 0.0  # RFC 3550 interarrival jitter (seconds)
+		self.delay = MIN_DELAY  # target playout delay (seconds)
+		self.concealed = 0  # samples concealed since last received packet
+		self.silence = False  # comfort noise plays, remote stopped sending audio after a SID packet
+		self.concealment.reset()
+		self.received = 0  # counters
+		self.duplicates = 0
+		self.late = 0  # arrived after its playout time (or after played)
+		self.lost = 0  # never arrived, concealed
+		self.underruns = 0  # buffer empty at playout time, concealed or restarted
+		self.dropped = 0  # skipped while buffer was over target delay, reduces delay
+		self.sids = 0  # comfort noise packets received
+
+	def put(self, sequence: int, timestamp: int, audio: bytes) -> None:
+		if (not self.arrived(sequence, timestamp)):
+			return
+		self.packets[sequence] = audio
+		self.buffered += len(audio)
+		self.last_len = len(audio)
+		if (len(self.packets) > MAX_PACKETS):  # not played out (call not bridged yet)
+			self.skip()
+
+	def put_sid(self, sequence: int, timestamp: int, payload: bytes) -> None:  # comfort noise packet, takes its place in sequence so no loss is concealed for it
+		self.sids += 1
+		if (not self.arrived(sequence, timestamp)):
+			return
+		self.packets[sequence] = vad.sid_level(payload)
+		self.sid_packets += 1
+
+	def arrived(self, sequence: int, timestamp: int) -> bool:  # updates jitter and sequence of a packet, False when duplicate or late
+		now = clock.monotonic()
+		transit = now - timestamp / common.SAMPLE_FREQ
+		if ((self.last_seq != None) and (abs(seq_diff(sequence, self.last_seq)) > MAX_MISORDER)):  # new stream
+			debug(f':jitter_buffer.put: Warning! Sequence jump {self.last_seq} -> {sequence}, restarted.')
+			self.restart()
+			self.transit = None
+		if (self.transit != None):
+			self.jitter += (abs(transit - self.transit) - self.jitter) / 16
+			self.delay = min(max(JITTER_FACTOR * self.jitter, MIN_DELAY), MAX_DELAY)
+		self.transit = transit
+		if ((self.last_seq == None) or (seq_diff(sequence, self.last_seq) > 0)):
+			self.last_seq = sequence
+		self.received += 1
+		if (sequence in self.packets):
+			self.duplicates += 1
+			return False
+		if ((self.next_seq != None) and (seq_diff(sequence, self.next_seq) < 0)):
+			self.late += 1
+			return False
+		return True
+
+	def get(self, length: int) -> bytes:  # length samples of audio, None while buffering (before playout or after a long gap)
+		if (self.next_seq == None):  # playout starts when target delay is buffered
+			if ((self.buffered == 0) or ((self.buffered + len(self.out)) < (self.delay * common.SAMPLE_FREQ))):
+				return None
+			self.next_seq = self.first()
+		while (len(self.out) < length):
+			audio = self.packets.get(self.next_seq)
+			if (isinstance(audio, int)):  # SID, silence starts or its noise level changes
+				del self.packets[self.next_seq]
+				self.sid_packets -= 1
+				self.next_seq = (self.next_seq + 1) & 0xFFFF
+				self.noise.level = audio
+				self.silence = True
+				self.concealed = 0
+				self.concealment.reset()
+			elif ((audio != None) and not (self.silence and (self.buffered < self.delay * common.SAMPLE_FREQ) and (self.sid_packets == 0))):  # talkspurt after silence waits for target delay (or its end)
+				del self.packets[self.next_seq]
+				self.buffered -= len(audio)
+				self.next_seq = (self.next_seq + 1) & 0xFFFF
+				self.concealed = 0
+				self.silence = False
+				self.out += self.concealment.received(audio)
+			elif (self.silence):  # no packets expected until talkspurt, a missing one was a lost SID or talkspurt start
+				if ((audio == None) and (self.packets != {})):
+					self.lost += 1
+					self.next_seq = (self.next_seq + 1) & 0xFFFF
+				else:
+					self.out += self.noise.generate(length - len(self.out), self.concealment.audio_format)
+			elif (self.packets != {}):  # packet lost, later packets arrived
+				self.lost += 1
+				self.next_seq = (self.next_seq + 1) & 0xFFFF
+				self.out += self.concealment.conceal(self.last_len)
+				self.concealed += self.last_len
+			elif (self.concealed < CONCEAL_MAX):  # nothing received yet, conceal and wait for it (playout delay grows)
+				self.underruns += 1
+				self.concealed += length - len(self.out)
+				self.out += self.concealment.conceal(length - len(self.out))
+			else:  # long gap, rebuffer
+				self.restart()
+				return None
+		if (self.buffered > (self.delay * common.SAMPLE_FREQ + 2 * self.last_len)):  # two packets over target delay buffered, skip one
+			self.dropped += 1
+			self.skip()
+		audio = bytes(self.out[:length])
+		del self.out[:length]
+		return audio
+
+	def first(self) -> int:  # lowest buffered sequence
+		return min(self.packets, key=lambda s: seq_diff(s, self.last_seq))
+
+	def skip(self) -> None:  # drops oldest buffered packet (after buffered audio played, no concealment needed)
+		sequence = self.first()
+		audio = self.packets.pop(sequence)
+		if (isinstance(audio, int)):
+			self.sid_packets -= 1
+		else:
+			self.buffered -= len(audio)
+		if (self.next_seq != None):
+			self.next_seq = (sequence + 1) & 0xFFFF
+
+	def set_format(self, audio_format: str) -> None:  # format of put audio (G.711 passthrough), buffered audio dropped
+		self.concealment.audio_format = audio_format
+		self.restart()
+
+	def restart(self) -> None:  # buffering starts again, next get waits for target delay
+		self.packets = {}
+		self.buffered = 0
+		self.sid_packets = 0
+		self.out = bytearray()
+		self.next_seq = None
+		self.last_seq = None
+		self.concealed = 0
+		self.silence = False
+		self.concealment.reset()
+
+	def stats(self) -> dict:
+		return {'received': self.received, 'duplicates': self.duplicates, 'late': self.late, 'lost': self.lost, 'underruns': self.underruns, \
+			'dropped': self.dropped, 'sid': self.sids, 'jitter_ms': round(self.jitter * 1000, 1), 'delay_ms': round(self.delay * 1000, 1)}
@@ -3,33 +3,70 @@
 # Description: PSTN Line handler of pstnxsip. Controls USB modem connected to PSTN line.
 # Author: Aydin Parin (Code inspired/altered from https://github.com/pradeesi/ play_audio_over_phone_line, record_audio_from_phone_line)
 
+from typing import Callable
+from collections import deque
 from ip_phone import IPPhone
 import common
+import clock
+import dsp
+import dtmf
+import echo_canceller
+import g711
 import serial
-import time
+import raw_serial
+import timers
+import profiler
 import atexit
+import call_progress
+import copy
+import os
 
 debug = common.debug
 
 # Modem / Phone line handler parameters
 RING_TIMEOUT = 7  # timeout beetween two rings, if caller give up/cancel call
 MODEM_BAUD = 115200
+CALLER_ID_DELAY = 0.5  # caller ID requested this long after first ring
+DTMF_ECHO_TIME = 0.5  # digits detected this long after AT+VTS are echo of sent tone (AT+VTD=30, 300 ms)
+PROMPT_ECHO_TIME = 0.5  # call progress tones detected this long after a prompt written to line are echo of prompt (dial.wav)
+PORT_ERRORS = (OSError, serial.SerialException)  # serial port I/O errors (device unplugged), modem is reopened by watchdog
+TX_BLOCK_TIME = 0.02  # modem transmit pacing interval, one block written per interval
+TX_BLOCK = int(common.SAMPLE_FREQ * TX_BLOCK_TIME)  # fixed modem write size (160 bytes)
+TX_FIFO_LEVEL = 3 * TX_BLOCK  # estimated modem transmit FIFO level kept by pacing (60 ms, covers event loop delays)
+TX_QUEUE_MAX = 10 * TX_BLOCK  # transmit queue limit (200 ms), oldest audio dropped above it
 
 # Modem reply strings
 CRLF_STR = '\r\n'.encode('ascii')
 OK_STR = 'OK\r\n'.encode('ascii')
-ERROR_STR = 'ERROR\r\n'.encode('ascii')
-CONNECT_STR = 'CONNECT\r\n'.encode('ascii')
-RING_STR = 'RING\r\n'.encode('ascii')
-NMBR_STR = 'NMBR'.encode('ascii')
+MAX_RESULT_LEN = 128  # longest result line kept by ResultParser, longer data without CRLF is dropped
+
+# Modem result codes, events of ResultParser (code, value)
+RC_OK = 'OK'
+RC_CONNECT = 'CONNECT'
+RC_RING = 'RING'
+RC_NO_CARRIER = 'NO CARRIER'
+RC_ERROR = 'ERROR'
+RC_BUSY = 'BUSY'
+RC_DATE = 'DATE'  # formatted caller ID fields (AT+VCID=1), value is the text after '='
+RC_TIME = 'TIME'
+RC_NMBR = 'NMBR'
+RC_NAME = 'NAME'
+RC_END_VOICE = '<DLE><ETX>'  # end of voice data, not CRLF framed
+RC_INFO = 'INFO'  # information text of a command (i.e. AT+GMI), value is the line
+RESULT_CODES = {code.encode('ascii'): code for code in (RC_OK, RC_CONNECT, RC_RING, RC_NO_CARRIER, RC_ERROR, RC_BUSY)}
+CID_FIELDS = {code.encode('ascii'): code for code in (RC_DATE, RC_TIME, RC_NMBR, RC_NAME)}
+FAILURE_CODES = (RC_ERROR, RC_NO_CARRIER, RC_BUSY)  # complete running command as failed
 # MFI_CONEXANT = 'CONEXANT'.encode('ascii')
 # MFI_USR = 'U.S. Robotics'.encode('ascii')
 
 # Modem AT Command Set
 # FACTORY_RESET = 'ATZ\r\n'.encode('ascii')
 FACTORY_RESET = 'AT&F0\r\n'.encode('ascii')
-# REPORT_MFI = 'AT+GMI\r\n'.encode('ascii')  # Manufacturer Identification
-SET_COUNTRY = ('AT+GCI=' + common.MODEM_COUNTRY_CODE + '\r\n').encode('ascii')  # set country to TR
+HEALTH_CHECK = 'AT\r\n'.encode('ascii')  # watchdog probe of idle modem
+REPORT_MANUFACTURER = 'AT+GMI\r\n'.encode('ascii')  # Manufacturer Identification
+REPORT_MODEL = 'AT+GMM\r\n'.encode('ascii')  # Model Identification
+REPORT_CLASSES = 'AT+FCLASS=?\r\n'.encode('ascii')  # supported modes (0 data, 1 fax, 8 voice)
+REPORT_COMPRESSIONS = 'AT+VSM=?\r\n'.encode('ascii')  # supported voice compression methods (voice mode only)
 ECHO_OFF = 'ATE0\r\n'.encode('ascii')
 ENABLE_FORMATTED_CID = 'AT+VCID=1\r\n'.encode('ascii')
 REPORT_CID = 'AT+VRID=0\r\n'.encode('ascii')
@@ -42,38 +79,217 @@ LINE_ON_HOOK = 'AT+VLS=0\r\n'.encode('ascii')   # DCE on-hook
 LINE_OFF_HOOK = 'AT+VLS=1\r\n'.encode('ascii')  # DCE off-hook, connected to telco
 DTMF_DURATION = 'AT+VTD=30\r\n'.encode('ascii')  # DTMF duration set to 300 ms
 TERMINATE_CALL = 'ATH\r\n'.encode('ascii')
-TRANSMIT_GAIN = 'AT+VGT=128\r\n'.encode('ascii') # Gain Transmit (Playback Volume)
 ENTER_VOICE_TRANSMIT_RECIEVE_STATE = 'AT+VTR\r\n'.encode('ascii')	# Start Voice Transmission and Reception (Voice Duplex)
-if (common.MODEM_MFG == common.MM_CONEXANT):
-	SET_VOICE_COMPRESSION = 'AT+VSM=1,8000,0,0\r\n'.encode('ascii')  # 1 = 8-bit unsigned pcm, 8.0 kHz
-	RECEIVE_GAIN = 'AT+VGR=255\r\n'.encode('ascii') # Gain Receive (Record Gain)
-elif (common.MODEM_MFG == common.MM_USR):
-	SET_VOICE_COMPRESSION = 'AT+VSM=128,8000\r\n'.encode('ascii')  # 1 = 8-bit unsigned pcm, 8.0 kHz
-	RECEIVE_GAIN = 'AT+VGR=128\r\n'.encode('ascii') # Gain Receive (Record Gain)
+PROBE_COMMANDS = (REPORT_MANUFACTURER, REPORT_MODEL, REPORT_CLASSES, ENTER_VOICE_MODE, REPORT_COMPRESSIONS)  # chipset probe at start (MM_AUTO)
+RECONFIGURE_COMMANDS = ('MODEM_COUNTRY_CODE',)  # settings sent to modem in data mode, other modem settings are sent when voice mode started
+VOICE_IDLE_COMMANDS = ('MODEM_RECEIVE_GAIN', 'MODEM_TRANSMIT_GAIN')  # voice settings sent again between calls when MODEM_VOICE_IDLE
+
+def configure() -> None:  # commands depending on reloadable settings of common.py (config.py calls after reload)
+	global SET_COUNTRY, TRANSMIT_GAIN
+	SET_COUNTRY = ('AT+GCI=' + common.MODEM_COUNTRY_CODE + '\r\n').encode('ascii')  # set country
+	TRANSMIT_GAIN = f'AT+VGT={common.MODEM_TRANSMIT_GAIN}\r\n'.encode('ascii') # Gain Transmit (Playback Volume)
+
+configure()
 
 # Modem DLE shielded codes - DCE to DTE modem data
 DLE_CHAR = 16					# <DLE>
 DLE_ERASER = 17					# to erase <DLE> from buffer
+DLE_BYTE = bytes([DLE_CHAR])
+DLE_DLE_BYTES = bytes([DLE_CHAR, DLE_CHAR])  # <DLE> sample in voice data sent to modem
 DCE_BUSY_TONE = 98				# <DLE>-b
 DCE_DIAL_TONE = 100				# <DLE>-d
 DCE_SILENCE_DETECTED = 115		# <DLE>-s
 DCE_TX_BUFFER_UNDERRUN = 117	# <DLE>-u
 DCE_RX_BUFFER_OVERRUN = 111		# <DLE>-o
 DCE_END_VOICE_DATA_TX = 3		# <DLE><ETX>
+END_VOICE_STR = bytes([DLE_CHAR, DCE_END_VOICE_DATA_TX])
+
+# Voice formats (+VSM compression methods, 8 bits per sample, 8.0 kHz)
+VF_PCM = g711.LINEAR  # 8-bit unsigned pcm, 0x80 biased
+VF_ULAW = g711.ULAW  # G.711 mu-law, RTP PCMU payload
+VF_ALAW = g711.ALAW  # G.711 A-law, RTP PCMA payload
+VSM_NAMES = {'UNSIGNEDPCM': VF_PCM, '8BITLINEAR': VF_PCM, 'G711U': VF_ULAW, 'ULAW': VF_ULAW, 'MULAW': VF_ULAW, 'G711A': VF_ALAW, 'ALAW': VF_ALAW}  # AT+VSM=? method names (letters and digits only) of formats
+PASSTHROUGH_FORMATS = (VF_ULAW, VF_ALAW)  # MODEM_PASSTHROUGH formats in order of preference (IP phones prefer PCMU)
+
+class ModemProfile:  # chipset differences, each Line keeps its own copy updated by probing
+	def __init__(self, mfg: int, name: str, ids: tuple, voice_formats: dict, vsm_params: str, receive_gain: int, end_voice_tx_rx: bytes, \
+		end_voice_resp: bytes, end_voice_result: str, voice_idle: bool, tx_fifo_level: int):
+		self.mfg = mfg  # common.MM_CONEXANT, common.MM_USR...
+		self.name = name
+		self.ids = ids  # upper case texts matched in AT+GMI and AT+GMM information
+		self.manufacturer = ''  # probed AT+GMI and AT+GMM information
+		self.model = ''
+		self.classes = ('0', '8')  # AT+FCLASS=? modes
+		self.voice_formats = voice_formats  # format: +VSM compression method
+		self.vsm_params = vsm_params  # +VSM parameters after compression method (sample rate...)
+		self.receive_gain = receive_gain  # AT+VGR default when MODEM_RECEIVE_GAIN is None
+		self.end_voice_tx_rx = end_voice_tx_rx  # <DLE> shielded code sent to end voice transmit receive
+		self.end_voice_resp = end_voice_resp  # modem response to it
+		self.end_voice_result = end_voice_result  # result code event of the response
+		self.voice_idle = voice_idle  # RING and caller ID reported in voice mode (MODEM_VOICE_IDLE)
+		self.tx_fifo_level = tx_fifo_level  # estimated transmit FIFO bytes kept by tx_pace (out_waiting is not reliable)
+
+	def matches(self, manufacturer: str, model: str) -> bool:
+		info = (manufacturer + ' ' + model).upper()
+		return any([(text in info) for text in self.ids])
+
+	def probed(self, manufacturer: str, model: str, classes: list, compressions: list) -> 'ModemProfile':  # copy updated with probe information
+		profile = copy.copy(self)
+		profile.manufacturer = manufacturer
+		profile.model = model
+		if (len(classes) != 0):
+			profile.classes = tuple([c.strip() for c in ','.join(classes).split(',')])
+		formats = {}
+		for method in compressions:  # 1,"UNSIGNED PCM",8,0,(8000),(0),(0)
+			fields = method.split(',')
+			name = ''.join([c for c in fields[1].upper() if c.isalnum()]) if (len(fields) > 1) else ''
+			if (fields[0].strip().isdigit() and (name in VSM_NAMES)):
+				formats.setdefault(VSM_NAMES[name], int(fields[0]))
+		if (VF_PCM in formats):
+			profile.voice_formats = formats
+		return profile
+
+	def voice_compression(self, voice_format: str = VF_PCM) -> bytes:  # AT+VSM command of a voice format
+		return f'AT+VSM={self.voice_formats[voice_format]},{self.vsm_params}\r\n'.encode('ascii')
+
+	def receive_gain_command(self) -> bytes:  # Gain Receive (Record Gain)
+		receive_gain = (common.MODEM_RECEIVE_GAIN if (common.MODEM_RECEIVE_GAIN != None) else self.receive_gain)
+		return f'AT+VGR={receive_gain}\r\n'.encode('ascii')
 
 # Supported <DLE> Shielded Codes Sent to the Modem (DCE) (not in the table, from pdf)
-if (common.MODEM_MFG == common.MM_CONEXANT):
-	DTE_END_VOICE_DATA_TX_RX = (chr(16) + chr(94)).encode('ascii')	# <DLE>^
-	DCE_END_VOICE_DATA_TX_RESP = (chr(16) + chr(3)).encode('ascii')
-elif (common.MODEM_MFG == common.MM_USR):
-	DTE_END_VOICE_DATA_TX_RX = (chr(16) + chr(3)).encode('ascii')  # <DLE><ETX>
-	DCE_END_VOICE_DATA_TX_RESP = OK_STR
+MODEM_PROFILES = {  # chipset profiles by MODEM_MFG, first one is used when probed modem not matched
+	common.MM_CONEXANT: ModemProfile(common.MM_CONEXANT, 'Conexant', ('CONEXANT', 'CX93'), {VF_PCM: 1}, '8000,0,0', 255, \
+		bytes([DLE_CHAR, ord('^')]), END_VOICE_STR, RC_END_VOICE, True, TX_FIFO_LEVEL),  # <DLE>^ answered with <DLE><ETX>
+	common.MM_USR: ModemProfile(common.MM_USR, 'USR', ('ROBOTICS', 'USR'), {VF_PCM: 128}, '8000', 128, \
+		END_VOICE_STR, OK_STR, RC_OK, False, TX_FIFO_LEVEL),  # <DLE><ETX> answered with OK
+}
+
+def modem_profile(mfg: int) -> ModemProfile:  # copy of a registered profile, common.MM_AUTO: first one until probed
+	if (mfg not in MODEM_PROFILES):
+		mfg = list(MODEM_PROFILES)[0]
+	return copy.copy(MODEM_PROFILES[mfg])
+
+def probe_profile(manufacturer: str, model: str, classes: list, compressions: list) -> ModemProfile:  # registered profile matching probed chipset
+	matched = [profile for profile in MODEM_PROFILES.values() if profile.matches(manufacturer, model)]
+	profile = (matched[0] if (len(matched) != 0) else list(MODEM_PROFILES.values())[0])
+	return profile.probed(manufacturer, model, classes, compressions)
+
+class DLEDecoder:  # streaming decoder of modem voice data, removes <DLE> shielded codes and calls their handlers
+	def __init__(self, handlers: list):
+		self.handlers = handlers  # 256 entries, handler(code) of <DLE><code> (code byte as index)
+		self.pending = False  # last data ended with <DLE>, its code is the first byte of next data
+
+	def reset(self) -> None:
+		self.pending = False
+
+	def decode(self, data: bytes) -> bytes:  # returns audio of data, same object when no <DLE> in data
+		audio = None
+		start = 0
+		if (self.pending):  # code of <DLE> at the end of previous data
+			if (len(data) == 0):
+				return data
+			self.pending = False
+			start = 1
+			if (data[0] == DLE_CHAR):  # <DLE><DLE> is a 0x10 sample
+				audio = bytearray(data[:1])
+			else:
+				self.handlers[data[0]](data[0])
+		dle = data.find(DLE_CHAR, start)
+		if (dle < 0):  # no <DLE>, nothing to copy
+			if (audio == None):
+				return data[start:] if (start != 0) else data
+			audio += data[start:]
+			return audio
+		if (audio == None):
+			audio = bytearray()
+		end = len(data)
+		while (dle >= 0):
+			audio += data[start:dle]
+			if ((dle + 1) == end):  # code byte not received yet
+				self.pending = True
+				return audio
+			code = data[dle + 1]
+			if (code == DLE_CHAR):
+				audio.append(DLE_CHAR)
+			else:
+				self.handlers[code](code)
+			start = dle + 2
+			dle = data.find(DLE_CHAR, start)
+		audio += data[start:]
+		return audio
+
+class ResultParser:  # incremental tokenizer of CRLF framed modem result codes, memory bounded by MAX_RESULT_LEN
+	def __init__(self):
+		self.buffer = bytearray()  # last line, CRLF not received yet
+		self.info = 0  # lines not a result code or caller ID field, information text of commands
+		self.overflows = 0  # data longer than MAX_RESULT_LEN without CRLF, dropped
+
+	def reset(self) -> None:
+		self.buffer.clear()
+
+	def feed(self, data: bytes) -> list:  # returns (code, value) events of complete lines in data
+		events = []
+		buffer = self.buffer
+		buffer += data
+		start = 0
+		while (True):
+			end = buffer.find(CRLF_STR, start)
+			etx = buffer.find(END_VOICE_STR, start, (end if (end >= 0) else len(buffer)))
+			if (etx >= 0):  # <DLE><ETX> ends voice data, audio before it is dropped
+				events.append((RC_END_VOICE, ''))
+				start = etx + len(END_VOICE_STR)
+				continue
+			if (end < 0):
+				break
+			line = bytes(buffer[start:end]).strip()
+			start = end + len(CRLF_STR)
+			if (len(line) == 0):  # result codes are framed with <CR><LF> on both sides
+				continue
+			code = RESULT_CODES.get(line)
+			if (code != None):
+				events.append((code, ''))
+			elif (line.startswith(b'CONNECT')):  # CONNECT <rate>
+				events.append((RC_CONNECT, line[7:].strip().decode('ascii', 'replace')))
+			else:
+				name, equal, value = line.partition(b'=')
+				code = CID_FIELDS.get(name.strip())
+				if ((code != None) and (equal != b'')):
+					events.append((code, value.strip().decode('ascii', 'replace')))
+				else:
+					self.info += 1
+					events.append((RC_INFO, line.decode('ascii', 'replace')))
+		del buffer[:start]
+		if (len(buffer) > MAX_RESULT_LEN):
+			self.overflows += 1
+			buffer.clear()
+		return events
+
+	def stats(self) -> dict:
+		return {'info': self.info, 'overflows': self.overflows}
+
+class ATCommand:  # queued modem command, completed by its expected response, ERROR or timeout
+	__slots__ = ('cmd', 'resp', 'callback', 'timeout', 'required', 'info', 'sent')
+
+	def __init__(self, cmd: bytes, resp: str, callback: Callable, timeout: float, required: bool = True):
+		self.cmd = cmd
+		self.resp = resp  # expected result code (RC_OK, RC_CONNECT...), None completes when written
+		self.callback = callback  # callback(command, result) when completed, None if not needed
+		self.timeout = timeout
+		self.required = required  # failure is an error (probe commands may not be supported)
+		self.info = []  # information text lines received before result code
+		self.sent = 0.0  # monotonic time written to modem
 
 class Line:
+	serial_class = None  # simulation.py uses a fake modem, None: pyserial or raw_serial (MODEM_RAW_SERIAL)
+
 	def __init__(self, usb_port: str):
 		# Modem / serial port itial values
-		self.modem = serial.Serial()
+		serial_class = self.serial_class
+		if (serial_class == None):
+			serial_class = (raw_serial.RawSerial if (common.MODEM_RAW_SERIAL and raw_serial.available) else serial.Serial)
+		self.modem = serial_class()
 		self.modem.port = usb_port
+		self.port = usb_port
 		self.modem.baudrate = MODEM_BAUD
 		self.modem.bytesize = serial.EIGHTBITS	#number of bits per bytes
 		self.modem.parity = serial.PARITY_NONE	#set parity check: no parity
@@ -84,212 +300,565 @@ class Line:
 		self.modem.dsrdtr = False					#disable hardware (DSR/DTR) flow control
 		self.modem.writeTimeout = 0				#timeout for write
 		self.state = common.PS_INACTIVE
-		# self.mfi = common.MM_CONEXANT  # not used
-		self.modem_response = bytes('', 'ascii')
+		self.profile = modem_profile(common.MODEM_MFG)  # chipset profile, replaced by probed one at start (MM_AUTO)
+		self.probe_info = {}  # probe command: information lines
+		self.health_timer: timers.Timer = None  # watchdog, AT probe of idle modem every MODEM_HEALTH_TIME
+		self.reopen_timer: timers.Timer = None  # running after a fault until port reopened
+		self.fault_time = 0.0  # monotonic time of modem fault, 0 when modem ready
+		self.faults = 0  # modem faults recovered by reopening port
+		self.port_listener: Callable = None  # called with True/False when modem port opened/closed (asyncio runtime)
+		self.results = ResultParser()  # modem result codes in command and data mode
 		self.caller_id = ''
 		self.dtmf = ''
-		self.m_val = 128
-		self.echo_cancel = 0
+		self.dtmf_detector: dtmf.Detector = None  # software DTMF detection of call (MODEM_DTMF_DETECT)
+		self.dtmf_mute = 0.0  # monotonic time until detected digits are ignored (echo of sent digits)
+		self.tone_detector: call_progress.Detector = None  # busy, congestion, reorder and dial tone detection of call (MODEM_TONE_DETECT)
+		self.tone_mute = 0.0  # monotonic time until detected tones are ignored (echo of prompts)
+		self.echo_canceller: echo_canceller.EchoCanceller = None  # removes echo of written audio from read audio of call (MODEM_ECHO_CANCEL)
+		self.rx_pipeline: dsp.Pipeline = None  # processing stages of read audio (DSP_PSTN_TO_IP), None passes audio untouched
+		self.tx_pipeline: dsp.Pipeline = None  # processing stages of bridged IP audio (DSP_IP_TO_PSTN)
 		self.ring_counter = 0
-		self.ring_timer = 0
+		self.ring_timer: timers.Timer = None
+		self.audio_timer: timers.Timer = None  # expected time of a full RTP_LEN packet in modem receive buffer (voice mode)
+		self.selectable = hasattr(self.modem, 'fileno')  # posix serial ports can be waited by event loop (not windows COM ports)
 		self.status = None
+		self.commands = deque()  # ATCommand queue, first one is written to modem when current completes
+		self.current: ATCommand = None  # command waiting for its response, modem data is routed to it
+		self.command_timer: timers.Timer = None  # response timeout of current command
+		self.command_times = {}  # command: [count, total, max] response times (seconds)
+		self.cid_timer: timers.Timer = None  # running after first ring until caller ID requested
+		self.voice_idle = False  # modem kept in voice mode between calls (MODEM_VOICE_IDLE)
+		self.voice_class = False  # voice mode settings sent (+FCLASS=8), only off-hook and AT+VTR needed to connect
+		self.off_hook = False  # voice dialed (ATD in voice mode takes line off-hook)
+		self.ring_time = 0.0  # monotonic time of first ring of incoming call, 0 when not ringing
+		self.voice_time = 0.0  # monotonic time of start_voice_mode
+		self.voice_format = VF_PCM  # format of voice data read and written (AT+VSM), G.711 when MODEM_PASSTHROUGH
+		self.tx_silence = g711.silence(VF_PCM, TX_BLOCK)  # silence block in voice format
+		self.tx_queue = bytearray()  # IP audio waiting to be written to modem
+		self.tx_fifo = 0.0  # estimated bytes in modem transmit FIFO (out_waiting is not reliable)
+		self.tx_time = 0.0  # monotonic time of tx_fifo estimate
+		self.tx_block = bytearray(TX_BLOCK)  # block written to modem, reused (no allocation per block)
+		self.tx_view = memoryview(self.tx_block)
+		self.tx_last = False  # tx_block is last audio block written, faded on underrun
+		self.tx_timer: timers.Timer = None  # running in voice mode while audio transmitted
+		self.tx_source: Callable = None  # bridged IP phone jitter buffer, tx_source(length) returns audio or None
+		self.tx_underruns = 0  # transmit queue empty, faded block or silence written
+		self.tx_modem_underruns = 0  # <DLE>u received, modem FIFO was empty
+		self.tx_overruns = 0  # audio dropped when transmit queue full
+		self.dle_handlers = [self.dle_unhandled] * 256  # <DLE><code> handlers, indexed by code
+		for code in (DCE_BUSY_TONE, DCE_DIAL_TONE, DCE_SILENCE_DETECTED, DCE_END_VOICE_DATA_TX):
+			self.dle_handlers[code] = self.dle_hangup
+		self.dle_handlers[DCE_TX_BUFFER_UNDERRUN] = self.dle_underrun
+		self.dle_handlers[DCE_RX_BUFFER_OVERRUN] = self.dle_overrun
+		for digit in common.DTMF_DIGITS:
+			self.dle_handlers[ord(digit)] = self.dle_dtmf
+		self.decoder = DLEDecoder(self.dle_handlers)
+		self.check_echo_cancel()
 		debug(':line.init: Modem initialized.')
 
+	def check_echo_cancel(self) -> None:  # logged once when line created or MODEM_ECHO_CANCEL reloaded, not on every call
+		if (common.MODEM_ECHO_CANCEL and (echo_canceller.numpy == None)):
+			common.error(f':line.check_echo_cancel: Error! MODEM_ECHO_CANCEL needs NumPy, calls of {self.port} are not echo cancelled.')
+
 	def start(self) -> None:
 		if (self.modem.is_open):
 			self.modem.close()
-			time.sleep(1)
-		self.modem.open()  # Open Serial Port
-		self.modem.reset_input_buffer()
-		self.modem.reset_output_buffer()
-		self.command(TERMINATE_CALL, OK_STR)  # hang-up if opened
-		self.command(FACTORY_RESET, OK_STR)  # reset to factory default
-		self.command(ECHO_OFF, OK_STR)  # Disable Command Echo Mode
-		# self.command(REPORT_MFI, OK_STR)  # Request Manufacturer Identification
-		# if (MFI_CONEXANT in self.modem_response):
-		# 	self.mfi = common.MM_CONEXANT
-		# elif (MFI_USR in self.modem_response):
-		# 	self.mfi = common.MM_USR
-		self.command(SET_COUNTRY, OK_STR)  # set country.
-		self.command(ENABLE_VERBOSE_CODES, OK_STR)  # Display result codes in verbose form 	
-		self.command(ENTER_DATA_MODE, OK_STR)  # Enter Data Mode
-		self.command(ENABLE_FORMATTED_CID, OK_STR)  # Enable formatted caller report
-		self.state = common.PS_IDLE
+			clock.sleep(1)
+		try:
+			self.modem.open()  # Open Serial Port
+			self.modem.reset_input_buffer()
+			self.modem.reset_output_buffer()
+		except PORT_ERRORS as e:  # not plugged yet, watchdog retries
+			self.fault(f'open: {e}')
+			return
+		if (self.port_listener != None):
+			self.port_listener(True)
+		self.results.reset()
+		self.reset_commands()
+		self.command(TERMINATE_CALL, RC_OK)  # hang-up if opened
+		self.command(FACTORY_RESET, RC_OK)  # reset to factory default
+		self.command(ECHO_OFF, RC_OK)  # Disable Command Echo Mode
+		self.command(SET_COUNTRY, RC_OK)  # set country.
+		self.command(ENABLE_VERBOSE_CODES, RC_OK)  # Display result codes in verbose form 	
+		self.voice_class = False
+		self.off_hook = False
+		if (common.MODEM_MFG in MODEM_PROFILES):  # chipset set in common.py
+			self.profile = modem_profile(common.MODEM_MFG)
+			self.modem_setup()
+		else:  # setup queued when probe commands completed
+			self.probe_info = {}
+			for cmd in PROBE_COMMANDS:
+				self.command(cmd, RC_OK, self.probe_result, required=False)
+		if (common.MODEM_HEALTH_TIME != 0):
+			self.health_timer = timers.rearm(self.health_timer, common.MODEM_HEALTH_TIME, self.health_check)
+		self.state = common.PS_IDLE  # commands are queued, calls wait for them (busy)
 		debug(':line.start: line.state: PS_IDLE')
 
+	def probe_result(self, command: ATCommand, result: bool) -> None:  # probe command completed, profile selected after last one
+		self.probe_info[command.cmd] = (command.info if result else [])
+		if (len(self.probe_info) < len(PROBE_COMMANDS)):
+			return
+		manufacturer = ' '.join(self.probe_info[REPORT_MANUFACTURER])
+		model = ' '.join(self.probe_info[REPORT_MODEL])
+		self.profile = probe_profile(manufacturer, model, self.probe_info[REPORT_CLASSES], self.probe_info[REPORT_COMPRESSIONS])
+		debug(f':line.probe_result: {self.port} {manufacturer} {model} profile: {self.profile.name} classes: {self.profile.classes} formats: {self.profile.voice_formats}')
+		if ('8' not in self.profile.classes):
+			common.error(f':line.probe_result: Error! Modem has no voice mode (+FCLASS=8). {self.port} {manufacturer} {model}')
+		self.modem_setup()
+
+	def modem_setup(self) -> None:  # commands depending on chipset profile
+		self.voice_idle = (common.MODEM_VOICE_IDLE and self.profile.voice_idle)  # modem reports RING and caller ID in voice mode
+		if (self.voice_idle):
+			self.voice_setup()  # voice mode pre-armed for next call
+		else:
+			self.command(ENTER_DATA_MODE, RC_OK)  # Enter Data Mode
+		self.command(ENABLE_FORMATTED_CID, RC_OK, self.modem_ready)  # Enable formatted caller report
+
+	def modem_ready(self, command: ATCommand, result: bool) -> None:  # last setup command completed
+		if (result and (self.fault_time != 0)):  # recovered from a fault
+			recovery = clock.monotonic() - self.fault_time
+			self.fault_time = 0.0
+			profiler.record('modem_recovery', recovery)
+			common.error(f':line.modem_ready: Modem {self.port} ready again after {recovery:.1f} s (faults: {self.faults}).')
+
+	def recovering(self) -> bool:  # modem failed and not ready yet, new calls are rejected (503)
+		return (self.fault_time != 0)
+
+	def device_present(self) -> bool:  # device node exists (USB modem plugged), ports without a path (COM1) are not checked
+		return ((not os.path.isabs(self.port)) or os.path.exists(self.port))
+
+	def health_check(self) -> None:  # health timer callback, device node checked and idle modem probed with AT
+		self.health_timer = timers.schedule(common.MODEM_HEALTH_TIME, self.health_check)
+		if (not self.device_present()):
+			self.fault('device removed')
+		elif ((self.state == common.PS_IDLE) and (not self.busy())):  # response timeout is a fault
+			self.command(HEALTH_CHECK, RC_OK)
+
+	def fault(self, reason: str) -> None:  # modem not responding, I/O error or device removed, port reopened in background
+		if (self.fault_time == 0):  # recovery time measured from first fault until modem ready
+			self.fault_time = clock.monotonic()
+			self.faults += 1
+			common.error(f':line.fault: Error! Modem {self.port} failed ({reason}), reopening.')
+		else:
+			debug(f':line.fault: {self.port} still failing ({reason}).')
+			pass
+		self.reset_commands()
+		self.health_timer = timers.cancel(self.health_timer)
+		self.cid_timer = timers.cancel(self.cid_timer)
+		self.ring_timer = timers.cancel(self.ring_timer)
+		self.audio_timer = timers.cancel(self.audio_timer)
+		self.tx_reset()
+		self.ring_time = 0.0
+		self.caller_id = ''
+		self.ring_counter = 0
+		self.voice_class = False
+		self.off_hook = False
+		self.state = common.PS_INACTIVE  # calls end, new calls rejected until modem ready again
+		self.reopen_timer = timers.rearm(self.reopen_timer, common.MODEM_REOPEN_TIME, self.reopen)
+		if (self.port_listener != None):
+			self.port_listener(False)
+
+	def reopen(self) -> None:  # reopen timer callback, port closed here (event loop stopped waiting for it after fault)
+		self.reopen_timer = None
+		try:
+			self.modem.close()
+		except PORT_ERRORS:
+			pass
+		if (not self.device_present()):
+			self.fault('device removed')
+			return
+		self.start()
+
+	def reconfigure(self, changes: dict) -> None:  # config reloaded between calls, only commands depending on changes are sent again
+		if ('MODEM_ECHO_CANCEL' in changes):
+			self.check_echo_cancel()
+		if ((self.state == common.PS_IDLE) and any([(name in changes) for name in RECONFIGURE_COMMANDS])):
+			self.command(SET_COUNTRY, RC_OK)  # set country.
+			self.command(ENABLE_FORMATTED_CID, RC_OK)  # caller ID format depends on country
+			debug(f':line.reconfigure: {self.port} country: {common.MODEM_COUNTRY_CODE}')
+		if ((self.state == common.PS_IDLE) and self.voice_class and any([(name in changes) for name in VOICE_IDLE_COMMANDS])):
+			self.command(self.profile.receive_gain_command(), RC_OK)  # Set receive gain.
+			self.command(TRANSMIT_GAIN, RC_OK)  # Set transmit gain.
+			debug(f':line.reconfigure: {self.port} gains sent')
+
 	def stop(self) -> None:
 		if (self.modem.is_open):
 			self.modem.close()
+		self.reset_commands()
+		self.health_timer = timers.cancel(self.health_timer)
+		self.reopen_timer = timers.cancel(self.reopen_timer)
+		self.fault_time = 0.0
+		self.cid_timer = timers.cancel(self.cid_timer)
+		self.ring_timer = timers.cancel(self.ring_timer)
+		self.audio_timer = timers.cancel(self.audio_timer)
+		self.tx_reset()
+		debug(f':line.stop: command times {self.command_stats()} results {self.results.stats()} faults {self.faults}')
 		self.state = common.PS_INACTIVE
 		debug(':line.stop: line.state: PS_INACTIVE')
 
-	def command(self, cmd, resp='') -> None:
-		result = False
-		self.modem_response = bytes('', 'ascii')
-		self.modem.write(cmd)  # Send command to the Modem
-		self.status = None  # clear status
-		debug(f':line.command: sent: {cmd}')
-		if (resp == ''):
-			return
-		timeout = time.time() + common.RESPONSE_TIMEOUT
-		while (time.time() < timeout):
-			if (self.modem.in_waiting != 0): # if response
-				self.modem_response += self.modem.read(self.modem.in_waiting)
-			if (resp in self.modem_response):
-				result = True
-				break
-			elif (ERROR_STR in self.modem_response):
-				result = False
+	def command(self, cmd: bytes, resp: str = None, callback: Callable = None, timeout: float = None, required: bool = True) -> None:  # queues an AT command, returns without waiting, timeout None is RESPONSE_TIMEOUT (reloadable)
+		timeout = common.RESPONSE_TIMEOUT if (timeout == None) else timeout
+		self.commands.append(ATCommand(cmd, resp, callback, timeout, required))
+		if (self.current == None):
+			self.next_command()
+
+	def next_command(self) -> None:  # writes queued commands until one waits for a response
+		while ((self.current == None) and (len(self.commands) != 0)):
+			command = self.commands.popleft()
+			self.current = command
+			try:
+				self.modem.write(command.cmd)  # Send command to the Modem
+			except PORT_ERRORS as e:
+				self.fault(f'write: {e}')
+				return
+			self.status = None  # clear status
+			command.sent = clock.monotonic()
+			debug(f':line.command: sent: {command.cmd}')
+			if (command.resp == None):
+				self.complete(True)
+			else:
+				self.command_timer = timers.schedule(command.timeout, self.command_timeout)
+
+	def response_received(self, data: bytes) -> None:  # modem data in command and data mode, result codes handled as events
+		for code, value in self.results.feed(data):
+			self.result(code, value)
+			if ((self.current == None) and (self.state == common.PS_CONNECTED)):  # voice data follows CONNECT
+				self.results.reset()
 				break
-		debug(f':line.command: rcvd: {self.modem_response}')  # do not clear modem response here
-		if (result == False):  # Failed command execution
-			common.error(':line.command: Error! Modem AT Command Response Error or Timeout.')
+
+	def result(self, code: str, value: str) -> None:
+		debug(f':line.result: {code} {value}')
+		if (code == RC_RING):  # call incoming from line
+			self.ring()
+		elif (code == RC_NMBR):  # caller ID, reported after first ring or requested (AT+VRID)
+			self.caller_id = value
+			debug(f':line.result:  {self.caller_id} calling.')
+		elif (code in CID_FIELDS.values()):
+			pass
+		elif (code == RC_INFO):
+			if (self.current != None):
+				self.current.info.append(value)
+			else:
+				debug(f':line.result: Unknown modem line dropped: {value}')
+				pass
+		elif (self.current != None):
+			if (code == self.current.resp):
+				self.complete(True)
+			elif (code in FAILURE_CODES):
+				self.complete(False)
+
+	def command_timeout(self) -> None:  # modem not responding, required commands are retried by reopening modem
+		self.command_timer = None
+		command = self.current
+		self.complete(False)
+		if (command.required):
+			self.fault(f'no response to {command.cmd.decode("ascii").strip()}')
+
+	def complete(self, result: bool) -> None:  # current command completed, next one is written
+		command = self.current
+		self.current = None
+		self.command_timer = timers.cancel(self.command_timer)
+		duration = clock.monotonic() - command.sent
+		name = command.cmd.split(b'=')[0].strip()
+		times = self.command_times.setdefault(name, [0, 0.0, 0.0])
+		times[0] += 1
+		times[1] += duration
+		times[2] = max(times[2], duration)
+		debug(f':line.command: completed: {command.cmd} {result} ({duration * 1000:.1f} ms)')
+		if ((result == False) and command.required):  # Failed command execution
+			common.error(f':line.command: Error! Modem AT Command Response Error or Timeout. {command.cmd}')
+		if (command.callback != None):
+			command.callback(command, result)
+		self.next_command()
+
+	def reset_commands(self) -> None:  # drops queued and running commands (modem closed or reopened)
+		self.commands.clear()
+		self.current = None
+		self.command_timer = timers.cancel(self.command_timer)
+
+	def busy(self) -> bool:  # AT commands running or caller ID not received yet
+		return ((self.current != None) or (self.cid_timer != None))
+
+	def command_stats(self) -> dict:  # command: (count, mean ms, max ms)
+		return {name.decode('ascii'): (times[0], round(times[1] * 1000 / times[0], 1), round(times[2] * 1000, 1)) for name, times in self.command_times.items()}
+
+	def voice_setup(self) -> None:  # voice mode settings, sent between calls when voice mode pre-armed (MODEM_VOICE_IDLE)
+		self.command(ENTER_VOICE_MODE, RC_OK)  # Enter Voice Mode
+		self.command(DISABLE_SILENCE_DETECTION, RC_OK)  # Disable Silence Detection
+		self.command(DTMF_DURATION, RC_OK)  # Set DTMF duration.
+		self.command(self.profile.receive_gain_command(), RC_OK)  # Set receive gain.
+		self.command(TRANSMIT_GAIN, RC_OK)  # Set transmit gain.
+		self.voice_format = VF_PCM
+		if (common.MODEM_PASSTHROUGH):  # G.711 data passes between modem and RTP without transcoding
+			self.voice_format = ([f for f in PASSTHROUGH_FORMATS if (f in self.profile.voice_formats)] + [VF_PCM])[0]
+		self.tx_silence = g711.silence(self.voice_format, TX_BLOCK)
+		self.command(self.profile.voice_compression(self.voice_format), RC_OK)  # Compression Method: Unsigned PCM or G.711 / Sampling Rate: 8KHz
+		self.voice_class = True
 
 	def start_voice_mode(self) -> None:
+		if (self.state == common.PS_INACTIVE):  # modem failed, call ends
+			return
 		if (self.state != common.PS_CONNECTED):
-			self.command(ENTER_VOICE_MODE, OK_STR)  # Enter Voice Mode
-			self.command(DISABLE_SILENCE_DETECTION, OK_STR)  # Disable Silence Detection
-			self.command(DTMF_DURATION, OK_STR)  # Set DTMF duration.
-			self.command(RECEIVE_GAIN, OK_STR)  # Set receive gain.
-			self.command(TRANSMIT_GAIN, OK_STR)  # Set transmit gain.
-			self.command(SET_VOICE_COMPRESSION, OK_STR)  # Compression Method: Unsigned PCM / Sampling Rate: 8KHz
-			self.command(LINE_OFF_HOOK, OK_STR)  # Open line
-			self.command(ENTER_VOICE_TRANSMIT_RECIEVE_STATE, CONNECT_STR)  # Put modem into voice transmit receive mode
+			self.voice_time = clock.monotonic()
+			if (not self.voice_class):
+				self.voice_setup()
+			if (not self.off_hook):  # already off-hook when dialed
+				self.command(LINE_OFF_HOOK, RC_OK)  # Open line
+			self.command(ENTER_VOICE_TRANSMIT_RECIEVE_STATE, RC_CONNECT, self.voice_connected)  # Put modem into voice transmit receive mode
 		self.caller_id = ''
 		self.dtmf = ''
-		self.m_val = 128
-		self.echo_cancel = 0
+		self.dtmf_detector = dtmf.Detector(self.voice_format) if (common.MODEM_DTMF_DETECT) else None
+		self.tone_detector = call_progress.Detector(common.MODEM_COUNTRY_CODE, self.voice_format) if (common.MODEM_TONE_DETECT) else None
+		self.echo_canceller = echo_canceller.EchoCanceller(common.MODEM_ECHO_CANCEL, self.voice_format) if (common.MODEM_ECHO_CANCEL and (echo_canceller.numpy != None)) else None
+		self.rx_pipeline = dsp.pipeline('DSP_PSTN_TO_IP', common.DSP_PSTN_TO_IP, self.voice_format)
+		self.tx_pipeline = dsp.pipeline('DSP_IP_TO_PSTN', common.DSP_IP_TO_PSTN, self.voice_format)
 		self.ring_counter = 0
-		self.ring_timer = 0
-		self.state = common.PS_CONNECTED
+		self.ring_timer = timers.cancel(self.ring_timer)
+		self.cid_timer = timers.cancel(self.cid_timer)
+		self.audio_timer = timers.cancel(self.audio_timer)
+		self.decoder.reset()
+		self.tx_reset()
+		self.state = common.PS_CONNECTED  # voice data is read and written when queued commands completed
 		debug(':line.start_voice_mode: line.state: CONNECTED')
 
 	def stop_voice_mode(self) -> None:
-		self.modem.reset_input_buffer()
-		self.modem.reset_output_buffer()
+		if (self.state == common.PS_INACTIVE):  # modem failed, reinitialized by watchdog
+			return
+		try:
+			self.modem.reset_input_buffer()
+			self.modem.reset_output_buffer()
+		except PORT_ERRORS as e:
+			self.fault(f'reset: {e}')
+			return
 		if ((self.state == common.PS_CONNECTED) or (self.state == common.PS_HANGINGUP)):
-			self.command(DTE_END_VOICE_DATA_TX_RX, DCE_END_VOICE_DATA_TX_RESP)  # Send End of Voice Transmit Recieve
-			self.command(LINE_ON_HOOK, OK_STR)
-			self.command(TERMINATE_CALL, OK_STR)
-		self.command(ENTER_DATA_MODE, OK_STR)  # Enter Data Mode
-		self.command(ENABLE_FORMATTED_CID, OK_STR)  # Enable formatted caller report.
+			self.command(self.profile.end_voice_tx_rx, self.profile.end_voice_result)  # Send End of Voice Transmit Recieve
+			self.command(LINE_ON_HOOK, RC_OK)
+			self.command(TERMINATE_CALL, RC_OK)
+			self.voice_class = False  # modem may leave voice mode when hanged up
+		self.off_hook = False
+		if (self.voice_idle):
+			if (not self.voice_class):
+				self.voice_setup()  # voice mode pre-armed for next call
+		else:
+			self.command(ENTER_DATA_MODE, RC_OK)  # Enter Data Mode
+			self.voice_class = False
+		self.command(ENABLE_FORMATTED_CID, RC_OK)  # Enable formatted caller report.
+		self.ring_time = 0.0
 		self.caller_id = ''
 		self.dtmf = ''
-		self.m_val = 128
-		self.echo_cancel = 0
+		debug(f':line.stop_voice_mode: echo canceller {self.echo_canceller.stats() if (self.echo_canceller != None) else None}')
+		self.echo_canceller = None
+		debug(f':line.stop_voice_mode: pstn to ip stages {self.rx_pipeline.stats() if (self.rx_pipeline != None) else None}, ip to pstn stages {self.tx_pipeline.stats() if (self.tx_pipeline != None) else None}')
+		self.rx_pipeline = None
+		self.tx_pipeline = None
 		self.ring_counter = 0
-		self.ring_timer = 0
+		self.ring_timer = timers.cancel(self.ring_timer)
+		self.cid_timer = timers.cancel(self.cid_timer)
+		self.audio_timer = timers.cancel(self.audio_timer)
+		debug(f':line.stop_voice_mode: transmit {self.tx_stats()}')
+		self.tx_reset()
 		self.state = common.PS_IDLE
 		debug(':line.stop_voice_mode: line.state: PS_IDLE')
 
 	def handler(self) -> None:
-		if (self.state != common.PS_CONNECTED):  # if modem in data mode
-			if (self.modem.in_waiting > 0):  # check if modem has data
-				self.modem_response += self.modem.read(self.modem.in_waiting)
-				if (len(self.modem_response) != 0):
-					debug(f':line_handler: Modem response: {self.modem_response}')
-					if (RING_STR in self.modem_response):  # call incoming from line
-						self.ring_timer = time.time() + RING_TIMEOUT  # every ring restarts timer
-						self.ring_counter += 1  # increase ring counter
-						if (self.state != common.PS_RINGING):
-							self.state = common.PS_RINGING
-							time.sleep(0.5)  # wait a while
-							self.command(REPORT_CID, OK_STR)  # request caller ID
-							if (NMBR_STR in self.modem_response):  # if caller ID
-								ns = self.modem_response.find(NMBR_STR)
-								ne = self.modem_response.find(CRLF_STR, ns)
-								self.caller_id = self.modem_response[ns+5:ne].decode('utf-8')  # get CID from modem response
-								debug(f':line.handler:  {self.caller_id} calling.')
-						self.modem_response = bytes('', 'ascii')  # clear response
-					elif (OK_STR in self.modem_response):  # if unhandled response
-						self.modem_response = bytes('', 'ascii')  # clear response
-			elif (self.ring_timer != 0):
-				if (time.time() > self.ring_timer):  # Call from line, Caller give up / cancel
-					debug(':main_handler: Warning! Caller gived up / canceled. Call will be disconnected.')
-					self.state = common.PS_IDLE
+		if ((self.current != None) or (self.state not in (common.PS_CONNECTED, common.PS_INACTIVE))):  # if command running or modem in data mode
+			try:
+				if (self.modem.in_waiting > 0):  # check if modem has data
+					self.response_received(self.modem.read(self.modem.in_waiting))
+			except PORT_ERRORS as e:
+				self.fault(f'read: {e}')
+
+	def ring(self) -> None:
+		if ((self.state != common.PS_IDLE) and (self.state != common.PS_RINGING)):  # modem answered or answering a call
+			return
+		self.ring_timer = timers.rearm(self.ring_timer, RING_TIMEOUT, self.ring_timeout)  # every ring restarts timer
+		self.ring_counter += 1  # increase ring counter
+		if (self.state != common.PS_RINGING):  # new call
+			self.state = common.PS_RINGING
+			self.ring_time = clock.monotonic()
+			self.cid_timer = timers.rearm(self.cid_timer, CALLER_ID_DELAY, self.request_caller_id)  # wait a while
+
+	def request_caller_id(self) -> None:  # cid timer callback
+		self.command(REPORT_CID, RC_OK)  # request caller ID
+		self.cid_timer = None  # busy until caller ID received (command running)
+
+	def voice_connected(self, command: ATCommand, result: bool) -> None:  # AT+VTR completed, voice data flows
+		if (result):
+			profiler.record('voice_setup', clock.monotonic() - self.voice_time)
+			if (self.ring_time != 0):  # answered call from line
+				profiler.record('ring_to_bridge', clock.monotonic() - self.ring_time)
+		self.ring_time = 0.0
+
+	def ring_timeout(self) -> None:  # Call from line, Caller give up / cancel
+		self.ring_timer = None
+		self.ring_time = 0.0
+		debug(':main_handler: Warning! Caller gived up / canceled. Call will be disconnected.')
+		self.state = common.PS_IDLE
+
+	def audio_ready(self) -> None:  # a full packet expected in modem receive buffer, modem is waited by event loop again
+		self.audio_timer = None
 
 	def read_audio(self) -> bytes:  # Modem Receive
 		pstn_read = None
-		if (self.state == common.PS_CONNECTED):  # if modem in voice mode
-			if (self.modem.in_waiting >= common.RTP_LEN):  # if modem receive buffer has data
-				pstn_read = bytearray(self.modem.read(self.modem.in_waiting))  # read modem receive buffer
-				data_len = len(pstn_read)
-				debug(f'{time.time()} : data_len: {data_len}, pstn_read {pstn_read}')
-				dle = pstn_read.find(DLE_CHAR)  # if <DLE>s in audio data
-				while (dle >= 0):  # if DLE char found
-					pstn_read[dle] = DLE_ERASER  # change with DLE_ERASER
-					dle += 1  # search for a code in the next byte
-					if (dle == data_len):  # no more bytes in data
-						break
-					if (pstn_read[dle] == DLE_CHAR):  # will be deleted
-						pass
-					elif (pstn_read[dle] == DCE_BUSY_TONE):
-						debug(':line.read_audio: Warning! Busy tone detected. Call will be disconnected.')
-						self.state = common.PS_HANGINGUP
-						break
-					elif (pstn_read[dle] == DCE_DIAL_TONE):
-						debug(':line.read_audio: Warning! Dial tone detected. Call will be disconnected.')
-						self.state = common.PS_HANGINGUP
-						break
-					elif (pstn_read[dle] == DCE_SILENCE_DETECTED):
-						debug(':line.read_audio: Warning! Silence detected. Call will be disconnected.')
-						self.state = common.PS_HANGINGUP
-						break
-					elif (pstn_read[dle] == DCE_END_VOICE_DATA_TX):
-						debug(':line.read_audio: Warning! <DLE><ETX> Char recieved. Call will be disconnected.')
-						self.state = common.PS_HANGINGUP
-						break
-					elif (pstn_read[dle] == DCE_TX_BUFFER_UNDERRUN):  # <DLE>u : transmit buffer underrun
-						self.status = DCE_TX_BUFFER_UNDERRUN
-						debug(':line.read_audio: Warning! TX Buffer Underrun.')
-						pass
-					elif (pstn_read[dle] == DCE_RX_BUFFER_OVERRUN):  # <DLE>o : receive buffer overrun
-						debug(':line.read_audio: Warning! RX Buffer Overrun.')
-						pass
-					elif (chr(pstn_read[dle]) in common.DTMF_DIGITS):  # DTMF tone received from line
-						self.dtmf = chr(pstn_read[dle])
-						debug(f':line.read_audio: DTMF tone {self.dtmf} recieved from line.')
-					else:
-						debug(f':line.read_audio: Unhandled <DLE><{hex(pstn_read[dle])}> recieved.')  # <DLE><code> received
-						pass
-					pstn_read[dle] = DLE_ERASER
-					dle = pstn_read.find(DLE_CHAR, dle)  # dle intentionally not increased
+		if ((self.state == common.PS_CONNECTED) and (self.current == None)):  # if modem in voice mode
+			try:
+				in_waiting = self.modem.in_waiting
+				if (in_waiting < common.RTP_LEN):  # not enough data yet, event loop waits until a full packet expected
+					self.audio_timer = timers.rearm(self.audio_timer, (common.RTP_LEN - in_waiting) / common.SAMPLE_FREQ, self.audio_ready)
+				else:  # if modem receive buffer has data
+					self.audio_timer = timers.cancel(self.audio_timer)
+					pstn_read = self.decode_audio(self.modem.read(in_waiting))  # read modem receive buffer
+			except PORT_ERRORS as e:
+				self.fault(f'read: {e}')
+		return pstn_read
+
+	def decode_audio(self, pstn_read: bytes) -> bytes:  # handles <DLE> shielded codes in modem receive data, None if no audio left
+		debug(f'{clock.time()} : data_len: {len(pstn_read)}, pstn_read {pstn_read}')
+		pstn_read = self.decoder.decode(pstn_read)
+		if (len(pstn_read) == 0):
+			return None
+		if (self.echo_canceller != None):  # detectors get audio without echo of prompts and digits
+			pstn_read = self.echo_canceller.near(pstn_read)
+		if (self.dtmf_detector != None):
+			digits = self.dtmf_detector.feed(pstn_read)
+			if ((digits != '') and (clock.monotonic() >= self.dtmf_mute)):
+				self.dtmf = digits[-1]
+				debug(f':line.decode_audio: DTMF tone {self.dtmf} detected on line.')
+		if (self.tone_detector != None):
+			tone = self.tone_detector.feed(pstn_read)
+			if ((tone != None) and (self.state == common.PS_CONNECTED) and (clock.monotonic() >= self.tone_mute)):
+				profiler.record(f'tone_{tone.name}', self.tone_detector.latency)
+				debug(f':line.decode_audio: Warning! {tone.name} tone detected after {self.tone_detector.latency:.2f} s. Call will be disconnected.')
+				self.state = common.PS_HANGINGUP
+		if (self.rx_pipeline != None):  # detectors get unprocessed levels, rest of frame waits for next read
+			pstn_read = self.rx_pipeline.process(pstn_read)
+			if (len(pstn_read) == 0):
+				return None
 		return pstn_read
 
-	def write_audio(self, packet: bytes) -> None:  #Modem Transmit
+	def dle_hangup(self, code: int) -> None:  # <DLE>b busy tone, <DLE>d dial tone, <DLE>s silence, <DLE><ETX> end of voice data
+		debug(f':line.read_audio: Warning! <DLE>{chr(code) if (code > 32) else "<ETX>"} detected. Call will be disconnected.')
+		self.state = common.PS_HANGINGUP
+
+	def dle_underrun(self, code: int) -> None:  # <DLE>u : transmit buffer underrun
+		self.status = DCE_TX_BUFFER_UNDERRUN
+		self.tx_modem_underruns += 1
+		self.tx_fifo = 0.0  # modem FIFO is empty, pacing refills it on next block time
+		debug(':line.read_audio: Warning! TX Buffer Underrun.')
+
+	def dle_overrun(self, code: int) -> None:  # <DLE>o : receive buffer overrun
+		debug(':line.read_audio: Warning! RX Buffer Overrun.')
+		pass
+
+	def dle_dtmf(self, code: int) -> None:  # DTMF tone received from line
+		if (self.dtmf_detector != None):  # digits reported by software detector
+			return
+		self.dtmf = chr(code)
+		debug(f':line.read_audio: DTMF tone {self.dtmf} recieved from line.')
+
+	def dle_unhandled(self, code: int) -> None:
+		debug(f':line.read_audio: Unhandled <DLE><{hex(code)}> recieved.')  # <DLE><code> received
+		pass
+
+	def write_linear(self, packet: bytes) -> None:  # prompts (8 bit unsigned linear), converted to voice format
+		self.tone_mute = clock.monotonic() + PROMPT_ECHO_TIME
+		self.write_audio(g711.encode(self.voice_format, packet))
+
+	def rtp_formats(self) -> list:  # G.711 formats offered to IP side, MODEM_PASSTHROUGH formats of modem first (A-law only when modem reports it), mu-law always
+		formats = [f for f in PASSTHROUGH_FORMATS if (common.MODEM_PASSTHROUGH and (f in self.profile.voice_formats))]
+		return (formats + ([VF_ULAW] if (VF_ULAW not in formats) else []))
+
+	def to_linear(self, data: bytes) -> bytes:  # voice data read from modem as 8 bit unsigned linear (recording)
+		return g711.decode(self.voice_format, data)
+
+	def write_audio(self, packet: bytes) -> None:  # Modem Transmit (voice format), audio queued and written by tx_pace at sample rate
 		if (self.state == common.PS_CONNECTED):  # if modem in voice mode
-			if (self.modem.out_waiting < 6401):  # if modem transmit buffer has space (out_waiting returns wrong numbers, sometimes multiplied by 8 sometimes 16)
-				data = bytearray(packet)  # read IP call receive buffer
-				data_len = len(data)
-				if (data_len != 0):  # if data received and modem buffer has space (out_waiting parameter returns wrong numbers)
-					dle = data.find(DLE_CHAR)  # if <DLE>s in audio data
-					while (dle >= 0):  # if DLE char found
-						data[dle] = DLE_ERASER  # change with DLE_ERASER
-						dle = data.find(DLE_CHAR, dle)  # dle intentionally not increased
-					if (common.ECHO_CANCEL_DELTA != 0):  # 'echo cancellation' handling
-						i = j = m = 0
-						while (i < data_len):
-							v = data[i]
-							if (v > 128):  # only positive values (audio packets consist: 8 bit, unsigned, 0x80 biased)
-								m += int(v)  # m: sum of ip_read bytes
-								j += 1
-								if (j == 10):  # 10 sample to detect sound changes
-									break
-							i += 1
-						if (j > 0):  # if sound detected
-							m = m / j  # calculate mean value of samples
-							if (abs(self.m_val - m) > common.ECHO_CANCEL_DELTA):  # if mean value changes above limit
-								self.echo_cancel = time.time() + common.ECHO_CANCEL_TIME  # (re)trigger echo cancellation timer
-							self.m_val = int((self.m_val + m) / 2)  # calculate long term mean value
-							if (self.m_val > (128 + common.ECHO_CANCEL_DELTA)):  # if mean value is high enough
-								self.echo_cancel = time.time() + common.ECHO_CANCEL_TIME  # (re)trigger echo cancellation timer
-						if (self.echo_cancel != 0):  # during echo cancellation time
-							if (time.time() > self.echo_cancel):  # timeout occured
-								self.echo_cancel = 0  # end echo cancellation
-					self.modem.write(data)  # send packet
-					if (self.status == DCE_TX_BUFFER_UNDERRUN):
-						self.modem.write(data)  # add the same packet to transmit queue
-						self.status = None  # clear status
+			data = packet  # read IP call receive buffer
+			data_len = len(data)
+			if (data_len != 0):  # if data received, queue keeps samples, tx_pace shields <DLE>s of written blocks
+				self.tx_queue += data
+				if (len(self.tx_queue) > TX_QUEUE_MAX):  # IP side sends faster than modem plays, drop oldest audio
+					del self.tx_queue[:len(self.tx_queue) - TX_QUEUE_MAX]
+					self.tx_overruns += 1
+					debug(':line.write_audio: Warning! TX queue overrun.')
+				if (self.tx_timer == None):  # first audio, start pacing
+					self.tx_time = clock.monotonic()
+					self.tx_pace()
+
+	def tx_pace(self) -> None:  # tx timer callback, keeps estimated modem FIFO at profile tx_fifo_level writing TX_BLOCK blocks
+		if (self.state != common.PS_CONNECTED):
+			self.tx_timer = None
+			return
+		deadline = (self.tx_timer.deadline if (self.tx_timer != None) else clock.monotonic())
+		self.tx_timer = timers.schedule_at(deadline + TX_BLOCK_TIME, self.tx_pace)
+		now = clock.monotonic()
+		if (self.current != None):  # voice mode commands running, audio waits in queue
+			self.tx_time = now
+			return
+		self.tx_fifo = max(self.tx_fifo - (now - self.tx_time) * common.SAMPLE_FREQ, 0.0)  # modem plays SAMPLE_FREQ bytes per second
+		self.tx_time = now
+		while (self.tx_fifo < self.profile.tx_fifo_level):
+			if ((len(self.tx_queue) < TX_BLOCK) and (self.tx_source != None)):  # pull bridged IP audio at playout time
+				if (self.tx_pipeline != None):  # whole frames pulled, surplus waits in queue
+					audio = self.tx_source(dsp.FRAME)
+					if (audio != None):
+						self.write_audio(self.tx_pipeline.process(audio))
+				else:
+					audio = self.tx_source(TX_BLOCK - len(self.tx_queue))
+					if (audio != None):
+						self.write_audio(audio)
+			queued = len(self.tx_queue)
+			if (queued >= TX_BLOCK):
+				with memoryview(self.tx_queue) as queue:
+					self.tx_block[:] = queue[:TX_BLOCK]
+				del self.tx_queue[:TX_BLOCK]
+				self.tx_last = True
+			else:
+				if (self.tx_last):  # underrun, fade last block out instead of repeating it
+					last = g711.decode(self.voice_format, self.tx_block)
+					self.tx_block[queued:] = g711.encode(self.voice_format, bytes([128 + ((last[n] - 128) * (TX_BLOCK - n)) // TX_BLOCK for n in range(queued, TX_BLOCK)]))
+					self.tx_last = False
+					self.tx_underruns += 1
+					debug(':line.tx_pace: Warning! TX queue underrun.')
+				else:  # no audio, silence keeps modem FIFO filled
+					self.tx_block[queued:] = self.tx_silence[queued:]
+				self.tx_block[:queued] = self.tx_queue
+				self.tx_queue.clear()
+			block = self.tx_view
+			if (self.tx_block.find(DLE_CHAR) >= 0):  # <DLE> samples are doubled, modem plays one byte of each pair (copied only when needed)
+				block = self.tx_block.replace(DLE_BYTE, DLE_DLE_BYTES)
+			try:
+				self.modem.write(block)
+			except PORT_ERRORS as e:
+				self.fault(f'write: {e}')
+				return
+			if (self.echo_canceller != None):  # far-end reference, every block played including silence
+				self.echo_canceller.far(self.tx_block)
+			self.tx_fifo += TX_BLOCK  # samples, doubled <DLE>s take no modem FIFO time
+
+	def set_tx_source(self, source: Callable) -> None:  # bridges IP audio (IPPhone.jitter.get), None stops
+		self.tx_source = source
+		if ((source != None) and (self.tx_timer == None) and (self.state == common.PS_CONNECTED)):  # start pacing
+			self.tx_time = clock.monotonic()
+			self.tx_pace()
+
+	def tx_reset(self) -> None:
+		self.tx_timer = timers.cancel(self.tx_timer)
+		self.tx_source = None
+		self.tx_queue.clear()
+		self.tx_fifo = 0.0
+		self.tx_last = False
+
+	def tx_stats(self) -> dict:  # transmit counters and buffer depth (bytes)
+		return {'underruns': self.tx_underruns, 'modem_underruns': self.tx_modem_underruns, 'overruns': self.tx_overruns, \
+			'queue': len(self.tx_queue), 'fifo': int(self.tx_fifo)}
+
+	def get_readers(self) -> list:  # objects to be waited by event loop for incoming data
+		if ((not self.selectable) or (not self.modem.is_open) or (self.reopen_timer != None)):  # failed port is closed after unregistered
+			return []
+		if (self.audio_timer != None):  # voice mode, waiting for a full packet (audio_timer wakes up event loop)
+			return []
+		return [self.modem]
 
 	def read_dtmf(self) -> str:
 		dtmf = self.dtmf
@@ -297,11 +866,23 @@ class Line:
 		return dtmf
 
 	def send_dtmf(self, dtmf: str) -> None:
-		self.modem.write((SEND_DTMF + dtmf + '\r\n').encode('ascii'))  # Send DTMF tone to line
+		if (self.state == common.PS_INACTIVE):
+			return
+		self.dtmf_mute = clock.monotonic() + DTMF_ECHO_TIME
+		try:
+			self.modem.write((SEND_DTMF + dtmf + '\r\n').encode('ascii'))  # Send DTMF tone to line
+		except PORT_ERRORS as e:
+			self.fault(f'write: {e}')
+			return
 		debug(f':line.send_dtmf: DTMF {dtmf} sent to line.')
 		
-	def dial(self, number: str) -> None:
-		self.command(('ATD' + number + ';\r\n').encode('ascii'), OK_STR)  # Dial PBX number
+	def dial(self, number: str) -> None:  # dials in voice mode, only AT+VTR is sent when bridged
+		if (self.state == common.PS_INACTIVE):  # modem failed, call ends
+			return
+		if (not self.voice_class):
+			self.voice_setup()
+		self.command(('ATD' + number + ';\r\n').encode('ascii'), RC_OK)  # Dial PBX number
+		self.off_hook = True
 		debug(f':line.dial:  {number} dialed.')
 
 	def read_caller_id(self) -> str:
@@ -0,0 +1,441 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: media_process.py
+# Description: Media process of pstnxsip. Owns modems and RTP sockets, bridges audio. Signaling process (pstnxsip.py) controls it through a pipe, prompt and record audio pass through shared memory rings.
+# Author: Aydin Parin
+
+from typing import Callable
+from ip_phone import IPPhone
+from line import Line
+from call_session import CallSession
+from multiprocessing import shared_memory
+import clock
+import common
+import config
+import g711
+import multiprocessing
+import profiler
+import selectors
+import timers
+
+debug = common.debug
+
+RING_HEADER = 16  # write and read positions (two unsigned 64 bit counters)
+PROMPT_RING_SIZE = common.SAMPLE_FREQ  # 1 sec of prompt audio (signaling writes at real time pace)
+RECORD_RING_SIZE = common.SAMPLE_FREQ * 8  # 8 sec of line audio for recording
+RECORD_POLL_TIME = 0.1  # signaling process reads record ring at least every 100 ms
+RTP_PARAMS = ('rtp_local_ip', 'rtp_local_port', 'rtp_remote_ip', 'rtp_remote_port', 'rtp_outSequence', 'rtp_outTimestamp', 'rtp_outSSRC', 'rtp_codec', 'rtp_cn')
+
+class AudioRing:  # single producer, single consumer byte ring buffer in shared memory
+	def __init__(self, size: int, name: str = None):
+		self.owner = (name == None)
+		self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=RING_HEADER + size)
+		self.name = self.shm.name
+		self.size = size
+		self.pos = self.shm.buf[:RING_HEADER].cast('Q')  # pos[0]: write position, pos[1]: read position
+		self.data = self.shm.buf[RING_HEADER:RING_HEADER + size]
+		if (self.owner):
+			self.pos[0] = 0
+			self.pos[1] = 0
+
+	def used(self) -> int:
+		return self.pos[0] - self.pos[1]
+
+	def write(self, data: bytes) -> int:  # returns written byte count, drops data not fitting
+		w = self.pos[0]
+		n = min(len(data), self.size - (w - self.pos[1]))
+		start = w % self.size
+		first = min(n, self.size - start)
+		self.data[start:start + first] = data[:first]
+		if (n > first):
+			self.data[:n - first] = data[first:n]
+		self.pos[0] = w + n  # publish after data copied
+		return n
+
+	def read(self, length: int = 0) -> bytes:  # returns all data or length bytes at most
+		r = self.pos[1]
+		n = self.pos[0] - r
+		if ((length != 0) and (length < n)):
+			n = length
+		start = r % self.size
+		first = min(n, self.size - start)
+		data = bytes(self.data[start:start + first])
+		if (n > first):
+			data += bytes(self.data[:n - first])
+		self.pos[1] = r + n
+		return data
+
+	def close(self) -> None:
+		self.pos.release()
+		self.data.release()
+		self.shm.close()
+		if (self.owner):
+			self.shm.unlink()
+
+class MediaClient:  # signaling process side of media process
+	def __init__(self, modem_ports: list, ip_count: int):
+		self.conn, media_conn = multiprocessing.Pipe()
+		self.seq = 0  # sequence of last sent control message
+		self.to_line = [AudioRing(PROMPT_RING_SIZE) for port in modem_ports]
+		self.from_line = [AudioRing(RECORD_RING_SIZE) for port in modem_ports]
+		self.to_ip = [AudioRing(PROMPT_RING_SIZE) for n in range(ip_count)]
+		rings = [[r.name for r in self.to_line], [r.name for r in self.from_line], [r.name for r in self.to_ip]]
+		self.media_args = (media_conn, modem_ports, ip_count, rings)  # MediaProcess arguments (simulation.py runs it in this process)
+		self.process = multiprocessing.Process(target=media_main, args=self.media_args + (dict(config.overrides),), daemon=True)
+		self.lines = [LineProxy(self, n, port) for n, port in enumerate(modem_ports)]
+		self.ip_phones = [None] * ip_count
+
+	def start(self) -> None:
+		self.process.start()
+		debug(f':media_client.start: Media process started, pid: {self.process.pid}')
+
+	def stop(self) -> None:
+		if (self.process.is_alive()):
+			self.send('stop')
+			self.process.join(common.RESPONSE_TIMEOUT)
+		for ring in (self.to_line + self.from_line + self.to_ip):
+			ring.close()
+
+	def send(self, command: str, index: int = 0, *args) -> int:
+		self.seq += 1
+		self.conn.send((self.seq, command, index, args))
+		return self.seq
+
+	def poll(self, timeout: float = 0) -> None:  # handles media process messages
+		while (self.conn.poll(timeout)):
+			timeout = 0
+			msg = self.conn.recv()
+			if (msg[0] == 'line'):  # ('line', index, seq, state, ring_counter, caller_id, busy, recovering, formats)
+				self.lines[msg[1]].update(*msg[2:])
+			elif (msg[0] == 'line_dtmf'):  # ('line_dtmf', index, digit)
+				self.lines[msg[1]].dtmf += msg[2]
+			elif (msg[0] == 'ip_dtmf'):  # ('ip_dtmf', index, digit)
+				if ((self.ip_phones[msg[1]] != None) and (self.ip_phones[msg[1]].rtp_active)):
+					self.ip_phones[msg[1]].dtmf += msg[2]
+
+	def write_ring(self, ring: AudioRing, data: bytes) -> None:
+		was_empty = (ring.used() == 0)
+		ring.write(data)
+		if (was_empty):  # media process reads rings while they have data
+			self.send('wake')
+
+class LineProxy:  # Line interface of signaling process, modem is controlled by media process
+	def __init__(self, media: MediaClient, index: int, port: str):
+		self.media = media
+		self.index = index
+		self.port = port
+		self.seq = 0  # state updates of media process older than last command are ignored
+		self.state = common.PS_INACTIVE
+		self.caller_id = ''
+		self.dtmf = ''
+		self.voice_format = g711.LINEAR  # prompt and record rings carry linear audio, media process converts to line's voice format
+		self.ring_counter = 0
+		self.commands_running = False  # modem commands of media process line running or caller ID not received yet
+		self.fault = False  # modem of media process failed and reopening
+		self.formats = [g711.ULAW]  # rtp_formats of media process line (depends on probed modem)
+		self.selectable = True
+
+	def update(self, seq: int, state: int, ring_counter: int, caller_id: str, busy: bool, recovering: bool, formats: tuple) -> None:
+		if (seq >= self.seq):
+			self.state = state
+			self.ring_counter = ring_counter
+			self.caller_id = caller_id
+			self.commands_running = busy
+			self.fault = recovering
+			self.formats = list(formats)
+
+	def busy(self) -> bool:
+		return self.commands_running
+
+	def recovering(self) -> bool:
+		return self.fault
+
+	def rtp_formats(self) -> list:
+		return self.formats
+
+	def start(self) -> None:  # media process starts modem, wait for it
+		timeout = clock.monotonic() + (common.RESPONSE_TIMEOUT * 10)
+		self.media.poll()
+		while ((self.state == common.PS_INACTIVE) and (clock.monotonic() < timeout)):
+			clock.sleep(common.LOOP_TIME)
+			self.media.poll()
+		if (self.state == common.PS_INACTIVE):
+			common.error(f':line_proxy.start: Error! Media process not started line {self.port}.')
+
+	def stop(self) -> None:
+		self.state = common.PS_INACTIVE
+		if (all([line.state == common.PS_INACTIVE for line in self.media.lines])):
+			self.media.stop()
+
+	def start_voice_mode(self) -> None:
+		if (self.state != common.PS_CONNECTED):
+			self.seq = self.media.send('start_voice_mode', self.index)
+		self.caller_id = ''
+		self.dtmf = ''
+		self.ring_counter = 0
+		self.state = common.PS_CONNECTED
+
+	def stop_voice_mode(self) -> None:
+		self.seq = self.media.send('stop_voice_mode', self.index)
+		self.caller_id = ''
+		self.dtmf = ''
+		self.ring_counter = 0
+		self.state = common.PS_IDLE
+
+	def dial(self, number: str) -> None:
+		self.media.send('dial', self.index, number)
+
+	def reconfigure(self, changes: dict) -> None:  # media process applies reloaded config and sends modem commands depending on it
+		if (changes != {}):
+			self.seq = self.media.send('reconfigure', self.index, changes)
+
+	def send_dtmf(self, dtmf: str) -> None:
+		self.media.send('send_dtmf', self.index, dtmf)
+
+	def read_dtmf(self) -> str:
+		dtmf = self.dtmf[:1]
+		self.dtmf = self.dtmf[1:]
+		return dtmf
+
+	def read_caller_id(self) -> str:
+		return self.caller_id
+
+	def read_audio(self) -> bytes:  # line audio is bridged by media process
+		return None
+
+	def set_tx_source(self, source: Callable) -> None:  # media process line pulls bridged RTP audio (bridge command)
+		pass
+
+	def write_linear(self, packet: bytes) -> None:  # prompts
+		if (self.state == common.PS_CONNECTED):
+			self.media.write_ring(self.media.to_line[self.index], packet)
+
+	def handler(self) -> None:
+		self.media.poll()
+
+	def get_readers(self) -> list:  # one pipe for all lines
+		if (self.index == 0):
+			return [self.media.conn]
+		return []
+
+class SignalingIPPhone(IPPhone):  # IP phone of signaling process, RTP socket is owned by media process
+	def __init__(self, media: MediaClient, index: int, *args):
+		super().__init__(*args)
+		self.media = media
+		self.index = index
+		media.ip_phones[index] = self
+
+	def rtp_start(self) -> None:
+		if (self.rtp_active):
+			self.rtp_stop()
+		self.media.send('rtp_start', self.index, {p: getattr(self, p) for p in RTP_PARAMS})
+		self.rtp_active = True
+
+	def rtp_stop(self) -> None:
+		if (self.rtp_active):
+			self.dtmf = ''
+			self.rtp_active = False
+			self.media.send('rtp_stop', self.index)
+
+	def get_readers(self) -> list:
+		if (self.active):
+			return [self.sip_sckt]
+		return []
+
+	def read_audio(self, length: int = 0) -> bytes:  # RTP is received by media process
+		return None
+
+	def write_audio(self, payload: bytes) -> None:  # prompts
+		if (self.rtp_active):
+			self.media.write_ring(self.media.to_ip[self.index], payload)
+
+	def send_dtmf(self, dtmf: str) -> None:
+		if (self.rtp_active):
+			self.media.send('send_dtmf_ip', self.index, dtmf)
+
+class SplitCallSession(CallSession):  # call session of signaling process, audio is bridged by media process
+	def __init__(self, line: LineProxy, ip_phone: SignalingIPPhone, call_from: int):
+		super().__init__(line, ip_phone, call_from)
+		self.record_timer: timers.Timer = None
+
+	def start_cross_conn(self) -> None:
+		if (self.cross_connected):
+			return
+		super().start_cross_conn()
+		self.line.media.send('bridge', self.line.index, self.ip_phone.index, common.RECORDING_ENABLED)
+		if (self.rec_started):
+			self.record_timer = timers.schedule(RECORD_POLL_TIME, self.record_poll)
+
+	def stop_cross_conn(self) -> None:
+		self.line.media.send('unbridge', self.line.index)
+		self.record_timer = timers.cancel(self.record_timer)
+		self.bridge_audio()  # remaining recorded audio
+		super().stop_cross_conn()
+
+	def bridge_audio(self) -> None:
+		if (self.rec_started):
+			self.record_handler(self.line.media.from_line[self.line.index].read())
+
+	def record_poll(self) -> None:  # record timer callback
+		self.bridge_audio()
+		self.record_timer = timers.schedule(RECORD_POLL_TIME, self.record_poll)
+
+class MediaProcess:
+	def __init__(self, conn, modem_ports: list, ip_count: int, rings: list):
+		self.conn = conn
+		self.lines = [Line(port) for port in modem_ports]
+		self.rtps = [IPPhone('', '', '', '', 0, 0, 0, '', 0) for n in range(ip_count)]  # only RTP part is used
+		self.to_line = [AudioRing(PROMPT_RING_SIZE, name) for name in rings[0]]
+		self.from_line = [AudioRing(RECORD_RING_SIZE, name) for name in rings[1]]
+		self.to_ip = [AudioRing(PROMPT_RING_SIZE, name) for name in rings[2]]
+		self.bridges = {}  # line index: rtp index
+		self.recording = set()  # line indexes
+		self.seq = 0  # last handled control message
+		self.reported = [None] * len(self.lines)
+		self.running = True
+		self.selector = selectors.DefaultSelector()
+
+	def run(self) -> None:
+		self.start()
+		busy = False
+		while (self.running):
+			self.wait_events(busy)
+			busy = self.handle_events()
+		self.stop()
+
+	def start(self) -> None:
+		for line in self.lines:
+			line.start()
+		self.report()
+
+	def handle_events(self) -> bool:  # one loop pass, returns True while prompts playing
+		self.control_handler()
+		timers.expire()
+		for n, line in enumerate(self.lines):
+			self.line_handler(n, line)
+		for n, rtp in enumerate(self.rtps):
+			self.rtp_handler(n, rtp)
+		busy = self.prompt_handler()
+		self.report()
+		return busy
+
+	def stop(self) -> None:
+		for rtp in self.rtps:
+			rtp.rtp_stop()
+		for line in self.lines:
+			line.stop()
+		for ring in (self.to_line + self.from_line + self.to_ip):
+			ring.close()
+
+	def wait_events(self, prompts: bool) -> None:
+		readers = [self.conn]
+		for handler in (self.lines + self.rtps):
+			readers += handler.get_readers()
+		for key in list(self.selector.get_map().values()):
+			if (key.fileobj not in readers):
+				self.selector.unregister(key.fileobj)
+		registered = [key.fileobj for key in self.selector.get_map().values()]
+		for r in readers:
+			if (r not in registered):
+				self.selector.register(r, selectors.EVENT_READ)
+		timeout = timers.timeout()
+		if (prompts or (not all([line.selectable for line in self.lines]))):  # prompt rings are read every LOOP_TIME
+			if ((timeout == None) or (timeout > common.LOOP_TIME)):
+				timeout = common.LOOP_TIME
+		self.selector.select(timeout)
+
+	def control_handler(self) -> None:
+		while (self.conn.poll()):
+			seq, command, n, args = self.conn.recv()
+			self.seq = seq
+			debug(f':media_process.control_handler: {command} {n} {args}')
+			if (command == 'start_voice_mode'):
+				self.lines[n].start_voice_mode()
+			elif (command == 'stop_voice_mode'):
+				self.lines[n].stop_voice_mode()
+				self.to_line[n].read()  # drop remaining prompt
+			elif (command == 'dial'):
+				self.lines[n].dial(args[0])
+			elif (command == 'reconfigure'):
+				config.update(args[0])
+				self.lines[n].reconfigure(args[0])
+			elif (command == 'send_dtmf'):
+				self.lines[n].send_dtmf(args[0])
+			elif (command == 'rtp_start'):
+				for p, value in args[0].items():
+					setattr(self.rtps[n], p, value)
+				self.rtps[n].rtp_start()
+			elif (command == 'rtp_stop'):
+				self.rtps[n].rtp_stop()
+				self.to_ip[n].read()  # drop remaining prompt
+			elif (command == 'send_dtmf_ip'):
+				self.rtps[n].send_dtmf(args[0])
+			elif (command == 'bridge'):
+				self.bridges[n] = args[0]
+				self.rtps[args[0]].set_audio_format(self.lines[n].voice_format)  # G.711 payloads pass without transcoding when modem uses the codec
+				self.rtps[args[0]].jitter.restart()  # drop IP audio received before bridged
+				self.lines[n].set_tx_source(self.rtps[args[0]].jitter.get)  # line pulls IP audio at playout time
+				if (args[1]):
+					self.recording.add(n)
+			elif (command == 'unbridge'):
+				self.bridges.pop(n, None)
+				self.lines[n].set_tx_source(None)
+				self.recording.discard(n)
+			elif (command == 'stop'):
+				self.running = False
+
+	def line_handler(self, n: int, line: Line) -> None:
+		if ((line.state != common.PS_CONNECTED) or line.busy()):  # data mode or voice mode commands running
+			line.handler()
+			return
+		audio = line.read_audio()
+		dtmf = line.read_dtmf()
+		if (n in self.bridges):
+			rtp = self.rtps[self.bridges[n]]
+			if (audio != None):
+				if (n in self.recording):
+					self.from_line[n].write(line.to_linear(audio))
+				rtp.write_audio(audio)
+			if ((dtmf != '') and (dtmf in common.DTMF_DIGITS)):
+				rtp.send_dtmf(dtmf)
+		elif (dtmf != ''):
+			self.conn.send(('line_dtmf', n, dtmf))
+
+	def rtp_handler(self, n: int, rtp: IPPhone) -> None:
+		if (not rtp.rtp_active):
+			return
+		rtp.read_audio()  # audio is buffered by jitter buffer, bridged line pulls it
+		dtmf = rtp.read_dtmf()
+		line = None
+		for l, r in self.bridges.items():
+			if (r == n):
+				line = self.lines[l]
+		if (line != None):
+			if ((dtmf != '') and (dtmf in common.DTMF_DIGITS)):
+				line.send_dtmf(dtmf)
+		elif (dtmf != ''):
+			self.conn.send(('ip_dtmf', n, dtmf))
+
+	def prompt_handler(self) -> bool:  # writes prompts to lines and RTP, returns True while prompts playing
+		playing = False
+		for n, ring in enumerate(self.to_line):
+			if (ring.used() != 0):
+				self.lines[n].write_linear(ring.read())
+				playing = True
+		for n, ring in enumerate(self.to_ip):
+			if (ring.used() != 0):
+				self.rtps[n].write_audio(ring.read())
+				playing = True
+		return playing
+
+	def report(self) -> None:  # sends changed line states to signaling process
+		for n, line in enumerate(self.lines):
+			status = (line.state, line.ring_counter, line.caller_id, line.busy(), line.recovering(), tuple(line.rtp_formats()))
+			if (status != self.reported[n]):
+				self.reported[n] = status
+				self.conn.send(('line', n, self.seq) + status)
+
+def media_main(conn, modem_ports: list, ip_count: int, rings: list, overrides: dict) -> None:
+	config.update(overrides)  # CONFIG_FILE values loaded by signaling process
+	MediaProcess(conn, modem_ports, ip_count, rings).run()
+	if (profiler.profiler != None):  # stages of media process were profiled
+		common.error(f'media process:\r\n{profiler.profiler.report()}')
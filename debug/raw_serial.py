@@ -0,0 +1,132 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: raw_serial.py
+# Description: Raw termios serial port of pstnxsip (posix). Same interface as the pyserial Serial methods used by line.py, reads into a preallocated ring with os.readv and writes memoryviews with os.write.
+# Author: Aydin Parin
+
+import common
+import os
+try:
+	import termios  # posix only, line.py uses pyserial when not available
+except ImportError:
+	termios = None
+
+debug = common.debug
+
+available = (termios != None)
+RX_RING_SIZE = 16384  # receive ring (2 s of voice data), a read fills free space of ring with one system call
+
+class RawSerial:
+	def __init__(self):
+		self.port: str = None
+		self.baudrate = 115200
+		self.bytesize = 8  # settings of pyserial interface, port is always 8N1 raw without flow control
+		self.parity = 'N'
+		self.stopbits = 1
+		self.timeout = 0
+		self.xonxoff = False
+		self.rtscts = False
+		self.dsrdtr = False
+		self.writeTimeout = 0
+		self.fd = -1
+		self.ring = bytearray(RX_RING_SIZE)
+		self.view = memoryview(self.ring)
+		self.empty = [self.view]  # readv buffers of empty ring, usual case when all data read
+		self.head = 0  # first unread byte of ring
+		self.count = 0  # unread bytes
+
+	@property
+	def is_open(self) -> bool:
+		return (self.fd >= 0)
+
+	def open(self) -> None:
+		self.fd = os.open(self.port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+		try:
+			iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(self.fd)
+			iflag &= ~(termios.IGNBRK | termios.BRKINT | termios.PARMRK | termios.ISTRIP | termios.INLCR | termios.IGNCR | termios.ICRNL | \
+				termios.IXON | termios.IXOFF | termios.IXANY)
+			oflag &= ~termios.OPOST
+			lflag &= ~(termios.ECHO | termios.ECHONL | termios.ICANON | termios.ISIG | termios.IEXTEN)
+			cflag &= ~(termios.CSIZE | termios.PARENB | termios.CSTOPB | getattr(termios, 'CRTSCTS', 0))
+			cflag |= (termios.CS8 | termios.CLOCAL | termios.CREAD)
+			ispeed = ospeed = getattr(termios, f'B{self.baudrate}')
+			cc[termios.VMIN] = 0  # non-blocking reads
+			cc[termios.VTIME] = 0
+			termios.tcsetattr(self.fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, ispeed, ospeed, cc])
+		except (termios.error, AttributeError):
+			os.close(self.fd)
+			self.fd = -1
+			raise
+		self.head = 0
+		self.count = 0
+		debug(f':raw_serial.open: {self.port} opened.')
+
+	def close(self) -> None:
+		if (self.fd >= 0):
+			os.close(self.fd)
+			self.fd = -1
+		self.head = 0
+		self.count = 0
+
+	def fileno(self) -> int:
+		return self.fd
+
+	def fill(self) -> None:  # reads available data into free space of ring (one system call)
+		size = len(self.ring)
+		tail = (self.head + self.count) % size
+		if (self.count == 0):
+			self.head = 0
+			buffers = self.empty
+		elif (self.count == size):  # ring full, data stays in kernel buffer
+			return
+		elif (tail >= self.head):  # free space is end of ring and start of ring before head
+			buffers = [self.view[tail:]] if (self.head == 0) else [self.view[tail:], self.view[:self.head]]
+		else:
+			buffers = [self.view[tail:self.head]]
+		try:
+			self.count += os.readv(self.fd, buffers)
+		except (BlockingIOError, InterruptedError):  # no data
+			pass
+
+	@property
+	def in_waiting(self) -> int:  # received bytes, data in kernel buffer is read into ring instead of asked by ioctl
+		self.fill()
+		return self.count
+
+	def read(self, size: int = 1) -> bytes:
+		if (self.count < size):
+			self.fill()
+		size = min(size, self.count)
+		end = self.head + size
+		if (end <= len(self.ring)):
+			data = bytes(self.view[self.head:end])
+		else:  # wraps
+			data = bytes(self.view[self.head:]) + bytes(self.view[:end - len(self.ring)])
+		self.head = end % len(self.ring)
+		self.count -= size
+		return data
+
+	def readinto(self, buffer) -> int:  # copies received bytes into buffer (bytearray or memoryview), returns byte count
+		if (self.count < len(buffer)):
+			self.fill()
+		size = min(len(buffer), self.count)
+		first = min(size, len(self.ring) - self.head)
+		buffer[:first] = self.view[self.head:self.head + first]
+		if (first < size):
+			buffer[first:size] = self.view[:size - first]
+		self.head = (self.head + size) % len(self.ring)
+		self.count -= size
+		return size
+
+	def write(self, data) -> int:  # bytes, bytearray or memoryview, returns written byte count (full kernel buffer drops the rest like pyserial with write timeout 0)
+		try:
+			return os.write(self.fd, data)
+		except (BlockingIOError, InterruptedError):
+			return 0
+
+	def reset_input_buffer(self) -> None:
+		termios.tcflush(self.fd, termios.TCIFLUSH)
+		self.head = 0
+		self.count = 0
+
+	def reset_output_buffer(self) -> None:
+		termios.tcflush(self.fd, termios.TCOFLUSH)
@@ -0,0 +1,120 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: vad.py
+# Description: Voice activity detection and comfort noise (RFC 3389) of pstnxsip RTP. PSTN audio is not sent to IP phones while the line is silent, SID packets carry the noise level instead and the receiver synthesizes comfort noise from them.
+# Author: Aydin Parin
+
+import audioop
+import common
+import g711
+import math
+import random
+from array import array
+from collections import deque
+
+debug = common.debug
+
+# frame actions of Detector.feed
+VOICE = 0  # send frame
+TALKSPURT = 1  # send frame with RTP marker bit, first voice after silence
+SID = 2  # send SID packet instead of frame
+SILENT = 3  # send nothing
+
+FULL_SCALE = 32768  # 0 dBov, 16-bit samples
+MAX_LEVEL = 127  # SID level byte, -dBov (127: digital silence)
+SPEECH_MARGIN = 6  # dB over noise floor taken as speech
+SPEECH_MIN = -60  # dBov, quieter frames are silence whatever the noise floor
+FLOOR_WINDOW = 5.0  # seconds, noise floor is the lowest frame level in window
+FLOOR_MAX = -35  # dBov, louder audio (music on hold) is never noise
+HANGOVER = 0.2  # seconds frames are still sent after speech (word endings, unvoiced consonants)
+SID_TIME = 1.0  # seconds between SID packets in silence
+SID_CHANGE = 3  # dB change of noise level sending a SID packet at once
+NOISE_SMOOTH = 0.2  # part of frame level taken into noise level
+NOISE_LEN = common.SAMPLE_FREQ  # samples of white noise table, repeated (1 s)
+NOISE_RMS = 4096  # rms of noise table
+
+def linear(audio_format: str, data: bytes) -> bytes:  # voice data to 16-bit samples
+	if (audio_format == g711.ULAW):
+		return audioop.ulaw2lin(data, 2)
+	if (audio_format == g711.ALAW):
+		return audioop.alaw2lin(data, 2)
+	return audioop.lin2lin(audioop.bias(data, 1, -128), 1, 2)
+
+def voice_data(audio_format: str, samples: bytes) -> bytes:  # 16-bit samples to voice data
+	if (audio_format == g711.ULAW):
+		return audioop.lin2ulaw(samples, 2)
+	if (audio_format == g711.ALAW):
+		return audioop.lin2alaw(samples, 2)
+	return audioop.bias(audioop.lin2lin(samples, 2, 1), 1, 128)
+
+def level(audio_format: str, data: bytes) -> float:  # rms level of voice data (dBov), -MAX_LEVEL for digital silence
+	rms = audioop.rms(linear(audio_format, data), 2)
+	return (max(20 * math.log10(rms / FULL_SCALE), -MAX_LEVEL) if (rms > 0) else -MAX_LEVEL)
+
+def sid_level(payload: bytes) -> int:  # noise level (-dBov) of a SID payload, spectral parameters are ignored
+	return ((payload[0] & 0x7F) if (len(payload) != 0) else MAX_LEVEL)
+
+class Detector:  # feed() PSTN voice data of each RTP packet, returns what to send
+	def __init__(self):
+		self.levels = deque(maxlen=int(FLOOR_WINDOW * common.SAMPLE_FREQ / common.RTP_LEN))  # frame levels of noise floor window
+		self.hangover = int(HANGOVER * common.SAMPLE_FREQ)  # samples frames are still sent, call starts sending
+		self.noise = float(-MAX_LEVEL)  # smoothed level of silent frames (dBov)
+		self.silent = 0  # samples since silence started, 0 while voice is sent
+		self.sid_sent = 0  # silent value of last SID packet
+		self.sid_level = 0  # level byte of last SID packet
+		self.frames = 0  # counters
+		self.suppressed = 0
+		self.sids = 0
+		self.talkspurts = 0
+
+	def feed(self, audio_format: str, data: bytes) -> int:  # VOICE, TALKSPURT, SID or SILENT
+		n = len(data)
+		frame_level = level(audio_format, data)
+		self.levels.append(frame_level)
+		floor = min(min(self.levels), FLOOR_MAX)
+		self.frames += 1
+		if ((frame_level > floor + SPEECH_MARGIN) and (frame_level > SPEECH_MIN)):
+			self.hangover = int(HANGOVER * common.SAMPLE_FREQ)
+		elif (self.hangover > 0):
+			self.hangover -= n
+		if (self.hangover > 0):
+			if (self.silent == 0):
+				return VOICE
+			self.silent = 0
+			self.talkspurts += 1
+			return TALKSPURT
+		self.suppressed += 1
+		self.noise += (frame_level - self.noise) * (NOISE_SMOOTH if (self.silent != 0) else 1.0)
+		sid_level = min(int(round(-self.noise)), MAX_LEVEL)
+		first = (self.silent == 0)
+		self.silent += n
+		if (first or ((self.silent - self.sid_sent) >= SID_TIME * common.SAMPLE_FREQ) or (abs(sid_level - self.sid_level) >= SID_CHANGE)):
+			self.sid_sent = self.silent
+			self.sid_level = sid_level
+			self.sids += 1
+			return SID
+		return SILENT
+
+	def sid(self) -> bytes:  # SID payload, noise level only (RFC 3389 without spectral parameters)
+		return bytes([self.sid_level])
+
+	def stats(self) -> dict:
+		return {'frames': self.frames, 'suppressed': self.suppressed, 'sid': self.sids, 'talkspurts': self.talkspurts}
+
+class ComfortNoise:  # generate() white noise at level of last SID packet received
+	table = b''  # NOISE_LEN 16-bit samples, shared by all instances
+
+	def __init__(self):
+		if (ComfortNoise.table == b''):
+			rand = random.Random(1)
+			ComfortNoise.table = array('h', [max(min(int(rand.gauss(0, NOISE_RMS)), FULL_SCALE - 1), -FULL_SCALE) for n in range(NOISE_LEN)]).tobytes()
+		self.level = MAX_LEVEL  # -dBov
+		self.position = 0  # next sample of table
+
+	def generate(self, length: int, audio_format: str) -> bytes:  # length samples of noise (in audio_format)
+		samples = bytearray()
+		while (len(samples) < 2 * length):
+			end = min(self.position + length - len(samples) // 2, NOISE_LEN)
+			samples += ComfortNoise.table[2 * self.position:2 * end]
+			self.position = end % NOISE_LEN
+		factor = FULL_SCALE * 10 ** (-self.level / 20) / NOISE_RMS
+		return voice_data(audio_format, audioop.mul(bytes(samples), 2, factor))
@@ -0,0 +1,237 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: dsp.py
+# Description: Audio processing stages of pstnxsip bridge. A pipeline of one direction (PSTN -> IP or IP -> PSTN) decodes voice data to 160 sample frames in a shared buffer, runs its stages on the buffer in place and encodes it back. Needs NumPy.
+# Author: Aydin Parin
+
+import audioop
+import common
+import g711
+import math
+import time
+try:
+	import numpy  # required, stages work on a preallocated float array
+except ImportError:
+	numpy = None
+
+debug = common.debug
+
+FRAME = 160  # samples per frame (20 ms at 8 kHz), same as modem write block and RTP payload
+FULL_SCALE = 32768  # frames carry 16-bit samples
+
+now = time.perf_counter
+
+def decode_table(audio_format: str) -> object:  # voice data byte: 16-bit sample
+	if (audio_format == g711.ULAW):
+		return numpy.frombuffer(audioop.ulaw2lin(bytes(range(256)), 2), dtype=numpy.int16).astype(numpy.float32)
+	if (audio_format == g711.ALAW):
+		return numpy.frombuffer(audioop.alaw2lin(bytes(range(256)), 2), dtype=numpy.int16).astype(numpy.float32)
+	return (numpy.arange(256, dtype=numpy.float32) - 128) * 256
+
+def encode_table(audio_format: str) -> object:  # 16-bit sample + FULL_SCALE: voice data byte
+	samples = numpy.arange(-FULL_SCALE, FULL_SCALE, dtype=numpy.int32)
+	if (audio_format == g711.ULAW):
+		return numpy.frombuffer(audioop.lin2ulaw(samples.astype(numpy.int16).tobytes(), 2), dtype=numpy.uint8)
+	if (audio_format == g711.ALAW):
+		return numpy.frombuffer(audioop.lin2alaw(samples.astype(numpy.int16).tobytes(), 2), dtype=numpy.uint8)
+	return ((samples >> 8) + 128).astype(numpy.uint8)
+
+def dbfs(level: float) -> float:
+	return (20 * math.log10(level / FULL_SCALE) if (level > 0) else -100.0)
+
+class Stage:  # processes a frame (FRAME float32 16-bit samples) in place, subclasses are listed in STAGES by name
+	name = ''
+
+	def __init__(self, arg: float = None):
+		self.cpu = 0.0  # seconds spent in process (Pipeline)
+
+	def process(self, frame: object) -> None:
+		pass
+
+	def stats(self) -> dict:  # measurements of stage, written to debug log at end of call
+		return {}
+
+class Gain(Stage):  # 'gain:6' fixed gain (dB)
+	name = 'gain'
+
+	def __init__(self, arg: float = None):
+		super().__init__(arg)
+		self.factor = 10 ** ((arg or 0.0) / 20)
+
+	def process(self, frame: object) -> None:
+		frame *= self.factor
+
+class DCRemoval(Stage):  # 'dc_removal:0.1' removes offset of modem audio, averaged over seconds (arg)
+	name = 'dc_removal'
+
+	def __init__(self, arg: float = None):
+		super().__init__(arg)
+		self.alpha = min(FRAME / ((arg or 0.1) * common.SAMPLE_FREQ), 1.0)  # part of frame mean taken into offset
+		self.offset = 0.0
+
+	def process(self, frame: object) -> None:
+		self.offset += (float(frame.mean()) - self.offset) * self.alpha
+		frame -= self.offset
+
+class HighPass(Stage):  # 'high_pass:300' second order Butterworth high-pass (cutoff Hz), removes hum and line noise below voice band
+	name = 'high_pass'
+
+	def __init__(self, arg: float = None):
+		super().__init__(arg)
+		w = 2 * math.pi * (arg or 300.0) / common.SAMPLE_FREQ
+		alpha = math.sin(w) / math.sqrt(2)  # Q = 0.707
+		a0 = 1 + alpha
+		self.b0 = (1 + math.cos(w)) / 2 / a0
+		self.b1 = -2 * self.b0
+		self.a1 = -2 * math.cos(w) / a0
+		self.a2 = (1 - alpha) / a0
+		# block recursion: y = H v + g1 y[-1] + g2 y[-2], v is the feed-forward part, H the lower triangular matrix of the
+		# poles' impulse response h and g1, g2 their zero-input responses to the last two outputs of previous frame
+		h = [1.0, -self.a1]
+		g1 = [-self.a1, self.a1 * self.a1 - self.a2]
+		g2 = [-self.a2, self.a1 * self.a2]
+		for n in range(2, FRAME):
+			h.append(-self.a1 * h[-1] - self.a2 * h[-2])
+			g1.append(-self.a1 * g1[-1] - self.a2 * g1[-2])
+			g2.append(-self.a1 * g2[-1] - self.a2 * g2[-2])
+		self.h = numpy.zeros((FRAME, FRAME), dtype=numpy.float32)
+		for n in range(FRAME):
+			self.h[n:, n] = h[:FRAME - n]
+		self.g1 = numpy.array(g1, dtype=numpy.float32)
+		self.g2 = numpy.array(g2, dtype=numpy.float32)
+		self.x = numpy.zeros(FRAME + 2, dtype=numpy.float32)  # last two inputs of previous frame and frame
+		self.v = numpy.zeros(FRAME, dtype=numpy.float32)
+		self.t = numpy.zeros(FRAME, dtype=numpy.float32)
+		self.y1 = self.y2 = 0.0
+
+	def process(self, frame: object) -> None:  # whole frame in three vector operations and a matrix product, no per-sample loop
+		x, v, t = self.x, self.v, self.t
+		x[:2] = x[FRAME:]
+		x[2:] = frame
+		numpy.add(x[2:], x[:FRAME], out=v)
+		v *= self.b0
+		numpy.multiply(x[1:FRAME + 1], self.b1, out=t)
+		v += t
+		numpy.dot(self.h, v, out=frame)
+		numpy.multiply(self.g1, self.y1, out=t)
+		frame += t
+		numpy.multiply(self.g2, self.y2, out=t)
+		frame += t
+		self.y1 = float(frame[-1])
+		self.y2 = float(frame[-2])
+
+class AGC(Stage):  # 'agc:-20' automatic gain control to a level (dBFS rms), gain ramps over frame
+	name = 'agc'
+	MAX_GAIN = 10 ** (20 / 20)  # quiet talkers raised 20 dB at most
+	MIN_GAIN = 10 ** (-12 / 20)
+	GATE = FULL_SCALE * 10 ** (-40 / 20)  # frames below -40 dBFS (pauses, idle noise of 8-bit PCM modems is about -45 dBFS) keep gain
+	ATTACK = 0.5  # part of gain change taken per frame when level is too high
+	RELEASE = 0.05  # when level is too low
+
+	def __init__(self, arg: float = None):
+		super().__init__(arg)
+		self.target = FULL_SCALE * 10 ** ((arg if (arg != None) else -20.0) / 20)
+		self.gain = 1.0
+		self.ramp = numpy.arange(FRAME, dtype=numpy.float32) / FRAME
+		self.gains = numpy.zeros(FRAME, dtype=numpy.float32)
+
+	def process(self, frame: object) -> None:
+		rms = math.sqrt(float(numpy.dot(frame, frame)) / FRAME)
+		if (rms < self.GATE):
+			frame *= self.gain
+			return
+		wanted = min(max(self.target / rms, self.MIN_GAIN), self.MAX_GAIN)
+		gain = self.gain + (wanted - self.gain) * (self.ATTACK if (wanted < self.gain) else self.RELEASE)
+		numpy.multiply(self.ramp, gain - self.gain, out=self.gains)
+		self.gains += self.gain
+		frame *= self.gains
+		self.gain = gain
+
+	def stats(self) -> dict:
+		return {'gain_db': round(20 * math.log10(self.gain), 1)}
+
+class Meter(Stage):  # 'meter' level of audio at its place in pipeline, audio is not changed
+	name = 'meter'
+	CLIP = FULL_SCALE * 0.99
+
+	def __init__(self, arg: float = None):
+		super().__init__(arg)
+		self.energy = 0.0
+		self.samples = 0
+		self.peak = 0.0
+		self.clipped = 0  # frames with a sample at full scale
+
+	def process(self, frame: object) -> None:
+		self.energy += float(numpy.dot(frame, frame))
+		self.samples += FRAME
+		peak = float(numpy.abs(frame).max())
+		if (peak > self.peak):
+			self.peak = peak
+		if (peak >= self.CLIP):
+			self.clipped += 1
+
+	def stats(self) -> dict:
+		rms = (math.sqrt(self.energy / self.samples) if (self.samples != 0) else 0.0)
+		return {'rms_dbfs': round(dbfs(rms), 1), 'peak_dbfs': round(dbfs(self.peak), 1), 'clipped': self.clipped}
+
+STAGES = {stage.name: stage for stage in (Gain, DCRemoval, HighPass, AGC, Meter)}
+
+class Pipeline:  # process() voice data of a bridge direction, complete frames pass all stages, rest waits for next data
+	def __init__(self, name: str, stages: list, audio_format: str = g711.LINEAR):
+		self.name = name
+		self.stages = stages
+		self.decode = decode_table(audio_format)
+		self.encode = encode_table(audio_format)
+		self.frame = numpy.zeros(FRAME, dtype=numpy.float32)  # shared by stages
+		self.index = numpy.zeros(FRAME, dtype=numpy.int32)  # encode table indexes of frame
+		self.pending = bytearray()  # voice data of incomplete frame
+		self.out = bytearray(FRAME * 4)  # encoded frames, reused (grows for longer reads)
+		self.out_array = numpy.frombuffer(self.out, dtype=numpy.uint8)
+		self.frames = 0
+
+	def process(self, data: bytes) -> bytes:  # returns processed voice data of complete frames (memoryview of a reused buffer, valid until next call), b'' if none
+		self.pending += data
+		size = len(self.pending) - (len(self.pending) % FRAME)
+		if (size == 0):
+			return b''
+		if (size > len(self.out)):
+			self.out = bytearray(size)
+			self.out_array = numpy.frombuffer(self.out, dtype=numpy.uint8)
+		out = self.out_array
+		frame = self.frame
+		for n in range(0, size, FRAME):
+			numpy.take(self.decode, numpy.frombuffer(self.pending, dtype=numpy.uint8, count=FRAME, offset=n), out=frame)
+			for stage in self.stages:
+				start = now()
+				stage.process(frame)
+				stage.cpu += now() - start
+			numpy.clip(frame, -FULL_SCALE, FULL_SCALE - 1, out=frame)
+			frame += FULL_SCALE + 0.5
+			self.index[:] = frame  # truncated, rounds to nearest sample
+			numpy.take(self.encode, self.index, out=out[n:n + FRAME])
+		del self.pending[:size]
+		self.frames += size // FRAME
+		return memoryview(self.out)[:size]
+
+	def stats(self) -> dict:  # CPU milliseconds per second of audio and measurements of each stage, repeated stages numbered (meter, meter.2)
+		seconds = self.frames * FRAME / common.SAMPLE_FREQ
+		stats = {}
+		for stage in self.stages:
+			name = stage.name
+			while (name in stats):
+				name = f'{stage.name}.{len([s for s in stats if s.split(".")[0] == stage.name]) + 1}'
+			stats[name] = dict({'cpu_ms_s': (round(stage.cpu * 1000 / seconds, 3) if (seconds > 0) else 0.0)}, **stage.stats())
+		return stats
+
+def pipeline(name: str, specs: list, audio_format: str) -> Pipeline:  # stages of specs ('agc:-20', 'meter'...), None when no stage (audio passes untouched)
+	if ((len(specs) == 0) or (numpy == None)):
+		if (len(specs) != 0):
+			common.error(f':dsp.pipeline: Error! {name} stages need NumPy, audio passes unprocessed.')
+		return None
+	stages = []
+	for spec in specs:
+		stage_name, _, arg = str(spec).partition(':')
+		try:
+			stages.append(STAGES[stage_name.strip()](float(arg) if (arg != '') else None))
+		except (KeyError, ValueError):
+			common.error(f':dsp.pipeline: Error! Invalid {name} stage {spec!r}, skipped (stages: {", ".join(STAGES)}).')
+	return (Pipeline(name, stages, audio_format) if (len(stages) != 0) else None)
@@ -0,0 +1,116 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: dtmf.py
+# Description: Software DTMF detector of pstnxsip. Runs a Goertzel filter bank over voice data read from modem in fixed blocks, NumPy when available, pure Python with precomputed coefficients otherwise.
+# Author: Aydin Parin
+
+import common
+import g711
+import math
+try:
+	import numpy  # optional, all blocks of a read filtered with one matrix product
+except ImportError:
+	numpy = None
+
+debug = common.debug
+
+ROW_FREQS = (697, 770, 852, 941)  # low group
+COLUMN_FREQS = (1209, 1336, 1477, 1633)  # high group
+KEYS = ('123A', '456B', '789C', '*0#D')  # KEYS[row][column]
+BLOCK = 102  # samples per Goertzel block (12.75 ms at 8 kHz), 78 Hz bins accept +-1.5% tone frequency error
+MIN_AMPLITUDE = 4  # weakest tone accepted, peak in 8-bit sample units (about -30 dB of full scale)
+MIN_POWER = MIN_AMPLITUDE * MIN_AMPLITUDE * BLOCK / 2  # tone power of a block at MIN_AMPLITUDE
+NORMAL_TWIST = 10 ** (10 / 10)  # column tone may be 10 dB weaker than row tone (8 dB sent, block estimates vary about 1 dB)
+REVERSE_TWIST = 10 ** (6 / 10)  # row tone may be 6 dB weaker than column tone (4 dB sent)
+RELATIVE_PEAK = 10 ** (6 / 10)  # other tones of a group 6 dB below strongest one
+TONE_RATIO = 0.6  # two tones carry this part of block energy at least, speech spreads over many frequencies (talk-off)
+DEBOUNCE = 2  # consecutive blocks with same result start (25.5 ms) or end a key press, a single block of a fluctuating tone or a noise burst changes nothing
+
+FREQS = ROW_FREQS + COLUMN_FREQS
+COEFFS = [2 * math.cos(2 * math.pi * f / common.SAMPLE_FREQ) for f in FREQS]  # Goertzel recurrence coefficients
+TABLES = {f: [v - 128 for v in g711.decode(f, bytes(range(256)))] for f in (g711.LINEAR, g711.ULAW, g711.ALAW)}  # voice data byte: signed sample
+if (numpy != None):
+	n = numpy.arange(BLOCK)
+	BANK = numpy.concatenate([numpy.cos(numpy.outer(n, 2 * numpy.pi * numpy.array(FREQS) / common.SAMPLE_FREQ)), \
+		numpy.sin(numpy.outer(n, 2 * numpy.pi * numpy.array(FREQS) / common.SAMPLE_FREQ))], axis=1)  # BLOCK x 16, real and imaginary parts of 8 bins
+	del n
+
+def goertzel(samples: list, coeffs: list = COEFFS) -> list:  # tone powers of one block in coefficient order, a tone gives its energy in block (sum of squares)
+	powers = []
+	for c in coeffs:
+		s1 = s2 = 0.0
+		for x in samples:
+			s1, s2 = x + c * s1 - s2, s1
+		powers.append((s1 * s1 + s2 * s2 - c * s1 * s2) * 2 / len(samples))
+	return powers
+
+def key(powers: list, energy: float) -> str:  # key of a block, '' if not a valid DTMF pair
+	row = max(range(4), key=powers.__getitem__)
+	column = max(range(4, 8), key=powers.__getitem__)
+	r = powers[row]
+	c = powers[column]
+	if ((r < MIN_POWER) or (c < MIN_POWER)):  # energy check
+		return ''
+	if ((r > c * NORMAL_TWIST) or (c > r * REVERSE_TWIST)):  # twist check
+		return ''
+	for i in range(8):
+		if ((i != row) and (i != column) and (powers[i] * RELATIVE_PEAK > (r if (i < 4) else c))):  # relative peak check
+			return ''
+	if ((r + c) < TONE_RATIO * energy):  # tones are not the most of signal
+		return ''
+	return KEYS[row][column - 4]
+
+class Detector:  # feed() voice data of a call, every key press reported once
+	def __init__(self, audio_format: str = g711.LINEAR, vectorized: bool = True):
+		self.vectorized = (vectorized and (numpy != None))
+		self.table = None
+		self.pending = bytearray()  # voice data of incomplete block
+		self.last = ''  # key of last block
+		self.count = 0  # consecutive blocks of last key
+		self.pressed = ''  # key of current key press, '' if released
+		self.digits = 0  # reported key presses
+		self.set_format(audio_format)
+
+	def set_format(self, audio_format: str) -> None:
+		self.table = numpy.array(TABLES[audio_format], dtype=numpy.float64) if (self.vectorized) else TABLES[audio_format]
+
+	def reset(self) -> None:
+		self.pending = bytearray()
+		self.last = ''
+		self.count = 0
+		self.pressed = ''
+
+	def feed(self, data: bytes) -> str:  # returns digits completed in data, usually '' or one digit
+		self.pending += data
+		blocks = len(self.pending) // BLOCK
+		if (blocks == 0):
+			return ''
+		size = blocks * BLOCK
+		if (self.vectorized):
+			samples = self.table[numpy.frombuffer(self.pending, dtype=numpy.uint8, count=size)].reshape(blocks, BLOCK)
+			bins = samples @ BANK
+			bank = (bins * bins).reshape(blocks, 2, 8).sum(axis=1) * (2 / BLOCK)
+			energies = (samples * samples).sum(axis=1).tolist()
+			powers = bank.tolist()
+		else:
+			table = self.table
+			powers = []
+			energies = []
+			for b in range(0, size, BLOCK):
+				samples = [table[v] for v in self.pending[b:b + BLOCK]]
+				powers.append(goertzel(samples))
+				energies.append(sum([x * x for x in samples]))
+		del self.pending[:size]
+		digits = ''
+		for p, energy in zip(powers, energies):
+			k = key(p, energy)
+			if (k == self.last):
+				self.count += 1
+			else:
+				self.last = k
+				self.count = 1
+			if ((self.count >= DEBOUNCE) and (k != self.pressed)):  # key pressed or released
+				self.pressed = k
+				if (k != ''):
+					digits += k
+					self.digits += 1
+		return digits
@@ -0,0 +1,141 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: echo_canceller.py
+# Description: Line echo canceller of pstnxsip. A block NLMS adaptive filter removes the echo of audio written to modem (far-end) from audio read from modem (near-end). Echo path delay is estimated by cross-correlation of both streams, adaptation is frozen in double-talk. Needs NumPy.
+# Author: Aydin Parin
+
+import audioop
+import common
+import g711
+import math
+try:
+	import numpy  # required, a block is filtered and adapted with matrix products
+	from numpy.lib.stride_tricks import sliding_window_view
+except ImportError:
+	numpy = None
+
+debug = common.debug
+
+BLOCK = 80  # near-end samples filtered with same weights (10 ms), weights adapted once per block
+MU = 1.0  # NLMS step size (0-2), block normalization keeps it stable on narrowband audio, smaller converges slower but misadjusts less in noise
+FAR_MIN_RMS = 64  # far-end quieter than this (16-bit sample units, about -54 dB of full scale) is not adapted on
+GEIGEL = 0.5  # near-end peak above this part of far-end peak is double-talk (echo return loss of line at least 6 dB)
+HANGOVER = 0.06  # seconds adaptation stays frozen after double-talk
+MAX_DELAY = 0.5  # seconds of echo path delay searched (modem FIFOs, hybrid)
+WINDOW = 0.5  # seconds of near-end audio correlated with far-end history
+ESTIMATE_TIME = 1.0  # seconds between two delay estimations
+CORRELATION_MIN = 0.3  # normalized cross-correlation peak accepted as echo path delay
+PRE_DELAY = 8  # taps kept before correlation peak (echo impulse response starts before its peak)
+
+FAR_MIN_POWER = FAR_MIN_RMS * FAR_MIN_RMS
+HANGOVER_BLOCKS = math.ceil(HANGOVER * common.SAMPLE_FREQ / BLOCK)
+WINDOW_LEN = int(WINDOW * common.SAMPLE_FREQ)
+ESTIMATE_LEN = int(ESTIMATE_TIME * common.SAMPLE_FREQ)
+
+def format_table(audio_format: str) -> object:  # voice data byte: 16-bit sample
+	if (audio_format == g711.ULAW):
+		return numpy.frombuffer(audioop.ulaw2lin(bytes(range(256)), 2), dtype=numpy.int16).astype(numpy.float32)
+	if (audio_format == g711.ALAW):
+		return numpy.frombuffer(audioop.alaw2lin(bytes(range(256)), 2), dtype=numpy.int16).astype(numpy.float32)
+	return (numpy.arange(256, dtype=numpy.float32) - 128) * 256
+
+def encode(audio_format: str, samples: object) -> bytes:  # 16-bit samples to voice data
+	if (audio_format == g711.LINEAR):
+		return (numpy.clip(numpy.rint(samples / 256), -128, 127) + 128).astype(numpy.uint8).tobytes()
+	data = numpy.clip(numpy.rint(samples), -32768, 32767).astype(numpy.int16).tobytes()
+	return (audioop.lin2ulaw(data, 2) if (audio_format == g711.ULAW) else audioop.lin2alaw(data, 2))
+
+class EchoCanceller:  # far() audio written to modem, near() returns audio read from modem without its echo
+	def __init__(self, taps: int, audio_format: str = g711.LINEAR):
+		self.taps = taps  # echo tail covered after estimated delay (128 taps: 16 ms)
+		self.audio_format = audio_format
+		self.table = format_table(audio_format)
+		self.weights = numpy.zeros(taps, dtype=numpy.float32)  # oldest far-end sample first
+		self.far_buffer = numpy.zeros(int(MAX_DELAY * common.SAMPLE_FREQ) + WINDOW_LEN + taps + BLOCK, dtype=numpy.float32)  # far-end history
+		self.far_count = 0  # far-end samples received, far_buffer ends with the last one
+		self.near_buffer = numpy.zeros(WINDOW_LEN, dtype=numpy.float32)  # near-end history for delay estimation
+		self.near_count = 0  # near-end samples received
+		self.offset = None  # far-end index of newest tap minus near-end index of filtered sample, None until delay estimated
+		self.estimate_count = WINDOW_LEN  # near_count of next delay estimation
+		self.candidate = None  # offset of last estimation, a changed delay is taken when estimated twice
+		self.hangover = 0  # blocks adaptation stays frozen
+		self.double_talk = 0  # blocks of double-talk detected
+		self.echo_energy = 0.0  # near-end and residual energy of echo only blocks (ERLE)
+		self.residual_energy = 0.0
+
+	def reset(self) -> None:  # echo path changed
+		self.weights[:] = 0
+		self.hangover = 0
+		self.echo_energy = 0.0
+		self.residual_energy = 0.0
+
+	def delay(self) -> float:  # estimated echo path delay (seconds of sample clock), None until estimated
+		return (((PRE_DELAY - self.offset) / common.SAMPLE_FREQ) if (self.offset != None) else None)
+
+	def erle(self) -> float:  # echo return loss enhancement (dB) since delay estimated
+		return (10 * math.log10(self.echo_energy / self.residual_energy) if (self.residual_energy > 0) else 0.0)
+
+	def stats(self) -> dict:
+		delay = self.delay()
+		return {'taps': self.taps, 'delay_ms': (round(delay * 1000, 1) if (delay != None) else None), 'erle_db': round(self.erle(), 1), 'double_talk': self.double_talk}
+
+	def far(self, data: bytes) -> None:  # voice data written to modem
+		samples = self.table[numpy.frombuffer(data, dtype=numpy.uint8)]
+		size = len(self.far_buffer)
+		self.far_buffer = numpy.concatenate((self.far_buffer, samples))[-size:]
+		self.far_count += len(samples)
+
+	def near(self, data: bytes) -> bytes:  # voice data read from modem, echo removed when delay estimated
+		d = self.table[numpy.frombuffer(data, dtype=numpy.uint8)]
+		n = len(d)
+		self.near_buffer = numpy.concatenate((self.near_buffer, d))[-WINDOW_LEN:]
+		self.near_count += n
+		if (self.near_count >= self.estimate_count):
+			self.estimate_count = self.near_count + ESTIMATE_LEN
+			self.estimate()
+		if (self.offset == None):
+			return data
+		index = self.near_count - n
+		return encode(self.audio_format, numpy.concatenate([self.filter(d[b:b + BLOCK], index + b) for b in range(0, n, BLOCK)]))
+
+	def filter(self, d: object, index: int) -> object:  # residual of a near-end block starting at near-end sample index
+		m = len(d)
+		first = self.far_count - len(self.far_buffer)  # far-end index of far_buffer[0]
+		start = index + self.offset - self.taps + 1 - first
+		end = index + self.offset + m - first
+		if ((start < 0) or (end > len(self.far_buffer))):  # far-end audio not available (transmit not started yet)
+			return d
+		x = self.far_buffer[start:end]
+		rows = sliding_window_view(x, self.taps)  # m x taps, far-end samples of each near-end sample
+		e = d - rows @ self.weights
+		power = numpy.dot(x, x) / len(x)
+		if (numpy.abs(d).max() > GEIGEL * numpy.abs(x).max()):  # Geigel detector, near-end talker louder than echo can be
+			self.hangover = HANGOVER_BLOCKS
+			self.double_talk += 1
+		elif (self.hangover > 0):
+			self.hangover -= 1
+		elif (power >= FAR_MIN_POWER):
+			self.weights += (MU / (self.taps * power * m)) * (e @ rows)
+			self.echo_energy += float(numpy.dot(d, d))
+			self.residual_energy += float(numpy.dot(e, e))
+		return e
+
+	def estimate(self) -> None:  # echo path delay by cross-correlation of near-end window with far-end history
+		far = self.far_buffer.astype(numpy.float64)
+		near = self.near_buffer.astype(numpy.float64)
+		near_energy = numpy.dot(near, near)
+		if (near_energy < WINDOW_LEN * FAR_MIN_POWER):  # no echo heard
+			return
+		size = 1 << (len(far) + WINDOW_LEN - 1).bit_length()
+		correlation = numpy.fft.irfft(numpy.fft.rfft(far, size) * numpy.conj(numpy.fft.rfft(near, size)), size)[:len(far) - WINDOW_LEN + 1]
+		energies = numpy.cumsum(numpy.concatenate(([0.0], far * far)))
+		energies = energies[WINDOW_LEN:] - energies[:-WINDOW_LEN]  # far-end energy of each window position
+		correlation = numpy.abs(correlation) / numpy.sqrt(numpy.maximum(energies, WINDOW_LEN * FAR_MIN_POWER) * near_energy)
+		k = int(numpy.argmax(correlation))
+		if (correlation[k] < CORRELATION_MIN):  # near-end talker or noise, not echo
+			return
+		offset = (self.far_count - len(far) + k) - (self.near_count - WINDOW_LEN) + PRE_DELAY
+		confirmed = ((self.offset == None) or ((self.candidate != None) and (abs(offset - self.candidate) <= PRE_DELAY // 2)))
+		self.candidate = offset
+		if (confirmed and ((self.offset == None) or (abs(offset - self.offset) > PRE_DELAY // 2))):
+			self.offset = offset
+			self.reset()
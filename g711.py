@@ -0,0 +1,33 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: g711.py
+# Description: Voice data formats of pstnxsip. Converts between 8-bit unsigned linear audio (prompts, recording, concealment) and G.711 mu-law/A-law data of modems and RTP, same formats pass without conversion.
+# Author: Aydin Parin
+
+import audioop
+
+LINEAR = 'pcm'  # 8-bit unsigned linear, 0x80 biased (AT+VSM unsigned pcm, wav files)
+ULAW = 'ulaw'  # G.711 mu-law (RTP PCMU)
+ALAW = 'alaw'  # G.711 A-law (RTP PCMA)
+SILENCE = {LINEAR: 0x80, ULAW: 0xFF, ALAW: 0xD5}  # zero level sample
+
+def decode(audio_format: str, data: bytes) -> bytes:  # to linear, linear data returned as is
+	if (audio_format == ULAW):
+		return audioop.bias(audioop.ulaw2lin(data, 1), 1, 128)
+	if (audio_format == ALAW):
+		return audioop.bias(audioop.alaw2lin(data, 1), 1, 128)
+	return data
+
+def encode(audio_format: str, data: bytes) -> bytes:  # from linear, linear data returned as is
+	if (audio_format == ULAW):
+		return audioop.lin2ulaw(audioop.bias(data, 1, -128), 1)
+	if (audio_format == ALAW):
+		return audioop.lin2alaw(audioop.bias(data, 1, -128), 1)
+	return data
+
+def transcode(source: str, target: str, data: bytes) -> bytes:  # passthrough (no copy) when formats are same
+	if (source == target):
+		return data
+	return encode(target, decode(source, data))
+
+def silence(audio_format: str, length: int) -> bytes:
+	return bytes([SILENCE[audio_format]]) * length
@@ -0,0 +1,560 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: modem_emulator.py
+# Description: CX93010 USB modem emulator of pstnxsip. Creates pseudo terminals answering the AT commands used by line.py and streams DLE shielded voice data in real time, for tests without modem hardware (Linux, macOS).
+# Author: Aydin Parin
+
+from typing import Callable
+import argparse
+import common
+import heapq
+import math
+import os
+import pty
+import random
+import selectors
+import signal
+import sys
+import time
+import tty
+try:
+	import audioop  # removed in python 3.13, 'pip install audioop-lts' (G.711 voice compression only)
+except ImportError:
+	audioop = None
+
+debug = common.debug
+
+SAMPLE_FREQ = 8000
+FRAME_TIME = 0.02  # voice data written to DTE every 20 ms
+FRAME_LEN = int(SAMPLE_FREQ * FRAME_TIME)
+TX_FIFO_SIZE = 8192  # modem transmit buffer (bytes), data above it is dropped
+RING_PERIOD = 5.0  # seconds between two RINGs
+CID_DELAY = 0.2  # caller ID report after first RING
+DTMF_TIME = 0.1  # DTMF tone length in voice data
+BUSY_REPORT_TIME = 1.0  # busy tone played this long before <DLE>b reported
+REOPEN_POLL_TIME = 0.1  # pty checked for DTE open while closed
+COUNTRY_TABLE = 'documents/ModemTablesFromPDF.txt'  # in project folder (or its parent for debug folder)
+MANUFACTURER = 'CONEXANT'
+MODEL = 'CX93010-2x UCMxx'
+
+DLE = 0x10
+ETX = 0x03
+RESULT_CODES = {'OK': 0, 'CONNECT': 1, 'RING': 2, 'NO CARRIER': 3, 'ERROR': 4, 'BUSY': 7}  # ATV0 numeric codes
+VOICE_COMPRESSIONS = {0: 'SIGNED PCM', 1: 'UNSIGNED PCM', 4: 'G711U', 5: 'G711A'}  # +VSM methods, 8 bits per sample
+DTMF_FREQS = {'1': (697, 1209), '2': (697, 1336), '3': (697, 1477), 'A': (697, 1633), '4': (770, 1209), '5': (770, 1336), '6': (770, 1477), 'B': (770, 1633), \
+	'7': (852, 1209), '8': (852, 1336), '9': (852, 1477), 'C': (852, 1633), '*': (941, 1209), '0': (941, 1336), '#': (941, 1477), 'D': (941, 1633)}
+BUSY_TONE = ((480, 620), 0.5, 0.5)  # frequencies, on and off seconds (North America, CEPT uses 425 Hz)
+
+def country_codes() -> set:  # +GCI codes of documents/ModemTablesFromPDF.txt 'Default Countries Supported' table, None if not found
+	folder = os.path.dirname(os.path.abspath(__file__))
+	text = None
+	for name in (os.path.join(folder, COUNTRY_TABLE), os.path.join(os.path.dirname(folder), COUNTRY_TABLE)):
+		try:
+			with open(name, 'r', encoding='utf8') as f:
+				text = f.read()
+			break
+		except OSError:
+			pass
+	if (text == None):
+		return None
+	codes = set()
+	table = text[text.find('Country\tCountry Code'):].splitlines()[1:]
+	for row in table:
+		fields = row.split()
+		if (len(fields) < 2):
+			break
+		codes.add(fields[-1].upper().rjust(2, '0'))
+	return codes
+
+class Scheduler:  # real time events of emulated modems, one thread
+	def __init__(self):
+		self.selector = selectors.DefaultSelector()
+		self.events = []  # heap of (time, sequence, callback)
+		self.seq = 0
+
+	def call_at(self, t: float, callback: Callable) -> list:  # returns event, cancel() sets its callback to None
+		self.seq += 1
+		event = [t, self.seq, callback]
+		heapq.heappush(self.events, event)
+		return event
+
+	def call_later(self, delay: float, callback: Callable) -> list:
+		return self.call_at(time.monotonic() + delay, callback)
+
+	def cancel(self, event: list) -> None:
+		if (event != None):
+			event[2] = None
+		return None
+
+	def run(self, until: Callable = None) -> None:  # runs until predicate true (forever if None)
+		while ((until == None) or (not until())):
+			timeout = None
+			if (self.events != []):
+				timeout = max(self.events[0][0] - time.monotonic(), 0)
+			for key, mask in self.selector.select(timeout):
+				key.data()
+			now = time.monotonic()
+			while ((self.events != []) and (self.events[0][0] <= now)):
+				t, seq, callback = heapq.heappop(self.events)
+				if (callback != None):
+					callback()
+
+class ModemEmulator:  # one emulated modem on a pseudo terminal, port is the device name given to Line (MODEM_PORTS)
+	def __init__(self, scheduler: Scheduler, link: str = None):
+		self.scheduler = scheduler
+		self.master, self.slave = pty.openpty()
+		tty.setraw(self.slave)
+		os.set_blocking(self.master, False)
+		self.port = os.ttyname(self.slave)
+		self.link = link
+		if (link != None):  # stable name, i.e. /tmp/ttyACM0
+			if (os.path.lexists(link)):
+				os.remove(link)
+			os.symlink(self.port, link)
+			self.port = link
+		self.countries = country_codes()
+		self.scheduler.selector.register(self.master, selectors.EVENT_READ, self.readable)
+		self.reopen_event: list = None
+		self.command = bytearray()
+		self.tx_pending = False  # voice data ended with <DLE>
+		self.ring_event: list = None
+		self.busy_event: list = None
+		self.frame_event: list = None
+		self.stats = {'calls': 0, 'rings': 0, 'dialed': [], 'dtmf_sent': '', 'rx_bytes': 0, 'tx_bytes': 0, 'tx_underruns': 0, 'tx_overruns': 0, \
+			'rx_overruns': 0, 'commands': 0, 'errors': 0}
+		self.reset()
+
+	def reset(self) -> None:  # AT&F0 factory defaults
+		self.echo = True
+		self.verbose = True
+		self.fclass = 0
+		self.country = 'B5'
+		self.cid_format = 0
+		self.compression = 1
+		self.off_hook = False
+		self.settings = {}  # other accepted commands, i.e. +VGR
+		self.stop_voice()
+		self.ring_event = self.scheduler.cancel(self.ring_event)
+		self.rings = 0
+		self.caller_id = None  # (number, name) of last call
+
+	# DTE -> modem
+	def readable(self) -> None:
+		try:
+			data = os.read(self.master, 4096)
+		except BlockingIOError:
+			return
+		except OSError:  # DTE closed the port (Linux EIO), wait until opened again
+			self.scheduler.selector.unregister(self.master)
+			self.reopen_event = self.scheduler.call_later(REOPEN_POLL_TIME, self.reopen)
+			return
+		if (self.voice):
+			self.voice_data(data)
+		else:
+			self.command_data(data)
+
+	def reopen(self) -> None:
+		self.reopen_event = None
+		self.scheduler.selector.register(self.master, selectors.EVENT_READ, self.readable)
+
+	def command_data(self, data: bytes) -> None:
+		self.command += data
+		while (True):
+			end = self.command.find(b'\r')
+			if (end < 0):
+				break
+			line = self.command[:end].decode('ascii', 'replace').strip()
+			del self.command[:end + 1]
+			if (self.command[:1] == b'\n'):
+				del self.command[:1]
+			if (line == ''):
+				continue
+			if (self.echo):
+				self.write((line + '\r').encode('ascii'))
+			self.at_command(line)
+			if (self.voice):  # rest of data is voice data
+				data = bytes(self.command)
+				self.command.clear()
+				self.voice_data(data)
+				return
+
+	def at_command(self, line: str) -> None:
+		self.stats['commands'] += 1
+		cmd = line.upper()
+		if (not cmd.startswith('AT')):
+			return self.result('ERROR')
+		cmd = cmd[2:]
+		if (cmd in ('', 'Z', '&F', '&F0')):
+			if (cmd != ''):
+				self.reset()
+			return self.result('OK')
+		if (cmd in ('E0', 'E1')):
+			self.echo = (cmd == 'E1')
+		elif (cmd in ('V0', 'V1')):
+			self.verbose = (cmd == 'V1')
+		elif (cmd in ('H', 'H0')):
+			self.on_hook()
+		elif (cmd.startswith('D')):
+			return self.dial(line[3:])
+		elif (cmd in ('+GMI', '+FMI?')):
+			self.info(MANUFACTURER)
+		elif (cmd in ('+GMM', '+FMM?')):
+			self.info(MODEL)
+		elif (cmd.startswith('+GCI')):
+			return self.set_country(cmd[4:])
+		elif (cmd.startswith('+FCLASS')):
+			return self.set_class(cmd[7:])
+		elif (cmd.startswith('+VCID=')):
+			if (cmd[6:] not in ('0', '1', '2')):
+				return self.result('ERROR')
+			self.cid_format = int(cmd[6:])
+		elif (cmd == '+VRID=0'):
+			return self.report_caller_id()
+		elif (cmd.startswith('+VSM')):
+			return self.set_compression(cmd[4:])
+		elif (cmd.startswith('+VLS=')):
+			if ((self.fclass != 8) or (cmd[5:] not in ('0', '1'))):
+				return self.result('ERROR')
+			if (cmd[5:] == '1'):
+				self.off_hook = True
+				self.ring_event = self.scheduler.cancel(self.ring_event)
+			else:
+				self.on_hook()
+		elif (cmd == '+VTR'):
+			if ((self.fclass != 8) or (not self.off_hook)):
+				return self.result('ERROR')
+			self.result('CONNECT')
+			return self.start_voice()
+		elif (cmd.startswith('+VTS=')):
+			if ((self.fclass != 8) or (not self.off_hook)):
+				return self.result('ERROR')
+			self.stats['dtmf_sent'] += cmd[5:].strip('[]{}').replace(',', '')
+		elif (cmd[:4] in ('+VSD', '+VTD', '+VGR', '+VGT', '+VIP', '+VNH', '+VIT', '+VRA', '+VRN')):
+			self.settings[cmd[:4]] = cmd[5:]
+		else:
+			return self.result('ERROR')
+		self.result('OK')
+
+	def result(self, code: str) -> None:
+		if (code == 'ERROR'):
+			self.stats['errors'] += 1
+		if (self.verbose):
+			self.write(f'\r\n{code}\r\n'.encode('ascii'))
+		else:
+			self.write(f'{RESULT_CODES[code]}\r'.encode('ascii'))
+
+	def info(self, text: str) -> None:
+		self.write(f'\r\n{text}\r\n'.encode('ascii'))
+
+	def set_country(self, arg: str) -> None:
+		if (arg == '?'):
+			self.info(f'+GCI: {self.country}')
+		elif (arg == '=?'):
+			self.info(f'+GCI: ({",".join(sorted(self.countries or [self.country]))})')
+		elif (arg.startswith('=') and ((self.countries == None) or (arg[1:].rjust(2, '0') in self.countries))):
+			self.country = arg[1:].rjust(2, '0')
+		else:
+			return self.result('ERROR')
+		self.result('OK')
+
+	def set_class(self, arg: str) -> None:
+		if (arg == '?'):
+			self.info(str(self.fclass))
+		elif (arg == '=?'):
+			self.info('0,1,1.0,8')
+		elif (arg in ('=0', '=1', '=1.0', '=8')):
+			self.fclass = int(float(arg[1:]))
+			if (self.fclass != 8):
+				self.off_hook = False
+		else:
+			return self.result('ERROR')
+		self.result('OK')
+
+	def set_compression(self, arg: str) -> None:
+		if (arg == '?'):
+			self.info(f'{self.compression},8000,0,0')
+		elif (arg == '=?'):
+			self.info('\r\n'.join([f'{n},"{name}",8,0,(8000),(0),(0)' for n, name in VOICE_COMPRESSIONS.items()]))
+		elif (arg.startswith('=')):
+			params = arg[1:].split(',')
+			if ((self.fclass != 8) or (not params[0].isdigit()) or (int(params[0]) not in VOICE_COMPRESSIONS) or (params[1:2] not in ([], ['8000']))):
+				return self.result('ERROR')
+			if ((int(params[0]) in (4, 5)) and (audioop == None)):
+				return self.result('ERROR')
+			self.compression = int(params[0])
+		else:
+			return self.result('ERROR')
+		self.result('OK')
+
+	def dial(self, number: str) -> None:  # ATD<number>; voice dial returns to command mode
+		voice = number.strip().endswith(';')
+		number = number.strip().rstrip(';')
+		self.stats['dialed'].append(number)
+		self.off_hook = True
+		if (not voice):  # data call, no carrier emulated
+			self.off_hook = False
+			return self.result('NO CARRIER')
+		self.result('OK')
+
+	def on_hook(self) -> None:
+		self.off_hook = False
+		self.stop_voice()
+
+	def report_caller_id(self) -> None:
+		if (self.caller_id == None):
+			return self.result('OK')
+		number, name = self.caller_id
+		report = '\r\nDATE=0101\r\nTIME=1200\r\n' + f'NMBR={number}\r\n' + (f'NAME={name}\r\n' if (name != '') else '')
+		self.write(report.encode('ascii') + b'\r\n')
+		self.result('OK')
+
+	# voice mode
+	def start_voice(self) -> None:
+		self.voice = True
+		self.tx_pending = False
+		self.tx_fifo = 0.0
+		self.tx_time = time.monotonic()
+		self.tx_started = False
+		self.rx_events = bytearray()  # <DLE> codes sent with next frame
+		self.tones = []  # (frequencies, start time, end time) added to voice data
+		self.noise = 0
+		self.stats['calls'] += 1
+		self.frame_time = time.monotonic()
+		self.frame_event = self.scheduler.call_at(self.frame_time, self.voice_frame)
+
+	def stop_voice(self) -> None:
+		self.voice = False
+		self.frame_event = self.scheduler.cancel(self.frame_event)
+		self.busy_event = self.scheduler.cancel(self.busy_event)
+
+	def voice_data(self, data: bytes) -> None:  # modem transmit, <DLE>^ or <DLE>! ends voice mode
+		self.drain()
+		audio = 0
+		n = 0
+		if (self.tx_pending):
+			self.tx_pending = False
+			n = 1
+			if (data[:1] == b'\x10'):
+				audio += 1
+			elif (self.voice_command(data[0])):
+				return self.command_data(data[1:])
+		while (n < len(data)):
+			dle = data.find(DLE, n)
+			if (dle < 0):
+				audio += len(data) - n
+				break
+			audio += dle - n
+			if ((dle + 1) == len(data)):
+				self.tx_pending = True
+				break
+			if (data[dle + 1] == DLE):
+				audio += 1
+			elif (self.voice_command(data[dle + 1])):
+				self.fill(audio)
+				return self.command_data(data[dle + 2:])
+			n = dle + 2
+		self.fill(audio)
+
+	def voice_command(self, code: int) -> bool:  # <DLE> code from DTE, True if voice mode ended
+		if (code in (ord('^'), ord('!'), ETX)):
+			self.stop_voice()
+			self.write(bytes([DLE, ETX]))
+			return True
+		if (code == 0x18):  # <CAN> clear transmit buffer
+			self.tx_fifo = 0.0
+		return False
+
+	def drain(self) -> None:  # modem plays transmit buffer at sample rate, empty buffer is an underrun
+		now = time.monotonic()
+		self.tx_fifo -= (now - self.tx_time) * SAMPLE_FREQ
+		self.tx_time = now
+		if (self.tx_fifo < 0):
+			if (self.tx_started):
+				self.underrun()
+			self.tx_started = False
+			self.tx_fifo = 0.0
+
+	def fill(self, length: int) -> None:
+		self.stats['tx_bytes'] += length
+		self.tx_fifo += length
+		self.tx_started = (self.tx_started or (length != 0))
+		if (self.tx_fifo > TX_FIFO_SIZE):
+			self.stats['tx_overruns'] += 1
+			self.tx_fifo = TX_FIFO_SIZE
+
+	def underrun(self) -> None:
+		self.stats['tx_underruns'] += 1
+		self.rx_events += bytes([DLE, ord('u')])
+
+	def voice_frame(self) -> None:  # one frame of voice data every FRAME_TIME, scheduled on absolute times (no drift)
+		self.frame_time += FRAME_TIME
+		self.frame_event = self.scheduler.call_at(self.frame_time, self.voice_frame)
+		self.drain()
+		t = self.frame_time - FRAME_TIME
+		samples = []
+		for n in range(FRAME_LEN):
+			v = random.gauss(0, 2)  # line noise
+			st = t + n / SAMPLE_FREQ
+			for freqs, start, end in self.tones:
+				if (start <= st < end):
+					v += sum([40 * math.sin(2 * math.pi * f * st) for f in freqs])
+			samples.append(max(-128, min(127, int(v))))
+		self.tones = [tone for tone in self.tones if (tone[2] > t)]
+		if (self.compression == 0):
+			audio = bytes([v & 0xFF for v in samples])
+		elif (self.compression == 1):
+			audio = bytes([v + 128 for v in samples])
+		else:
+			linear = bytes([v & 0xFF for v in samples])
+			audio = audioop.lin2ulaw(linear, 1) if (self.compression == 4) else audioop.lin2alaw(linear, 1)
+		data = bytes(self.rx_events) + audio.replace(b'\x10', b'\x10\x10')
+		self.rx_events.clear()
+		if (self.write(data)):
+			self.stats['rx_bytes'] += len(audio)
+		else:  # DTE does not read, modem receive buffer overrun
+			self.stats['rx_overruns'] += 1
+			self.rx_events += bytes([DLE, ord('o')])
+
+	def write(self, data: bytes) -> bool:
+		try:
+			os.write(self.master, data)
+		except (BlockingIOError, OSError):
+			return False
+		return True
+
+	# scripted PSTN events
+	def ring(self, number: str = '', name: str = '', count: int = 0) -> None:  # incoming call, count 0 rings until answered
+		self.caller_id = (number, name) if (number != '') else None
+		self.rings = count
+		self.ring_event = self.scheduler.cancel(self.ring_event)
+		self.ring_once(True)
+
+	def ring_once(self, first: bool = False) -> None:
+		self.ring_event = None
+		if (self.off_hook):
+			return
+		self.stats['rings'] += 1
+		self.write(b'\r\nRING\r\n' if self.verbose else b'2\r')
+		if (first and (self.caller_id != None) and (self.cid_format != 0)):
+			self.scheduler.call_later(CID_DELAY, lambda: self.off_hook or self.write(f'\r\nNMBR={self.caller_id[0]}\r\n'.encode('ascii')))
+		if (self.rings != 1):
+			self.rings = max(self.rings - 1, 0)
+			self.ring_event = self.scheduler.call_later(RING_PERIOD, self.ring_once)
+
+	def dtmf(self, digits: str) -> None:  # PSTN party presses keys, tone in voice data and <DLE>/<DLE>digit<DLE>~ reports
+		if (not self.voice):
+			return
+		start = max(self.frame_time, time.monotonic())
+		for n, digit in enumerate(digits.upper()):
+			t = start + n * 2 * DTMF_TIME
+			self.tones.append((DTMF_FREQS[digit], t, t + DTMF_TIME))
+			self.scheduler.call_at(t, lambda d=digit: self.voice and self.rx_events.extend(bytes([DLE, ord('/'), DLE, ord(d)])))
+			self.scheduler.call_at(t + DTMF_TIME, lambda: self.voice and self.rx_events.extend(bytes([DLE, ord('~')])))
+
+	def busy(self, report: bool = True) -> None:  # PSTN party hangs up, busy tone until on hook, <DLE>b after BUSY_REPORT_TIME
+		if (not self.voice):
+			return
+		freqs, on, off = BUSY_TONE
+		start = max(self.frame_time, time.monotonic())
+		for n in range(int(120 / (on + off))):
+			t = start + n * (on + off)
+			self.tones.append((freqs, t, t + on))
+		if (report):
+			self.busy_event = self.scheduler.call_later(BUSY_REPORT_TIME, lambda: self.voice and self.rx_events.extend(bytes([DLE, ord('b')])))
+
+	def report(self) -> str:
+		return f'{self.port}: ' + ', '.join([f'{k}={v}' for k, v in self.stats.items()])
+
+	def close(self) -> None:
+		self.stop_voice()
+		self.scheduler.cancel(self.reopen_event)
+		if (self.reopen_event == None):
+			self.scheduler.selector.unregister(self.master)
+		os.close(self.master)
+		os.close(self.slave)
+		if (self.link != None):
+			os.remove(self.link)
+
+SCRIPT_HELP = """script lines (one step per line, lines starting with # are comments), run on every modem:
+  ring NUMBER [COUNT] [NAME]   incoming call with caller ID (NUMBER - for none), COUNT rings (0 until answered)
+  voice [TIMEOUT]              wait until gateway starts voice mode (answered or dialed out)
+  wait SECONDS                 wait
+  dtmf DIGITS                  PSTN party presses keys
+  busy [quiet]                 PSTN party hangs up, busy tone (quiet: no <DLE>b report, tone only)
+  underrun                     inject a <DLE>u transmit underrun report
+  idle [TIMEOUT]               wait until voice mode ends
+  repeat [COUNT]               run script from beginning again (forever without COUNT)"""
+
+def run_script(modem: ModemEmulator, steps: list) -> None:  # steps of script as a coroutine on scheduler
+	def runner():
+		loops = 0
+		n = 0
+		while (n < len(steps)):
+			step = steps[n]
+			n += 1
+			name, args = step[0], step[1:]
+			if (name == 'ring'):
+				modem.ring('' if (args[0] == '-') else args[0], ' '.join(args[2:]), int(args[1]) if (len(args) > 1) else 0)
+			elif (name in ('voice', 'idle')):
+				deadline = time.monotonic() + (float(args[0]) if (args != []) else 3600)
+				while ((modem.voice != (name == 'voice')) and (time.monotonic() < deadline)):
+					yield 0.05
+			elif (name == 'wait'):
+				yield float(args[0])
+			elif (name == 'dtmf'):
+				modem.dtmf(args[0])
+			elif (name == 'busy'):
+				modem.busy(args[:1] != ['quiet'])
+			elif (name == 'underrun'):
+				if (modem.voice):
+					modem.underrun()
+			elif (name == 'repeat'):
+				loops += 1
+				if ((args == []) or (loops < int(args[0]))):
+					n = 0
+
+	steps_runner = runner()
+
+	def step():
+		try:
+			delay = next(steps_runner)
+		except StopIteration:
+			return
+		modem.scheduler.call_later(delay, step)
+
+	modem.scheduler.call_later(0, step)
+
+def parse_script(text: str) -> list:
+	steps = []
+	for line in text.splitlines():
+		fields = line.split()
+		if ((fields != []) and (not fields[0].startswith('#'))):  # comment lines start with #, DTMF digits can be #
+			steps.append([fields[0].lower()] + fields[1:])
+	return steps
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='pstnxsip CX93010 modem emulator on pseudo terminals', epilog=SCRIPT_HELP, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--count', type=int, default=1, help='number of modems')
+	parser.add_argument('--link', default=None, help='symbolic link names of ports, modem number appended (i.e. /tmp/ttyEMU gives /tmp/ttyEMU0)')
+	parser.add_argument('--script', default=None, help='script file run on every modem')
+	parser.add_argument('--ring', default=None, help='one incoming call with this caller ID, then wait (same as script "ring NUMBER")')
+	args = parser.parse_args()
+	scheduler = Scheduler()
+	modems = [ModemEmulator(scheduler, (args.link + str(n)) if (args.link != None) else None) for n in range(args.count)]
+	print('MODEM_PORTS = [' + ', '.join([repr(m.port) for m in modems]) + ']')
+	steps = []
+	if (args.script != None):
+		with open(args.script, 'r') as f:
+			steps = parse_script(f.read())
+	elif (args.ring != None):
+		steps = [['ring', args.ring]]
+	for m in modems:
+		run_script(m, steps)
+	signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))  # reports printed when stopped by CI
+	try:
+		scheduler.run()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		for m in modems:
+			print(m.report())
+			m.close()
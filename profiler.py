@@ -0,0 +1,183 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: profiler.py
+# Description: Loop profiler of pstnxsip. Times loop stages into latency histograms and exports a Chrome trace of one call. Installed only when PROFILE is True.
+# Author: Aydin Parin
+
+from typing import Callable
+import common
+import json
+import math
+import os
+import threading
+import time
+
+debug = common.debug
+
+BUCKET_MIN = 1e-6  # first histogram bucket upper bound (1 us)
+BUCKETS_PER_OCTAVE = 4  # bucket upper bounds grow by 2^(1/4), ~19% resolution
+BUCKET_COUNT = 96  # up to ~16 sec, slower samples counted in the last bucket
+MAX_TRACE_EVENTS = 500000  # trace recording stops when full
+REPORT_TIME = 60  # seconds between periodic reports (console and debug.log)
+
+now = time.perf_counter
+
+class Histogram:  # fixed bucket latency histogram
+	def __init__(self):
+		self.counts = [0] * BUCKET_COUNT
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def record(self, seconds: float) -> None:
+		b = 0
+		if (seconds > BUCKET_MIN):
+			b = min(math.ceil(math.log2(seconds / BUCKET_MIN) * BUCKETS_PER_OCTAVE), BUCKET_COUNT - 1)
+		self.counts[b] += 1
+		self.count += 1
+		self.total += seconds
+		if (seconds > self.max):
+			self.max = seconds
+
+	def percentile(self, p: float) -> float:  # upper bound of bucket containing p percent of samples
+		if (self.count == 0):
+			return 0.0
+		limit = self.count * p / 100
+		n = 0
+		for b, c in enumerate(self.counts):
+			n += c
+			if (n >= limit):
+				return min(bucket_bound(b), self.max)
+		return self.max
+
+def bucket_bound(b: int) -> float:
+	return BUCKET_MIN * (2 ** (b / BUCKETS_PER_OCTAVE))
+
+class Profiler:
+	def __init__(self, trace_file: str = ''):
+		self.stages = {}  # stage name: Histogram
+		self.passes = 0
+		self.overruns = 0  # loop passes longer than LOOP_TIME
+		self.trace_file = trace_file
+		self.trace_events = []
+		self.tracing = False
+		self.traced_session = None
+		self.start = now()
+
+	def stage(self, name: str) -> Histogram:
+		if (name not in self.stages):
+			self.stages[name] = Histogram()
+		return self.stages[name]
+
+	def wrap(self, name: str, func: Callable) -> Callable:  # returns func timed as stage name
+		histogram = self.stage(name)
+		def timed(*args, **kwargs):
+			t = now()
+			try:
+				return func(*args, **kwargs)
+			finally:
+				d = now() - t
+				histogram.record(d)
+				if (self.tracing):
+					self.trace(name, t, d)
+		timed.__wrapped__ = func
+		return timed
+
+	def wrap_pass(self, func: Callable) -> Callable:  # one loop pass (all handlers), counts LOOP_TIME overruns
+		timed = self.wrap('loop_pass', func)
+		def counted(*args, **kwargs):
+			t = now()
+			result = timed(*args, **kwargs)
+			self.passes += 1
+			if ((now() - t) > common.LOOP_TIME):
+				self.overruns += 1
+			return result
+		counted.__wrapped__ = func
+		return counted
+
+	def trace(self, name: str, t: float, d: float) -> None:  # Chrome trace-event complete event
+		if (len(self.trace_events) >= MAX_TRACE_EVENTS):
+			self.tracing = False
+			return
+		self.trace_events.append({'name': name, 'ph': 'X', 'ts': round((t - self.start) * 1e6, 1), 'dur': round(d * 1e6, 1), 'pid': os.getpid(), 'tid': threading.get_ident()})
+
+	def start_trace(self, session: object) -> None:  # first call is traced
+		if ((self.trace_file == '') or (self.traced_session != None)):
+			return
+		self.traced_session = session
+		self.tracing = True
+
+	def stop_trace(self, session: object) -> None:
+		if ((session is not self.traced_session) or (not self.tracing)):
+			return
+		self.tracing = False
+		with open(self.trace_file, 'w') as f:
+			json.dump({'traceEvents': self.trace_events, 'displayTimeUnit': 'ms'}, f)
+		self.trace_events = []
+
+	def report(self) -> str:
+		lines = [f'{"stage":<22} {"count":>9} {"p50 ms":>8} {"p99 ms":>8} {"max ms":>8}']
+		for name, h in self.stages.items():
+			if (h.count != 0):
+				lines.append(f'{name:<22} {h.count:>9} {h.percentile(50) * 1000:>8.3f} {h.percentile(99) * 1000:>8.3f} {h.max * 1000:>8.3f}')
+		lines.append(f'loop passes over LOOP_TIME ({common.LOOP_TIME * 1000:.0f} ms): {self.overruns} of {self.passes}')
+		return '\r\n'.join(lines)
+
+profiler: Profiler = None  # installed profiler, None when profiling disabled
+
+def record(name: str, seconds: float) -> None:  # call latency measured by line or ip phone, kept as a stage when profiling
+	if (profiler != None):
+		profiler.stage(name).record(seconds)
+
+def patch(owner: object, attr: str, name: str) -> None:
+	setattr(owner, attr, profiler.wrap(name, getattr(owner, attr)))
+
+def install(pstnxsip: object) -> Profiler:  # wraps loop stages with timers, nothing is changed when not installed
+	global profiler
+	from ip_phone import IPPhone
+	from line import Line
+	from call_session import CallSession
+	import call_progress
+	import dsp
+	import dtmf
+	import echo_canceller
+	import vad
+	import atexit
+	import timers
+	if (profiler != None):
+		return profiler
+	profiler = Profiler(common.PROFILE_TRACE_FILE)
+	patch(pstnxsip, 'main_handler', 'main_handler')
+	patch(Line, 'handler', 'Line.handler')
+	patch(Line, 'read_audio', 'Line.read_audio')
+	patch(Line, 'write_audio', 'Line.write_audio')
+	patch(Line, 'tx_pace', 'Line.tx_pace')
+	patch(dtmf.Detector, 'feed', 'dtmf.feed')
+	patch(call_progress.Detector, 'feed', 'call_progress.feed')
+	if (echo_canceller.numpy != None):
+		patch(echo_canceller.EchoCanceller, 'near', 'echo_canceller.near')
+	for name, stage in dsp.STAGES.items():
+		patch(stage, 'process', f'dsp.{name}')
+	patch(IPPhone, 'handler', 'IPPhone.handler')
+	patch(IPPhone, 'read_audio', 'IPPhone.read_audio')
+	patch(IPPhone, 'write_audio', 'IPPhone.write_audio')
+	patch(vad.Detector, 'feed', 'vad.feed')
+	patch(vad.ComfortNoise, 'generate', 'vad.comfort_noise')
+	patch(CallSession, 'play_handler', 'play_handler')
+	pstnxsip.handle_events = profiler.wrap_pass(pstnxsip.handle_events)
+	new_session = pstnxsip.new_session
+	def traced_new_session(*args):
+		session = new_session(*args)
+		profiler.start_trace(session)
+		return session
+	pstnxsip.new_session = traced_new_session
+	stop_cross_conn = CallSession.stop_cross_conn
+	def traced_stop_cross_conn(session):
+		stop_cross_conn(session)
+		profiler.stop_trace(session)
+	CallSession.stop_cross_conn = traced_stop_cross_conn
+	def periodic_report():
+		common.error(f':profiler.report:\r\n{profiler.report()}')
+		timers.schedule(REPORT_TIME, periodic_report)
+	timers.schedule(REPORT_TIME, periodic_report)
+	atexit.register(lambda: common.error(profiler.report()))
+	return profiler
@@ -1,278 +1,173 @@
 # Project: pstnxsip (Python3) (01/01/2023)
-# Module: pstnxsip.py 
-# Description: Main handler of pstnxsip. Controls PSTN line and IP Phone calls. 
+# Module: pstnxsip.py
+# Description: Main handler of pstnxsip. Controls PSTN line and IP Phone calls.
 # Author: Aydin Parin
 
-from ip_phone import IPPhone
+from ip_phone import IPPhone, SS_SERVICE_UNAVAILABLE
 from line import Line
+from call_session import CallSession, FROM_IP, FROM_PSTN
+from typing import List
+import async_gateway
+import media_process
+import profiler
 import common
-import serial
-import time
+import clock
+import config
+import sys
 import atexit
-import wave
+import selectors
+import timers
 
 debug = common.debug
 
-FROM_IP = 1
-FROM_PSTN = 2
-
-cross_connected = False
-call_from = None
-dial_timer = 0
-session_timer = 0
-resp_timer = 0
-line_number = ''
-ip_number = ''
-play_started = False
-play_file = None
-total_chunk = 0
-chunk_counter = 0
-rec_started = False
-rec_file = None
-ip_phone: IPPhone = None
-line: Line = None
-
-def start_cross_conn() -> None:
-	global cross_connected, ip_phone, line, line_number, ip_number, session_timer, dial_timer, resp_timer
-	if (cross_connected):  # if modem already in Voice Mode
-		return
-	stop_play_file()
-	if (common.RECORDING_ENABLED):
-		start_record_file(line_number, ip_number)
-	line.start_voice_mode()
-	audio_data = ip_phone.read_audio()  # empty IP call receive buffer
-	audio_data = line.read_audio()  # empty modem receive buffer
-	session_timer = time.time() + common.MAX_SESSION_DURATION
-	dial_timer = 0
-	resp_timer = 0
-	cross_connected = True
-
-def stop_cross_conn() -> None:
-	global cross_connected, ip_phone, line, line_number, ip_number, session_timer, dial_timer, resp_timer, call_from
-	ip_phone.hangup()
-	stop_play_file()
-	if (common.RECORDING_ENABLED):
-		stop_record_file()
-	line.stop_voice_mode()
-	line_number = ''
-	ip_number = ''
-	session_timer = 0
-	dial_timer = 0
-	resp_timer = 0
-	call_from = None
-	cross_connected = False
-
-def start_play_file(file_name: str) -> None:
-	global play_started, play_file, total_chunk, chunk_counter
-	if (not play_started):
-		play_file = wave.open(file_name,'rb')
-		total_chunk = play_file.getnframes() / common.CHUNK_SIZE
-		chunk_counter = 0
-		play_started = True
-
-def play_handler() -> None:
-	global play_started, play_file, total_chunk, chunk_counter, call_from, ip_phone, line
-	if (play_started):
-		if (chunk_counter < total_chunk):
-			if (call_from == FROM_PSTN):
-				line.write_audio(play_file.readframes(common.CHUNK_SIZE))
-			elif (call_from == FROM_IP):
-				ip_phone.write_audio(play_file.readframes(common.CHUNK_SIZE))
-			chunk_counter += 1
-		else:
-			stop_play_file()
-
-def stop_play_file() -> None:
-	global play_started, play_file
-	if (play_started):
-		play_file.close()
-		play_started = False
-
-def start_record_file(line_num: str, ip_num: str) -> None:
-	global rec_started, rec_file
-	line_num = line_num.strip('*#ABCD')
-	if (line_num == ''):
-		line_num = 'X'
-	ip_num = ip_num.strip('*#ABCD')
-	if (ip_num == ''):
-		ip_num = 'X'
-	if (not rec_started):
-		if (call_from == FROM_PSTN):
-			file_name = time.strftime('%Y%m%d-%H%M%S') + '_' + line_num + '_to_' + ip_num + '.wav'
-		elif (call_from == FROM_IP):
-			file_name = time.strftime('%Y%m%d-%H%M%S') + '_' + ip_num + '_to_' + line_num + '.wav'
-		rec_file = wave.open(file_name, 'wb')
-		rec_file.setnchannels(1)
-		rec_file.setsampwidth(1)
-		rec_file.setframerate(common.SAMPLE_FREQ)
-		rec_started = True
-
-def record_handler(audio_data: bytes = []) -> None:
-	global rec_started, rec_file
-	if (rec_started):
-		rec_file.writeframes(audio_data)
-
-def stop_record_file() -> None:
-	global rec_started, rec_file
-	if (rec_started):
-		rec_file.close()
-		rec_started = False
+lines: List[Line] = []  # in least recently used order (hunting)
+ip_phones: List[IPPhone] = []  # in least recently used order (hunting)
+sessions: List[CallSession] = []
+session_class = CallSession  # media_process.SplitCallSession when media runs in a separate process
+selector = selectors.DefaultSelector()
+
+def hunt(pool: list, busy: list) -> object:  # least recently used idle line or ip phone, None if all busy
+	for item in pool:
+		if ((item.state == common.PS_IDLE) and (item not in busy)):
+			pool.remove(item)  # move to the end of the list as the most recently used
+			pool.append(item)
+			return item
+	return None
+
+def new_session(line: Line, ip_phone: IPPhone, call_from: int) -> CallSession:
+	session = session_class(line, ip_phone, call_from)
+	sessions.append(session)
+	for pool, item in ((lines, line), (ip_phones, ip_phone)):  # mark as the most recently used
+		pool.remove(item)
+		pool.append(item)
+	return session
 
 def close_connections() -> None:
-	global ip_phone, line
-	stop_cross_conn()
-	if (ip_phone.state != common.PS_INACTIVE):
-		ip_phone.stop()
-		while (ip_phone.state != common.PS_INACTIVE):
-			ip_phone.handler()
-	line.stop()
+	for session in sessions:
+		session.stop_cross_conn()
+	for ip_phone in ip_phones:
+		if (ip_phone.state != common.PS_INACTIVE):
+			ip_phone.stop()
+			while (ip_phone.state != common.PS_INACTIVE):
+				ip_phone.handler()
+				timers.expire()  # register timeout
+	for line in lines:
+		line.stop()
 	if (common.DEBUGFILE):  # if debug.log file opened
 		common.debug_log.close()  # close debug.log file
 
-def main_handler() -> None:
-	global session_timer, resp_timer, dial_timer, cross_connected, call_from, ip_phone, line, line_number, ip_number
-
-	if (cross_connected):  # if modem in 'Voice Mode'
-		if (time.time() > session_timer):  # handle session timeout, if call session timeout (default 3 mins)
-			stop_cross_conn()
-		elif (ip_phone.state == common.PS_IDLE):
-			stop_cross_conn()
-		elif (line.state != common.PS_CONNECTED):
-			stop_cross_conn()
-		else:
-			line_read = line.read_audio()  # handle modem receive buffer, read modem receive buffer
-			if (line_read != None):
-				if (common.RECORDING_ENABLED):
-					record_handler(line_read)
-				if (line.echo_cancel != 0):
-					ip_phone.write_audio(b'\x80' * len(line_read))  # send 'silence' to IP phone (audioop routines can be used for suppression)
-				else:
-					ip_phone.write_audio(line_read)  # send audio to IP phone
-			ip_read = ip_phone.read_audio()  # handle IP call receive buffer, read IP call receive buffer
-			if (ip_read != None):
-				line.write_audio(ip_read)  # write data to modem buffer
-			dtmf = line.read_dtmf()	# handle DTMF from PSTN, last pressed key
-			if ((dtmf != '') and (dtmf in common.DTMF_DIGITS)):  # DTMF tone from PSTN, send DTMF code to IP phone
-				ip_phone.send_dtmf(dtmf)
-			dtmf = ip_phone.read_dtmf()	# handle DTMF from IP, last pressed key
-			if ((dtmf != '') and (dtmf in common.DTMF_DIGITS)):  # DTMF tone from IP phone, send DTMF code to PSTN
-				line.send_dtmf(dtmf)
-	elif (call_from == FROM_IP):  # handle call initiated from IP
-		# audio_data = line.read_audio()  # empty line receive buffer
-		if (ip_phone.state == common.PS_IDLE):  # call hanged-up
-			stop_cross_conn()
-			return
-		if (ip_phone.state == common.PS_CONNECTED):  #  call connected
-			audio_data = ip_phone.read_audio()  # empty IP phone receive buffer
-			if (dial_timer == 0):  # IP call connected, will be waiting for IP phone to dial a number
-				resp_timer = 0
-				line_number = ''
-				dial_timer =  time.time() + common.DIAL_TIMEOUT
-				start_play_file('dial.wav')
-				return
-			if (time.time() > dial_timer):  # if IP phone not dialed a number (timeout)
-				stop_cross_conn()  # even if not started (initializes all parameters)
-				return
-			dtmf = ip_phone.read_dtmf()	# last pressed key
-			if ((dtmf != '') and (dtmf in common.DTMF_DIGITS)):  # get digits
-				line_number += dtmf
-				# modify this lines; can create a dial plan or restrict dialing numbers (for outbound calls)
-				num_digit = 4
-				if (line_number[0] == '0'):  # can dial outside i.e. 05552345678
-					num_digit = 11
-				elif (line_number[0] == '*'):  # this is for internal numbers used in this project
-					num_digit = 3
-				else:
-					stop_cross_conn()  # even if not started (initializes all parameters)
-					return
-				if (len(line_number) == num_digit):  # if n digit pressed
-					line.dial(line_number)
-					start_cross_conn()
-					return
-		if (resp_timer != 0):
-			if (time.time() > resp_timer):
-				resp_timer = 0
-				ip_phone.hangup()
-	elif (call_from == FROM_PSTN):  # handle call initiated from PSTN
-		# audio_data = ip_phone.read_audio()  # empty IP phone receive buffer
-		if (line.state == common.PS_CONNECTED):  # if PSTN line in voice mode
-			audio_data = line.read_audio()  # empty line receive buffer
-		if (ip_phone.state == common.PS_CONNECTED):  # Call answered
-			start_cross_conn()
-			return
-		if (resp_timer != 0):
-			if (time.time() > resp_timer):  # Call not answered
-				stop_cross_conn()
-				return
-			elif (line.state == common.PS_IDLE):  # PSTN line session disconnected
-				stop_cross_conn()
-				return
-			elif (ip_phone.state == common.PS_IDLE):  # Call rejected/busy
-				stop_cross_conn()
-				return
-		if (dial_timer != 0):  # IP call connected, will be waiting for PSTN phone to dial a number (if can dial)
-			if (time.time() > dial_timer):  # if Line not dialed a number (timeout)
-				stop_cross_conn()  # even if not started (initializes all parameters)
-				return
-			if (line.state != common.PS_CONNECTED):  # PSTN line session disconnected
-				stop_cross_conn()
-				return
-			dtmf = line.read_dtmf()	# last pressed key
-			if ((dtmf != '') and (dtmf in common.DTMF_DIGITS)):  # get digits
-				ip_number += dtmf
-				# modify this lines when LINE_CAN_DIAL = True; can create an IVR menu or a dial plan or restrict dialing numbers (for inbound calls)
-				num_digit = 4
-				if (ip_number[0] == '1'):  # if number starts with 1
-					if ((len(ip_number) == num_digit) and (ip_phone.state == common.PS_IDLE)):  # if n digit pressed
-						ip_number = f'{ip_number}@{common.IP_PBX_DOMAIN}'
-						dial_timer = 0
-						resp_timer = time.time() + common.ANSWER_TIMEOUT
-						start_play_file('ringback.wav')
-						ip_phone.call(line_number, ip_number)	 # call IP phone
-				else:
-					stop_cross_conn()  # even if not started (initializes all parameters)
-	elif (ip_phone.state == common.PS_RINGING):  # wait for a call initiated from IP, ringing started from IP
-		resp_timer = time.time() + common.RESPONSE_TIMEOUT
-		call_from = FROM_IP
-		ip_phone.answer()
-	elif (line.state == common.PS_RINGING):  # wait for a call initiated from line
-		if ((common.LOCAL_PBX) and (common.LINE_CAN_DIAL)):  # inbound PSTN calls can dial only when LOCAL_PBX and LINE_CAN_DIAL are True
-			if (line.ring_counter == common.ANSWER_AFTER_RINGS):
-				call_from = FROM_PSTN
-				line.start_voice_mode()
-				ip_number = ''
-				dial_timer =  time.time() + common.DIAL_TIMEOUT
-				start_play_file('dial.wav')
-		else:
-			call_from = FROM_PSTN
-			line_number = line.read_caller_id()  # get caller ID
-			resp_timer = time.time() + common.ANSWER_TIMEOUT
-			ip_number = common.CALL_FORWARD_TO
-			ip_phone.call(line_number, ip_number)  # call IP phone
-
-if __name__ == '__main__':
-	atexit.register(close_connections)
+def update_selector() -> None:  # keep selector registrations same with the line and ip phone readers (RTP socket changes per call)
+	readers = []
+	for handler in (lines + ip_phones):
+		readers += handler.get_readers()
+	for key in list(selector.get_map().values()):  # unregister first, a new socket may get a closed socket's file descriptor
+		if (key.fileobj not in readers):
+			selector.unregister(key.fileobj)
+	registered = [key.fileobj for key in selector.get_map().values()]
+	for r in readers:
+		if (r not in registered):
+			selector.register(r, selectors.EVENT_READ)
+
+def wait_events(busy: bool) -> None:  # sleep until a reader has data or a timer is due
+	if (busy):  # a handler changed call state, run handlers again without waiting
+		timeout = 0
+	else:
+		timeout = timers.timeout()  # None (wait forever) if no timer running
+		if (not all([line.selectable for line in lines])):  # modem can not be waited by selector (i.e. windows COM ports), poll it
+			if ((timeout == None) or (timeout > common.LOOP_TIME)):
+				timeout = common.LOOP_TIME
+	update_selector()
+	if (selector.get_map()):
+		selector.select(timeout)
+	elif (timeout != None):
+		clock.sleep(timeout)
+
+def call_status() -> tuple:
+	return tuple([s.status() for s in sessions] + [h.state for h in (lines + ip_phones)])
 
-	line = Line(common.MODEM_PORT)
-	line.start()
-	ip_phone = IPPhone(common.IP_PBX_USER, common.IP_PBX_DOMAIN, common.IP_PBX_PASS, common.IP_PHONE_IP, common.IP_PHONE_PORT, \
-		common.RTP_LOW, common.RTP_HIGH, common.IP_PBX_PROXY_ADDRESS, common.IP_PBX_PROXY_PORT)
-	ip_phone.start()
-	while(ip_phone.state == common.PS_REGISTERING):
+def main_handler() -> None:
+	for session in sessions[:]:
+		session.handler()
+		if (session.closed()):
+			sessions.remove(session)
+	for ip_phone in ip_phones:  # wait for a call initiated from IP, ringing started from IP
+		if ((ip_phone.state != common.PS_RINGING) or (ip_phone in [s.ip_phone for s in sessions])):
+			continue
+		line = None
+		if (ip_phone.call_id not in [s.ip_phone.call_id for s in sessions]):  # same call may be forked to all ip phones
+			line = hunt(lines, [s.line for s in sessions])
+		if (line == None):  # all lines busy or call already answered by another ip phone
+			if (any([l.recovering() for l in lines])):  # modem reopening, registration kept, caller may retry later
+				ip_phone.reject(SS_SERVICE_UNAVAILABLE)
+			else:
+				ip_phone.reject()
+			continue
+		new_session(line, ip_phone, FROM_IP).start_from_ip()
+	for line in lines:  # wait for a call initiated from line
+		if ((line.state != common.PS_RINGING) or (line in [s.line for s in sessions])):
+			continue
+		if (line.busy()):  # caller ID not received yet
+			continue
+		if ((common.LOCAL_PBX) and (common.LINE_CAN_DIAL) and (line.ring_counter < common.ANSWER_AFTER_RINGS)):
+			continue
+		ip_phone = hunt(ip_phones, [s.ip_phone for s in sessions])
+		if (ip_phone == None):  # all ip phones busy, line keeps ringing
+			continue
+		new_session(line, ip_phone, FROM_PSTN).start_from_pstn()
+	if (config.requested and (sessions == []) and all([h.state == common.PS_IDLE for h in (lines + ip_phones)])):  # config reloaded between calls
+		changes = config.reload()
+		for handler in (lines + ip_phones):
+			handler.reconfigure(changes)
+
+def handle_events() -> bool:  # one loop pass, returns True if call state changed (next pass may not wait for an event)
+	status = call_status()
+	timers.expire()
+	for line in lines:
+		line.handler()
+	for ip_phone in ip_phones:
 		ip_phone.handler()
-		time.sleep(0.1)
+	main_handler()
+	return (status != call_status())
 
-while(True):
-	start_time = time.time()
-	if (ip_phone.state == common.PS_INACTIVE):
-		common.error('Error!: IP PBX deregistered ip_phone.')
+if __name__ == '__main__':
+	config.start()  # CONFIG_FILE overrides common.py before lines and ip phones created
+	if (common.ASYNC_MODE):  # asyncio runtime, calls are handled by async_gateway coroutines
+		async_gateway.main()
 		exit()
-	main_handler()
-	line.handler()
-	ip_phone.handler()
-	play_handler()
-	delta = time.time() - start_time  # try to stabilize loop time
-	if (delta < common.LOOP_TIME):
-		time.sleep(common.LOOP_TIME - delta)
-	else:
-		time.sleep(common.LOOP_TIME)
+	atexit.register(close_connections)
+	if (common.PROFILE):  # time loop stages, must be installed before media process started
+		profiler.install(sys.modules[__name__])
+
+	if (common.SPLIT_MEDIA):  # media process owns modems and RTP sockets, this process handles SIP and call states
+		media = media_process.MediaClient(common.MODEM_PORTS, len(common.IP_PHONE_PORTS))
+		media.start()
+		session_class = media_process.SplitCallSession
+	for n, port in enumerate(common.MODEM_PORTS):
+		if (common.SPLIT_MEDIA):
+			line = media.lines[n]
+		else:
+			line = Line(port)
+		line.start()
+		lines.append(line)
+	for n, port in enumerate(common.IP_PHONE_PORTS):
+		if (common.SPLIT_MEDIA):
+			ip_phone = media_process.SignalingIPPhone(media, n, common.IP_PBX_USER, common.IP_PBX_DOMAIN, common.IP_PBX_PASS, common.IP_PHONE_IP, port, \
+				common.RTP_LOW, common.RTP_HIGH, common.IP_PBX_PROXY_ADDRESS, common.IP_PBX_PROXY_PORT)
+		else:
+			ip_phone = IPPhone(common.IP_PBX_USER, common.IP_PBX_DOMAIN, common.IP_PBX_PASS, common.IP_PHONE_IP, port, \
+				common.RTP_LOW, common.RTP_HIGH, common.IP_PBX_PROXY_ADDRESS, common.IP_PBX_PROXY_PORT)
+		ip_phone.start()
+		ip_phones.append(ip_phone)
+	while(any([ip_phone.state == common.PS_REGISTERING for ip_phone in ip_phones]) or any([line.busy() for line in lines])):  # modem commands run while ip phones register
+		wait_events(False)
+		for handler in (lines + ip_phones):
+			handler.handler()
+		timers.expire()
+
+	busy = True
+	while(True):
+		wait_events(busy)
+		if (any([ip_phone.state == common.PS_INACTIVE for ip_phone in ip_phones])):
+			common.error('Error!: IP PBX deregistered ip_phone.')
+			exit()
+		busy = handle_events()
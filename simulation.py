@@ -0,0 +1,782 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: simulation.py
+# Description: Simulation of pstnxsip. Runs scripted PSTN and IP calls against a fake modem, fake sockets and a fake IP PBX on a virtual clock.
+# Author: Aydin Parin
+
+from ip_phone import IPPhone, SIPMessage, PCMU, PCMA
+from line import Line
+from collections import deque
+from typing import Callable
+import argparse
+import async_gateway
+import asyncio
+import call_progress
+import clock
+import common
+import g711
+import heapq
+import line as line_module
+import math
+import media_process
+import pstnxsip
+import random
+import selectors
+import time
+import timers
+
+debug = common.debug
+
+EPOCH = 1672531200.0  # virtual wall clock starts at 01/01/2023
+PBX_IP = '10.0.0.1'
+PBX_PORT = 5060
+PBX_RTP_PORT = 40000
+PBX_USER = '1000'  # CALL_FORWARD_TO user of simulation
+GATEWAY_IP = '10.0.0.2'
+GATEWAY_PORT = 5060
+GATEWAY_USER = 'pstnxsip'
+NETWORK_DELAY = 0.001  # one way delay of fake network
+FRAME_TIME = 0.02  # modem audio and RTP packet interval
+RING_PERIOD = 5  # seconds between two RINGs
+DIGIT_TIME = 0.3  # seconds between two DTMF digits of IP user
+TONE_HANGUP_TIME = 1.2  # seconds from start of busy tone until call progress detector hangs up
+PAUSE_TIME = 0.5  # seconds of talk and of silence of both parties in comfort noise calls
+SID_FRAMES = 25  # frames between two SID packets of IP user in silence
+SYNC = 'sync'  # runtimes of Simulation: lines and ip phones in pstnxsip main loop
+SPLIT = 'split'  # SPLIT_MEDIA, media process stepped in this process after each main loop pass
+ASYNC = 'async'  # ASYNC_MODE, async_gateway coroutines on an event loop in virtual time
+MAX_PASSES = 1000  # loop passes without time advancing, a state machine loop if exceeded
+PROBE_ANSWERS = {'AT+GMI': 'CONEXANT', 'AT+GMM': 'CX93001-EIS_V0.2002-V92', 'AT+FCLASS=?': '0,1,1.0,2,8', \
+	'AT+VSM=?': '0,"SIGNED PCM",8,0,(8000),(0),(0)\r\n1,"UNSIGNED PCM",8,0,(8000),(0),(0)\r\n5,"G.711A",8,0,(8000),(0),(0)'}  # chipset probe of Line.start, A-law for MODEM_PASSTHROUGH
+
+class VirtualClock(clock.Clock):  # time advances only when simulation advances it, also the event scheduler of fake devices
+	def __init__(self):
+		self.now = 0.0
+		self.events = []  # heap of (time, sequence, callback)
+		self.seq = 0
+
+	def time(self) -> float:
+		return EPOCH + self.now
+
+	def monotonic(self) -> float:
+		return self.now
+
+	def sleep(self, seconds: float) -> None:  # blocking code (i.e. Line.handler) lets fake devices run meanwhile
+		self.advance(self.now + seconds)
+
+	def call_later(self, delay: float, callback: Callable) -> None:
+		self.seq += 1
+		heapq.heappush(self.events, (self.now + delay, self.seq, callback))
+
+	def next_event(self) -> float:  # time of next device event, 0 if none
+		if (self.events == []):
+			return 0
+		return self.events[0][0]
+
+	def advance(self, t: float) -> None:  # runs device events until time t
+		while ((self.events != []) and (self.events[0][0] <= t)):
+			due, seq, callback = heapq.heappop(self.events)
+			if (due > self.now):
+				self.now = due
+			callback()
+		if (t > self.now):
+			self.now = t
+
+class FakeSocket:  # non-blocking UDP socket on fake network
+	def __init__(self, network):
+		self.network = network
+		self.address: tuple = None
+		self.queue = deque()
+		self.listener: Callable = None  # called instead of queueing (fake IP PBX)
+
+	def bind(self, address: tuple) -> None:
+		self.address = address
+		self.network.sockets[address] = self
+
+	def setblocking(self, flag: bool) -> None:
+		pass
+
+	def getsockname(self) -> tuple:
+		return self.address
+
+	def sendto(self, data: bytes, address: tuple) -> int:
+		self.network.send(bytes(data), self.address, address)
+		return len(data)
+
+	def recvfrom(self, size: int) -> tuple:
+		if (not self.queue):
+			raise BlockingIOError
+		data, sender = self.queue.popleft()
+		return data[:size], sender
+
+	def recv(self, size: int) -> bytes:
+		return self.recvfrom(size)[0]
+
+	def close(self) -> None:
+		if (self.network.sockets.get(self.address) is self):
+			del self.network.sockets[self.address]
+		self.queue.clear()
+
+class FakeNetwork:  # replaces socket.socket of IPPhone
+	def __init__(self, vclock: VirtualClock):
+		self.clock = vclock
+		self.sockets = {}  # bound address: FakeSocket
+
+	def __call__(self, family: int = 0, type: int = 0) -> FakeSocket:
+		return FakeSocket(self)
+
+	def send(self, data: bytes, sender: tuple, address: tuple) -> None:
+		def deliver():
+			sckt = self.sockets.get(address)
+			if (sckt == None):  # nobody listening, datagram lost
+				return
+			if (sckt.listener != None):
+				sckt.listener(data, sender)
+			else:
+				sckt.queue.append((data, sender))
+		self.clock.call_later(NETWORK_DELAY, deliver)
+
+class FakeModem:  # replaces serial.Serial of Line, answers AT commands and streams voice data
+	def __init__(self, sim):
+		self.sim = sim
+		self.is_open = False
+		self.out_waiting = 0
+		self.rx = bytearray()
+		self.command = bytearray()
+		self.voice = False
+		self.off_hook = False
+		self.caller_id = ''
+		self.rings = 0  # RINGs left to send
+		self.dialed = ''
+		self.audio_written = 0
+		self.first_audio = 0  # virtual time of first audio written by gateway
+		self.commands = []
+		self.profile = line_module.MODEM_PROFILES[common.MM_CONEXANT]  # answers probe commands as a Conexant modem
+		self.unplugged = False  # port calls fail like a removed USB modem
+		self.tone: call_progress.Tone = None  # exchange tone sent instead of PSTN party audio
+		self.tone_sample = 0
+		self.pauses = False  # PSTN party is silent every other PAUSE_TIME
+
+	def check(self) -> None:
+		if (self.unplugged):
+			raise OSError(5, 'Input/output error')
+
+	def replug(self) -> None:
+		self.unplugged = False
+		self.rx.clear()
+		self.command.clear()
+		self.voice = False
+		self.off_hook = False
+
+	@property
+	def in_waiting(self) -> int:
+		self.check()
+		return len(self.rx)
+
+	def fileno(self) -> int:  # selectable like posix serial ports, simulation checks in_waiting instead of a selector
+		return -1
+
+	def open(self) -> None:
+		self.check()
+		self.is_open = True
+
+	def close(self) -> None:
+		self.is_open = False
+
+	def reset_input_buffer(self) -> None:
+		self.check()
+		self.rx.clear()
+
+	def reset_output_buffer(self) -> None:
+		self.check()
+
+	def read(self, size: int) -> bytes:
+		self.check()
+		data = bytes(self.rx[:size])
+		del self.rx[:size]
+		return data
+
+	def write(self, data: bytes) -> int:
+		self.check()
+		data = bytes(data)  # line writes voice blocks as memoryviews
+		if (self.voice):
+			end = data.find(line_module.DLE_CHAR)
+			while ((end >= 0) and (data[end:end + 2] != self.profile.end_voice_tx_rx)):
+				end = data.find(line_module.DLE_CHAR, end + 2)  # <DLE><DLE> is a 0x10 sample
+			if (end >= 0):  # end of voice mode
+				self.voice = False
+				self.tone = None
+				self.rx += self.profile.end_voice_resp
+			else:
+				end = len(data)
+			if ((end != 0) and (self.first_audio == 0)):
+				self.first_audio = self.sim.clock.now
+			self.audio_written += end
+			return len(data)
+		self.command += data
+		while (b'\r\n' in self.command):
+			cmd, rest = self.command.split(b'\r\n', 1)
+			self.command = bytearray(rest)
+			self.at_command(cmd.decode('ascii'))
+		return len(data)
+
+	def at_command(self, cmd: str) -> None:
+		self.commands.append(cmd)
+		if (cmd == 'AT+VTR'):
+			self.voice = True
+			self.rx += b'CONNECT\r\n'
+			self.sim.clock.call_later(FRAME_TIME, self.voice_frame)
+			return
+		if (cmd in PROBE_ANSWERS):
+			self.rx += f'\r\n{PROBE_ANSWERS[cmd]}\r\n\r\nOK\r\n'.encode('ascii')
+			return
+		if (cmd == 'AT+VRID=0'):
+			self.rx += f'\r\nDATE=0101\r\nTIME=1200\r\nNMBR={self.caller_id}\r\n\r\nOK\r\n'.encode('ascii')
+			return
+		if (cmd == 'AT+VLS=1'):
+			self.off_hook = True
+			self.rings = 0
+		elif ((cmd == 'AT+VLS=0') or (cmd == 'ATH')):
+			self.off_hook = False
+		elif (cmd.startswith('ATD')):
+			self.dialed = cmd[3:].rstrip(';')
+		self.rx += b'OK\r\n'
+
+	def ring(self) -> None:
+		if ((self.rings == 0) or self.off_hook):
+			self.rings = 0
+			return
+		self.rings -= 1
+		self.rx += b'\r\nRING\r\n'
+		self.sim.clock.call_later(RING_PERIOD, self.ring)
+
+	def voice_frame(self) -> None:  # PSTN side audio, one frame every FRAME_TIME in voice mode
+		if (self.voice):
+			if (self.tone != None):
+				self.rx += self.tone_frame()
+			elif (self.pauses and paused(self.sim.clock.now)):
+				self.rx += bytes([0x8F + (n % 2) for n in range(common.RTP_LEN)])  # line idle noise at DC offset of voice frames
+			else:
+				self.rx += bytes([0x80 + ((n * 7) % 32) for n in range(common.RTP_LEN)])
+			self.sim.clock.call_later(FRAME_TIME, self.voice_frame)
+
+	def busy_tone(self) -> None:  # PSTN party hanged up
+		if (self.voice):
+			self.rx += bytes([line_module.DLE_CHAR, line_module.DCE_BUSY_TONE])
+
+	def play_tone(self, name: str) -> None:  # PSTN party hanged up, exchange tone of MODEM_COUNTRY_CODE heard without a <DLE> code until voice mode ends
+		self.tone = [t for t in call_progress.COUNTRY_TONES.get(common.MODEM_COUNTRY_CODE, call_progress.DEFAULT_TONES) if (t.name == name)][0]
+		self.tone_sample = 0
+
+	def tone_frame(self) -> bytes:
+		cadence = self.tone.cadence or (1.0,)
+		frame = bytearray()
+		for n in range(self.tone_sample, self.tone_sample + common.RTP_LEN):
+			t = (n / common.SAMPLE_FREQ) % sum(cadence)
+			segment = 0
+			while (t >= cadence[segment]):
+				t -= cadence[segment]
+				segment += 1
+			v = sum([30 * math.sin(2 * math.pi * f * n / common.SAMPLE_FREQ) for f in self.tone.freqs]) if ((segment % 2) == 0) else 0
+			frame.append(int(128 + v))
+		self.tone_sample += common.RTP_LEN
+		return bytes(frame)
+
+class FakeTransport:  # asyncio transport of SimGateway, closing stops delivery of a fake socket
+	def __init__(self, sckt: FakeSocket = None):
+		self.sckt = sckt
+
+	def close(self) -> None:
+		if (self.sckt != None):
+			self.sckt.listener = None
+
+class SimGateway(async_gateway.AsyncGateway):  # fake devices call protocol callbacks instead of asyncio transports
+	async def open_sip(self) -> None:
+		self.ip_phone.sip_sckt.listener = async_gateway.SIPProtocol(self).datagram_received
+
+	def timers_expired(self) -> None:  # asyncio runs a timer up to clock resolution early, virtual time would stand still before wheel deadline
+		due = timers.wheel.next_deadline()
+		if (due > timers.now()):
+			clock.sleep(due - timers.now())
+		super().timers_expired()
+
+	async def open_modem(self) -> None:  # VirtualSelector delivers modem data while modem_transport is set
+		if (self.modem_ready()):
+			self.modem_transport = FakeTransport()
+
+	async def open_rtp(self, sckt: FakeSocket) -> None:
+		if ((not self.ip_phone.rtp_active) or (self.ip_phone.rtp_sckt is not sckt)):  # call closed before task started
+			return
+		protocol = async_gateway.RTPProtocol(self)
+		while (sckt.queue):
+			protocol.datagram_received(*sckt.queue.popleft())
+		sckt.listener = protocol.datagram_received
+		self.rtp_transport = FakeTransport(sckt)
+
+class VirtualSelector(selectors.SelectSelector):  # waiting of event loop advances virtual clock to next device event or loop timer
+	def __init__(self, sim):
+		super().__init__()
+		self.sim = sim
+
+	def select(self, timeout: float = None) -> list:
+		if ((not self.sim.deliver()) and (timeout != 0)):
+			due = [t for t in (self.sim.clock.next_event(), (self.sim.clock.now + timeout) if (timeout != None) else 0) if (t != 0)]
+			if (due == []):
+				raise RuntimeError(f'simulation: event loop waits without any event at {self.sim.clock.now:.3f}')
+			self.sim.clock.advance(min(due))
+			self.sim.deliver()
+		return super().select(0)  # self-pipe of event loop
+
+class VirtualLoop(asyncio.SelectorEventLoop):  # event loop of ASYNC runtime, loop time is virtual clock
+	def __init__(self, sim):
+		super().__init__(VirtualSelector(sim))
+		self.sim = sim
+
+	def time(self) -> float:
+		return self.sim.clock.now
+
+def paused(now: float) -> bool:
+	return ((now % (2 * PAUSE_TIME)) >= PAUSE_TIME)
+
+class FakePBX:  # SIP registrar and the CALL_FORWARD_TO user agent
+	def __init__(self, sim, network: FakeNetwork):
+		self.sim = sim
+		self.sip = network()
+		self.sip.bind((PBX_IP, PBX_PORT))
+		self.sip.listener = self.sip_received
+		self.rtp = network()
+		self.rtp.bind((PBX_IP, PBX_RTP_PORT))
+		self.rtp.listener = self.rtp_received
+		self.contact: tuple = None  # registered gateway address
+		self.dialog: dict = None
+		self.answer_delay = 1.0  # None: never answers
+		self.talk_time = 2.0
+		self.hangup = True  # IP user hangs up after talk_time
+		self.digits = ''  # dialed by IP user after call connected
+		self.registers = 0
+		self.rejected = 0  # final status of last call to gateway rejected
+		self.rtp_received = 0
+		self.rtp_seq = 0
+		self.rtp_frames = 0  # frames of IP user audio, RTP timestamp
+		self.cn = False  # accepts comfort noise (CN) and sends SID packets in pauses
+		self.sids = 0  # SID packets received
+		self.talkspurts = 0  # audio packets with marker bit received
+		self.codec = PCMU  # only audio codec of IP user, offered and accepted
+		self.payloads = {}  # payload type: RTP packets received
+
+	def sip_received(self, data: bytes, sender: tuple) -> None:
+		msg = SIPMessage(data)
+		first = data.split(b'\r\n')[0].decode('utf8')
+		if (msg.msg_type == None):
+			return
+		if (first.startswith('SIP/2.0')):
+			self.response_received(msg, data)
+			return
+		method = first.split(' ')[0]
+		if (method == 'REGISTER'):
+			self.registers += 1
+			self.contact = sender
+			self.respond(data, 200, 'OK', 'reg')
+		elif (method == 'INVITE'):  # call from PSTN
+			self.dialog = {'call_id': msg.headers['Call-ID'], 'invite': data, 'tag': f'pbx{random.randint(1, 99999)}', 'cseq': 1, \
+				'local': msg.headers['To']['raw'], 'remote': f'{msg.headers["From"]["raw"]};tag={msg.headers["From"]["tag"]}', 'rtp': (msg.body['c']['address'], msg.body['m']['port'])}
+			self.dialog['local'] += f';tag={self.dialog["tag"]}'
+			self.respond(data, 100, 'Trying')
+			if (str(self.codec) not in msg.body['m']['methods']):  # gateway did not offer codec of IP user
+				self.respond(data, 488, 'Not Acceptable Here', self.dialog['tag'])
+				return
+			self.respond(data, 180, 'Ringing', self.dialog['tag'])
+			if (self.answer_delay != None):
+				self.sim.clock.call_later(self.answer_delay, self.answer)
+		elif (method == 'ACK'):
+			if ((self.dialog != None) and (self.dialog['call_id'] == msg.headers['Call-ID'])):
+				if (self.dialog.get('terminated')):  # ACK of 487
+					self.dialog = None
+				else:
+					self.connected()
+		elif (method == 'BYE'):
+			self.respond(data, 200, 'OK')
+			self.dialog = None
+		elif (method == 'CANCEL'):
+			self.respond(data, 200, 'OK')
+			if (self.dialog != None):
+				self.dialog['terminated'] = True
+				self.respond(self.dialog['invite'], 487, 'Request Terminated', self.dialog['tag'])
+
+	def response_received(self, msg: SIPMessage, data: bytes) -> None:
+		if ((self.dialog == None) or (msg.headers['Call-ID'] != self.dialog['call_id'])):
+			return
+		method = msg.headers['CSeq']['method']
+		if ((method == 'INVITE') and (msg.status == 200)):  # call to PSTN answered by gateway
+			if (msg.body['m']['methods'][0] != str(self.codec)):  # answer must take codec of offer
+				self.rejected = 488
+			self.dialog['remote'] += f';tag={msg.headers["To"]["tag"]}'
+			self.dialog['rtp'] = (msg.body['c']['address'], msg.body['m']['port'])
+			self.send_request('ACK', self.dialog['cseq'])
+			self.connected()
+		elif ((method == 'INVITE') and (msg.status >= 300)):  # call to gateway rejected
+			self.rejected = msg.status
+			self.dialog = None
+		elif (method == 'BYE'):
+			self.dialog = None
+
+	def answer(self) -> None:
+		if ((self.dialog == None) or self.dialog.get('terminated')):
+			return
+		self.respond(self.dialog['invite'], 200, 'OK', self.dialog['tag'], self.sdp())
+
+	def connected(self) -> None:
+		dialog = self.dialog
+		self.sim.clock.call_later(FRAME_TIME, lambda: self.rtp_frame(dialog))
+		for n, digit in enumerate(self.digits):
+			self.sim.clock.call_later(0.5 + n * DIGIT_TIME, lambda digit=digit: self.send_dtmf(dialog, digit))
+		if (self.hangup):  # talk time starts after dialing (gateway may wait DIGIT_TIMEOUT for more digits)
+			dial_time = ((DIGIT_TIME * len(self.digits) + 0.5 + common.DIGIT_TIMEOUT) if (self.digits != '') else 0)
+			self.sim.clock.call_later(dial_time + self.talk_time, lambda: self.bye(dialog))
+
+	def bye(self, dialog: dict) -> None:
+		if (self.dialog is dialog):
+			dialog['cseq'] += 1
+			self.send_request('BYE', dialog['cseq'])
+
+	def call(self) -> None:  # IP user calls gateway
+		self.dialog = {'call_id': f'sim{random.randint(1, 1 << 30)}', 'tag': f'pbx{random.randint(1, 99999)}', 'cseq': 1, \
+			'local': f'"{PBX_USER}" <sip:{PBX_USER}@{PBX_IP}>', 'remote': f'<sip:{GATEWAY_USER}@{PBX_IP}>', 'rtp': None}
+		self.dialog['local'] += f';tag={self.dialog["tag"]}'
+		self.send_request('INVITE', 1, self.sdp())
+
+	def sdp(self) -> str:
+		return f'v=0\r\no={PBX_USER} 1 1 IN IP4 {PBX_IP}\r\ns=sim\r\nc=IN IP4 {PBX_IP}\r\nt=0 0\r\nm=audio {PBX_RTP_PORT} RTP/AVP {self.codec} 101{" 13" if (self.cn) else ""}\r\na=rtpmap:{self.codec} {"PCMA" if (self.codec == PCMA) else "PCMU"}/8000\r\na=rtpmap:101 telephone-event/8000\r\n' + \
+			('a=rtpmap:13 CN/8000\r\n' if (self.cn) else '')
+
+	def content(self, body: str) -> str:
+		if (body == ''):
+			return 'Content-Length: 0\r\n\r\n'
+		return f'Content-Type: application/sdp\r\nContent-Length: {len(body)}\r\n\r\n{body}'
+
+	def respond(self, request: bytes, code: int, reason: str, tag: str = '', body: str = '') -> None:
+		resp = f'SIP/2.0 {code} {reason}\r\n'
+		for h in request.split(b'\r\n\r\n')[0].decode('utf8').split('\r\n')[1:]:
+			name, value = h.split(': ', 1)
+			if (name in ('Via', 'From', 'Call-ID', 'CSeq')):
+				resp += f'{h}\r\n'
+			elif (name == 'To'):
+				if ((tag != '') and (';tag=' not in value)):
+					value += f';tag={tag}'
+				resp += f'To: {value}\r\n'
+		resp += f'Contact: <sip:{PBX_USER}@{PBX_IP}:{PBX_PORT}>\r\n'
+		resp += self.content(body)
+		self.sip.sendto(resp.encode('utf8'), self.contact)
+
+	def send_request(self, method: str, cseq: int, body: str = '') -> None:
+		d = self.dialog
+		req = f'{method} sip:{GATEWAY_USER}@{self.contact[0]}:{self.contact[1]} SIP/2.0\r\n'
+		req += f'Via: SIP/2.0/UDP {PBX_IP}:{PBX_PORT};branch=z9hG4bK{random.randint(1, 1 << 30)}\r\n'
+		req += 'Max-Forwards: 70\r\n'
+		req += f'From: {d["local"]}\r\nTo: {d["remote"]}\r\n'
+		req += f'Call-ID: {d["call_id"]}\r\n'
+		req += f'CSeq: {cseq} {method}\r\n'
+		req += f'Contact: <sip:{PBX_USER}@{PBX_IP}:{PBX_PORT}>\r\n'
+		req += self.content(body)
+		self.sip.sendto(req.encode('utf8'), self.contact)
+
+	def rtp_packet(self, pt: int, payload: bytes) -> bytes:
+		self.rtp_seq = (self.rtp_seq + 1) & 0xFFFF
+		return bytes([0x80, pt]) + self.rtp_seq.to_bytes(2, 'big') + (self.rtp_frames * common.RTP_LEN).to_bytes(4, 'big') + (4321).to_bytes(4, 'big') + payload
+
+	def rtp_frame(self, dialog: dict) -> None:  # IP side audio, one packet every FRAME_TIME while dialog exists
+		if ((self.dialog is dialog) and (dialog['rtp'] != None)):
+			self.rtp_frames += 1
+			if (not (self.cn and paused(self.sim.clock.now))):
+				self.rtp.sendto(self.rtp_packet(self.codec, g711.silence(g711.ALAW if (self.codec == PCMA) else g711.ULAW, common.RTP_LEN)), dialog['rtp'])
+			elif ((self.rtp_frames % SID_FRAMES) == 1):
+				self.rtp.sendto(self.rtp_packet(13, bytes([70])), dialog['rtp'])
+			self.sim.clock.call_later(FRAME_TIME, lambda: self.rtp_frame(dialog))
+
+	def send_dtmf(self, dialog: dict, digit: str) -> None:  # RFC 2833 event with marker bit
+		if ((self.dialog is dialog) and (dialog['rtp'] != None)):
+			self.rtp.sendto(self.rtp_packet(0x80 | 101, bytes([common.DTMF_DIGITS.find(digit), 0x0a, 0x00, 0xa0])), dialog['rtp'])
+
+	def rtp_received(self, data: bytes, sender: tuple) -> None:
+		self.rtp_received += 1
+		self.payloads[data[1] & 0x7F] = self.payloads.get(data[1] & 0x7F, 0) + 1
+		if ((data[1] & 0x7F) == 13):
+			self.sids += 1
+		elif (data[1] & 0x80):
+			self.talkspurts += 1
+
+class Simulation:  # one line and one ip phone of pstnxsip main loop in virtual time
+	def __init__(self, seed: int = 1, runtime: str = SYNC, overrides: dict = {}):  # overrides: common settings of scenario (restart required ones)
+		random.seed(seed)
+		self.runtime = runtime
+		self.overrides = overrides
+		self.clock = VirtualClock()
+		clock.set_clock(self.clock)
+		timers.reset()
+		self.network = FakeNetwork(self.clock)
+		settings = {'CALL_FORWARD_TO': f'{PBX_USER}@{PBX_IP}', 'MODEM_TONE_DETECT': True, 'RTP_COMFORT_NOISE': True, 'MODEM_ECHO_CANCEL': 128, 'DSP_PSTN_TO_IP': ['dc_removal', 'agc', 'meter'], 'DSP_IP_TO_PSTN': ['high_pass', 'meter'], 'LOCAL_PBX': False, 'LINE_CAN_DIAL': False, 'RECORDING_ENABLED': False, \
+			'IP_PBX_USER': GATEWAY_USER, 'IP_PBX_DOMAIN': PBX_IP, 'IP_PBX_PASS': 'secret', 'IP_PBX_PROXY_ADDRESS': PBX_IP, 'IP_PBX_PROXY_PORT': PBX_PORT}
+		settings.update(overrides)
+		self.saved = (IPPhone.socket_class, Line.serial_class, pstnxsip.session_class, {name: getattr(common, name) for name in settings})
+		IPPhone.socket_class = self.network
+		Line.serial_class = staticmethod(lambda: FakeModem(self))
+		for name, value in settings.items():
+			setattr(common, name, value)
+		self.pbx = FakePBX(self, self.network)
+		phone_args = (common.IP_PBX_USER, common.IP_PBX_DOMAIN, common.IP_PBX_PASS, GATEWAY_IP, GATEWAY_PORT, common.RTP_LOW, common.RTP_HIGH, \
+			common.IP_PBX_PROXY_ADDRESS, common.IP_PBX_PROXY_PORT)
+		self.media: media_process.MediaProcess = None
+		self.gateway: SimGateway = None
+		self.loop: VirtualLoop = None
+		if (runtime == SPLIT):
+			client = media_process.MediaClient(['sim0'], 1)
+			self.media = media_process.MediaProcess(*client.media_args)
+			self.media.start()
+			self.line = client.lines[0]  # LineProxy
+			self.modem_line: Line = self.media.lines[0]
+			self.ip_phone = media_process.SignalingIPPhone(client, 0, *phone_args)
+			pstnxsip.session_class = media_process.SplitCallSession
+		else:
+			self.line = Line('sim0')
+			self.modem_line = self.line
+			self.ip_phone = IPPhone(*phone_args)
+		self.modem: FakeModem = self.modem_line.modem
+		if (runtime == ASYNC):
+			self.gateway = SimGateway(self.line, self.ip_phone)
+			async_gateway.gateways[:] = [self.gateway]
+			self.loop = VirtualLoop(self)
+			self.task = self.loop.create_task(self.gateway.run())
+		else:
+			pstnxsip.lines[:] = [self.line]
+			pstnxsip.ip_phones[:] = [self.ip_phone]
+			pstnxsip.sessions[:] = []
+			self.line.start()
+			self.ip_phone.start()
+		self.run_until(lambda: self.ip_phone.state not in (common.PS_INACTIVE, common.PS_REGISTERING), common.RESPONSE_TIMEOUT * 2)
+
+	def close(self) -> None:
+		if (self.loop != None):
+			self.task.cancel()
+			try:
+				self.loop.run_until_complete(self.task)  # gateway stops line and deregisters ip phone
+			except asyncio.CancelledError:
+				pass
+			self.loop.close()
+			async_gateway.gateways[:] = []
+			async_gateway.ip_call_ids.clear()
+		if (self.media != None):
+			self.media.stop()
+			self.line.stop()  # closes rings of media client
+		IPPhone.socket_class, Line.serial_class, pstnxsip.session_class, settings = self.saved
+		for name, value in settings.items():
+			setattr(common, name, value)
+		pstnxsip.lines[:] = []
+		pstnxsip.ip_phones[:] = []
+		pstnxsip.sessions[:] = []
+		clock.set_clock(clock.Clock())
+		timers.reset()
+
+	def pending(self) -> bool:  # a reader waited by event loop has data, selector would not wait
+		readers = self.line.get_readers() + self.ip_phone.get_readers()
+		if (self.media != None):
+			readers += [self.media.conn] + self.modem_line.get_readers() + self.media.rtps[0].get_readers()
+		return any([ready(r) for r in readers])
+
+	def deliver(self) -> bool:  # ASYNC: passes modem data to gateway like ModemProtocol, returns True if any
+		if ((self.gateway.modem_transport == None) or self.modem.unplugged or (self.modem.in_waiting == 0)):
+			return False
+		self.gateway.modem_received(self.modem.read(self.modem.in_waiting))
+		return True
+
+	async def wait(self, predicate: Callable, timeout: float) -> bool:  # ASYNC: polls predicate every FRAME_TIME, returns False on timeout
+		end = self.clock.now + timeout
+		while (not predicate()):
+			if (self.task.done()):
+				self.task.result()  # raises error of gateway
+				return False
+			if (self.clock.now >= end):
+				return False
+			await asyncio.sleep(FRAME_TIME)
+		return True
+
+	def run_until(self, predicate: Callable, timeout: float) -> bool:  # runs pstnxsip main loop, returns False on timeout
+		if (self.loop != None):
+			return self.loop.run_until_complete(self.wait(predicate, timeout))
+		end = self.clock.now + timeout
+		passes = 0
+		while (not predicate()):
+			busy = pstnxsip.handle_events()
+			if (self.media != None):
+				self.media.handle_events()  # prompts are written by timers of signaling side, media side needs no extra passes
+			if (busy or self.pending()):
+				passes += 1
+				if (passes > MAX_PASSES):
+					raise RuntimeError(f'simulation: call state does not settle at {self.clock.now:.3f}')
+				continue
+			passes = 0
+			if (self.clock.now >= end):
+				return False
+			due = [t for t in (timers.wheel.next_deadline(), self.clock.next_event(), end) if (t != 0)]
+			self.clock.advance(min(due))
+		return True
+
+	def idle(self) -> bool:
+		return ((self.modem.rings == 0) and (self.pbx.dialog == None) and (pstnxsip.sessions == []) and \
+			(self.line.state == common.PS_IDLE) and (self.ip_phone.state == common.PS_IDLE) and ((self.gateway == None) or self.gateway.idle()))
+
+	def pstn_call(self, caller_id: str = '5551234', rings: int = 10, answer_delay: float = 1.0, talk_time: float = 2.0, hangup: str = 'ip', timeout: float = 600) -> dict:
+		self.pbx.answer_delay = answer_delay
+		self.pbx.talk_time = talk_time
+		self.pbx.hangup = (hangup == 'ip')
+		self.pbx.digits = ''
+		self.modem.caller_id = caller_id
+		self.modem.rings = rings
+		if (hangup == 'pstn'):
+			self.clock.call_later(answer_delay + talk_time, self.modem.busy_tone)
+		elif (hangup == 'tone'):
+			self.clock.call_later(answer_delay + talk_time, lambda: self.modem.play_tone('busy'))
+		self.clock.call_later(0, self.modem.ring)
+		return self.tone_result(self.result(timeout), hangup)
+
+	def ip_call(self, number: str = '*11', talk_time: float = 2.0, hangup: str = 'ip', timeout: float = 600) -> dict:
+		self.pbx.talk_time = talk_time
+		self.pbx.hangup = (hangup == 'ip')
+		self.pbx.digits = number
+		if (hangup == 'pstn'):
+			self.clock.call_later(talk_time, self.modem.busy_tone)
+		elif (hangup == 'tone'):
+			self.clock.call_later(talk_time, lambda: self.modem.play_tone('busy'))
+		self.pbx.call()
+		return self.tone_result(self.result(timeout), hangup)
+
+	def modem_fault(self, down_time: float = 5.0, talk_time: float = 2.0, timeout: float = 600) -> dict:  # modem unplugged, a call meanwhile is rejected (503), next call bridged after reopen
+		self.modem.unplugged = True
+		self.clock.call_later(down_time, self.modem.replug)
+		self.pbx.rejected = 0
+		self.clock.call_later(0.5, self.pbx.call)
+		self.run_until(lambda: self.pbx.rejected != 0, timeout)
+		rejected = self.pbx.rejected
+		recovered = (self.run_until(lambda: self.idle() and (not self.line.recovering()), timeout) and (self.modem_line.faults != 0))
+		r = self.ip_call(talk_time=talk_time, timeout=timeout)
+		r['completed'] = (r['completed'] and recovered and (rejected == 503))
+		return r
+
+	def comfort_noise_call(self, talk_time: float = 2.0, timeout: float = 600) -> dict:  # both parties pause, silence is sent as SID packets (RFC 3389) both ways
+		self.pbx.cn = True
+		self.modem.pauses = True
+		sids = self.pbx.sids
+		talkspurts = self.pbx.talkspurts
+		try:
+			r = self.pstn_call(talk_time=talk_time, timeout=timeout)
+		finally:
+			self.pbx.cn = False
+			self.modem.pauses = False
+		r['sids'] = self.pbx.sids - sids
+		r['talkspurts'] = self.pbx.talkspurts - talkspurts
+		r['sids_received'] = self.ip_phone.jitter.sids
+		r['completed'] = (r['completed'] and (r['sids'] != 0) and (r['talkspurts'] != 0) and (r['sids_received'] != 0))
+		return r
+
+	def pcma_call(self, direction: str = 'pstn', talk_time: float = 2.0, timeout: float = 600) -> dict:  # IP user takes PCMA only, A-law passes between modem and RTP both ways
+		self.pbx.codec = PCMA
+		self.pbx.rejected = 0
+		pcma = self.pbx.payloads.get(PCMA, 0)
+		try:
+			r = (self.pstn_call(talk_time=talk_time, timeout=timeout) if (direction == 'pstn') else self.ip_call(talk_time=talk_time, timeout=timeout))
+		finally:
+			self.pbx.codec = PCMU
+		r['pcma'] = self.pbx.payloads.get(PCMA, 0) - pcma
+		r['voice_format'] = self.modem_line.voice_format
+		r['completed'] = (r['completed'] and (self.pbx.rejected == 0) and (r['pcma'] != 0) and (r['pcma'] == r['rtp_to_pbx']) and (r['voice_format'] == g711.ALAW))
+		return r
+
+	def tone_result(self, r: dict, hangup: str) -> dict:  # busy tone must end call within TONE_HANGUP_TIME
+		if (hangup == 'tone'):
+			r['completed'] = (r['completed'] and (0 < r['tone_latency'] <= TONE_HANGUP_TIME))
+		return r
+
+	def result(self, timeout: float) -> dict:
+		start = self.clock.now
+		modem_audio = self.modem.audio_written
+		rtp_received = self.pbx.rtp_received
+		self.modem.first_audio = 0
+		completed = self.run_until(self.idle, timeout)
+		detector = self.modem_line.tone_detector
+		return {'completed': completed, 'duration': self.clock.now - start, 'bridged': (self.modem.audio_written > modem_audio), \
+			'setup': ((self.modem.first_audio - start) if (self.modem.first_audio != 0) else None), 'rtp_to_pbx': self.pbx.rtp_received - rtp_received, \
+			'dialed': self.modem.dialed, 'tone_latency': (detector.latency if (detector != None) else 0.0)}
+
+def ready(reader) -> bool:  # fake modem, fake socket or media process pipe has data
+	if (isinstance(reader, FakeModem)):
+		return (reader.in_waiting != 0)
+	if (isinstance(reader, FakeSocket)):
+		return (len(reader.queue) != 0)
+	return reader.poll()
+
+SCENARIOS = {  # name: (call, arguments, expected bridged), runtime and overrides arguments select Simulation (default SYNC, no overrides): (call, arguments, expected bridged)
+	'pstn_ip_hangup': ('pstn_call', {'hangup': 'ip'}, True),
+	'pstn_pstn_hangup': ('pstn_call', {'hangup': 'pstn'}, True),
+	'pstn_busy_tone': ('pstn_call', {'hangup': 'tone'}, True),  # busy tone without <DLE>b, MODEM_TONE_DETECT
+	'pstn_no_answer': ('pstn_call', {'rings': 6, 'answer_delay': None}, False),  # ANSWER_TIMEOUT
+	'pstn_caller_gives_up': ('pstn_call', {'rings': 2, 'answer_delay': None}, False),  # RING_TIMEOUT
+	'pstn_session_timeout': ('pstn_call', {'talk_time': 1000}, True),  # MAX_SESSION_DURATION
+	'ip_ip_hangup': ('ip_call', {'hangup': 'ip'}, True),
+	'ip_pstn_hangup': ('ip_call', {'hangup': 'pstn'}, True),
+	'ip_busy_tone': ('ip_call', {'hangup': 'tone'}, True),
+	'ip_no_digits': ('ip_call', {'number': '', 'hangup': 'none'}, False),  # DIAL_TIMEOUT
+	'ip_outside_number': ('ip_call', {'number': '05552345678'}, True),  # dialed on last digit of IP_DIAL_PLAN pattern
+	'ip_starred_number': ('ip_call', {'number': '**5'}, True),  # '_[*][*].' pattern, dialed after DIGIT_TIMEOUT
+	'ip_denied_number': ('ip_call', {'number': '0090', 'hangup': 'none'}, False),  # IP_DIAL_DENY, rejected on second digit
+	'modem_unplugged': ('modem_fault', {}, True),  # watchdog reopens modem, IP call meanwhile rejected with 503
+	'pstn_comfort_noise': ('comfort_noise_call', {}, True),  # RTP_COMFORT_NOISE accepted by IP PBX, pauses sent as SID packets both ways
+	'pstn_pcma': ('pcma_call', {'direction': 'pstn', 'overrides': {'MODEM_PASSTHROUGH': True}}, True),  # A-law modem, PCMA offered by gateway and taken by IP PBX
+	'ip_pcma': ('pcma_call', {'direction': 'ip', 'overrides': {'MODEM_PASSTHROUGH': True}}, True),  # PCMA only offer of IP PBX accepted
+	'split_pstn_call': ('pstn_call', {'runtime': SPLIT}, True),  # SPLIT_MEDIA: MediaClient, SplitCallSession and SignalingIPPhone bridge through media process
+	'split_ip_call': ('ip_call', {'runtime': SPLIT, 'hangup': 'pstn'}, True),
+	'async_pstn_call': ('pstn_call', {'runtime': ASYNC}, True),  # ASYNC_MODE: AsyncGateway coroutines, fake devices call protocol callbacks
+	'async_ip_call': ('ip_call', {'runtime': ASYNC}, True),
+}
+
+def run(calls: int, scenarios: list, talk_time: float, seed: int) -> dict:  # runs calls round robin over scenarios, returns passed/failed counts per scenario
+	sim = None
+	virtual_time = 0.0
+	results = {name: [0, 0] for name in scenarios}
+	try:
+		for n in range(calls):
+			name = scenarios[n % len(scenarios)]
+			call, args, bridged = SCENARIOS[name]
+			args = dict(args)
+			runtime = args.pop('runtime', SYNC)
+			overrides = args.pop('overrides', {})
+			if ((sim == None) or (sim.runtime != runtime) or (sim.overrides != overrides)):
+				if (sim != None):
+					virtual_time += sim.clock.now
+					sim.close()
+				sim = Simulation(seed, runtime, overrides)
+			args.setdefault('talk_time', talk_time)
+			r = getattr(sim, call)(**args)
+			ok = (r['completed'] and (r['bridged'] == bridged))
+			results[name][0 if ok else 1] += 1
+			if (not ok):
+				common.error(f'simulation: {name} failed at {sim.clock.now:.3f}: {r}')
+	finally:
+		if (sim != None):
+			results['virtual_time'] = virtual_time + sim.clock.now
+			sim.close()
+	return results
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='pstnxsip call flow simulation in virtual time (run in the project folder, prompts are played)')
+	parser.add_argument('--calls', type=int, default=len(SCENARIOS), help='number of calls')
+	parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), help='scenarios to run (default all)')
+	parser.add_argument('--talk', type=float, default=2.0, help='talk time of bridged calls (seconds)')
+	parser.add_argument('--seed', type=int, default=1, help='random seed')
+	args = parser.parse_args()
+	start = time.perf_counter()
+	results = run(args.calls, args.scenario or list(SCENARIOS), args.talk, args.seed)
+	wall = time.perf_counter() - start
+	virtual_time = results.pop('virtual_time')
+	print(f'{"scenario":<22} {"passed":>7} {"failed":>7}')
+	for name, (passed, failed) in results.items():
+		print(f'{name:<22} {passed:>7} {failed:>7}')
+	print(f'{virtual_time:.0f} s virtual time in {wall:.1f} s')
+	exit(1 if any([r[1] for r in results.values()]) else 0)
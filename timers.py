@@ -0,0 +1,121 @@
+# Project: pstnxsip (Python3) (01/01/2023)
+# Module: timers.py
+# Description: Timer service of pstnxsip. Hashed timer wheel on the monotonic clock, timers call a callback when expired.
+# Author: Aydin Parin
+
+from typing import Callable
+import clock
+
+TICK = 0.01  # wheel resolution (10 ms), timers are still fired at their exact deadline
+SLOTS = 512  # wheel size (5.12 sec per round), longer timers wait more rounds in their slot
+
+now = clock.monotonic
+
+class Timer:
+	__slots__ = ('deadline', 'callback', 'tick', 'slot')
+
+	def __init__(self, deadline: float, callback: Callable):
+		self.deadline = deadline
+		self.callback = callback
+		self.tick = 0  # absolute tick number of deadline
+		self.slot: dict = None  # wheel slot while scheduled
+
+	@property
+	def active(self) -> bool:
+		return (self.slot != None)
+
+	def remaining(self) -> float:  # seconds to deadline
+		return self.deadline - now()
+
+class TimerWheel:
+	def __init__(self, tick: float = TICK, slots: int = SLOTS):
+		self.tick = tick
+		self.slots = [{} for n in range(slots)]  # dict as an ordered set of timers, O(1) insert and remove
+		self.current = int(now() / tick)  # first tick not yet expired
+		self.count = 0
+
+	def schedule_at(self, deadline: float, callback: Callable) -> Timer:
+		timer = Timer(deadline, callback)
+		self.add(timer)
+		return timer
+
+	def schedule(self, delay: float, callback: Callable) -> Timer:
+		return self.schedule_at(now() + delay, callback)
+
+	def add(self, timer: Timer) -> None:
+		timer.tick = max(int(timer.deadline / self.tick), self.current)  # overdue timers expire on the next pass
+		timer.slot = self.slots[timer.tick % len(self.slots)]
+		timer.slot[timer] = None
+		self.count += 1
+
+	def cancel(self, timer: Timer) -> None:
+		if ((timer != None) and (timer.slot != None)):
+			del timer.slot[timer]
+			timer.slot = None
+			self.count -= 1
+
+	def rearm(self, timer: Timer, delay: float, callback: Callable) -> Timer:  # moves a running timer to a new deadline, schedules a new one if not running
+		if ((timer == None) or (timer.slot == None)):
+			return self.schedule(delay, callback)
+		self.cancel(timer)
+		timer.deadline = now() + delay
+		timer.callback = callback
+		self.add(timer)
+		return timer
+
+	def expire(self) -> int:  # calls callbacks of expired timers, returns number of expired timers
+		t = now()
+		last = int(t / self.tick)
+		expired = []
+		for tick in range(self.current, min(last + 1, self.current + len(self.slots))):  # at most one round even if loop was blocked
+			slot = self.slots[tick % len(self.slots)]
+			for timer in slot:
+				if ((timer.tick <= last) and (timer.deadline <= t)):
+					expired.append(timer)
+		self.current = last  # current tick may still have timers not due
+		expired.sort(key=lambda timer: timer.deadline)
+		for timer in expired:
+			if (timer.slot != None):  # not cancelled by an earlier callback
+				self.cancel(timer)
+				timer.callback()
+		return len(expired)
+
+	def next_deadline(self) -> float:  # earliest deadline, 0 if no timer running
+		if (self.count == 0):
+			return 0
+		for tick in range(self.current, self.current + len(self.slots)):  # first slot with a timer due in this round
+			due = [timer.deadline for timer in self.slots[tick % len(self.slots)] if (timer.tick == tick)]
+			if (due != []):
+				return min(due)
+		return min([timer.deadline for slot in self.slots for timer in slot])  # only timers of next rounds
+
+	def timeout(self) -> float:  # seconds until next deadline, None if no timer running (wait forever)
+		deadline = self.next_deadline()
+		if (deadline == 0):
+			return None
+		return max(deadline - now(), 0)
+
+wheel = TimerWheel()  # timers of all lines, ip phones and calls of this process
+
+def reset() -> None:  # drops all timers, a new wheel starts at current time of clock
+	global wheel
+	wheel = TimerWheel()
+
+def schedule(delay: float, callback: Callable) -> Timer:
+	return wheel.schedule(delay, callback)
+
+def schedule_at(deadline: float, callback: Callable) -> Timer:
+	return wheel.schedule_at(deadline, callback)
+
+def rearm(timer: Timer, delay: float, callback: Callable) -> Timer:
+	return wheel.rearm(timer, delay, callback)
+
+def cancel(timer: Timer) -> None:  # returns None to clear timer attribute, i.e. self.timer = timers.cancel(self.timer)
+	wheel.cancel(timer)
+	return None
+
+def expire() -> int:
+	return wheel.expire()
+
+def timeout() -> float:
+	return wheel.timeout()
@@ -3,6 +3,24 @@ if not exist debug\ goto ERR
 if not exist debug\pstnxsip.py goto ERR
 if not exist debug\line.py goto ERR
 if not exist debug\ip_phone.py goto ERR
+if not exist debug\async_gateway.py goto ERR
+if not exist debug\call_session.py goto ERR
+if not exist debug\media_process.py goto ERR
+if not exist debug\timers.py goto ERR
+if not exist debug\profiler.py goto ERR
+if not exist debug\clock.py goto ERR
+if not exist debug\simulation.py goto ERR
+if not exist debug\dial_plan.py goto ERR
+if not exist debug\config.py goto ERR
+if not exist debug\jitter_buffer.py goto ERR
+if not exist debug\modem_emulator.py goto ERR
+if not exist debug\raw_serial.py goto ERR
+if not exist debug\g711.py goto ERR
+if not exist debug\dtmf.py goto ERR
+if not exist debug\call_progress.py goto ERR
+if not exist debug\echo_canceller.py goto ERR
+if not exist debug\dsp.py goto ERR
+if not exist debug\vad.py goto ERR
 if not exist debug\common.py goto ERR
 if not exist live\ md live
 find /V "debug(" <.\debug\pstnxsip.py >.\pstnxsip.py
@@ -11,6 +29,42 @@ find /V "debug(" <.\debug\line.py >.\line.py
 echo .\debug\line.py processed
 find /V "debug(" <.\debug\ip_phone.py >.\ip_phone.py
 echo .\debug\ip_phone.py processed
+find /V "debug(" <.\debug\async_gateway.py >.\async_gateway.py
+echo .\debug\async_gateway.py processed
+find /V "debug(" <.\debug\call_session.py >.\call_session.py
+echo .\debug\call_session.py processed
+find /V "debug(" <.\debug\media_process.py >.\media_process.py
+echo .\debug\media_process.py processed
+find /V "debug(" <.\debug\timers.py >.\timers.py
+echo .\debug\timers.py processed
+find /V "debug(" <.\debug\profiler.py >.\profiler.py
+echo .\debug\profiler.py processed
+find /V "debug(" <.\debug\clock.py >.\clock.py
+echo .\debug\clock.py processed
+find /V "debug(" <.\debug\simulation.py >.\simulation.py
+echo .\debug\simulation.py processed
+find /V "debug(" <.\debug\dial_plan.py >.\dial_plan.py
+echo .\debug\dial_plan.py processed
+find /V "debug(" <.\debug\config.py >.\config.py
+echo .\debug\config.py processed
+find /V "debug(" <.\debug\jitter_buffer.py >.\jitter_buffer.py
+echo .\debug\jitter_buffer.py processed
+find /V "debug(" <.\debug\modem_emulator.py >.\modem_emulator.py
+echo .\debug\modem_emulator.py processed
+find /V "debug(" <.\debug\raw_serial.py >.\raw_serial.py
+echo .\debug\raw_serial.py processed
+find /V "debug(" <.\debug\g711.py >.\g711.py
+echo .\debug\g711.py processed
+find /V "debug(" <.\debug\dtmf.py >.\dtmf.py
+echo .\debug\dtmf.py processed
+find /V "debug(" <.\debug\call_progress.py >.\call_progress.py
+echo .\debug\call_progress.py processed
+find /V "debug(" <.\debug\echo_canceller.py >.\echo_canceller.py
+echo .\debug\echo_canceller.py processed
+find /V "debug(" <.\debug\dsp.py >.\dsp.py
+echo .\debug\dsp.py processed
+find /V "debug(" <.\debug\vad.py >.\vad.py
+echo .\debug\vad.py processed
 copy .\debug\common.py .\common.py >NUL
 echo .\debug\common.py copied
 echo 'debug(' lines cleaned from files in './debug' folder (except common.py) then copied './' folder.